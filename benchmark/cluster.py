@@ -0,0 +1,320 @@
+"""
+Cluster benchmark without Docker: start N replicas, each a gateway and a worker process on ephemeral ports and Unix
+sockets of this machine, drive a mixed read/write workload against all of them, then report throughput, latency
+percentiles per operation, the time the replicas take to converge once the writes stop, and the replication
+messages and bytes they exchanged, taken from their GET /metrics.
+
+    python benchmark/cluster.py --replicas 3 --duration 10 --concurrency 16 --write_ratio 0.2
+    python benchmark/cluster.py --replicas 5 --gossip --output cluster.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import logging
+import argparse
+import tempfile
+import multiprocessing
+from collections import defaultdict
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from graph_crdt.graph import CRDTGraph  # noqa: E402
+from graph_crdt.worker import DatabaseWorker  # noqa: E402
+from graph_crdt.gateway import DatabaseGateway  # noqa: E402
+from graph_crdt.shard import Partition, shard_addresses  # noqa: E402
+from gcrdt_client import AsyncCRDTGraphClient  # noqa: E402
+
+READS = ("exists_vertex", "get_neighbors", "find_path")
+WRITES = ("add_vertex", "add_edge", "remove_vertex")
+
+
+def run_worker(address, partition):
+    logging.disable(logging.INFO)
+    DatabaseWorker(socket_internal=address, database=CRDTGraph(partition=partition)).execute()
+
+
+def run_gateway(port, friend, address, gossip, shards):
+    logging.disable(logging.INFO)
+    DatabaseGateway.execute(host="127.0.0.1", port=port, your_address=f"http://127.0.0.1:{port}",
+                            friend_address=friend, socket_internal=address, gossip=gossip, shards=shards)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_until(condition, timeout, interval=0.05):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("Replica did not start in time")
+        time.sleep(interval)
+
+
+def responding(address):
+    try:
+        return requests.get(f"{address}/", timeout=1).ok
+    except requests.RequestException:
+        return False
+
+
+class LocalCluster:
+    """
+    Replicas as local processes, each registering with the first one
+    """
+    def __init__(self, replicas, shards=1, gossip=False):
+        self.replicas = replicas
+        self.shards = shards
+        self.gossip = gossip
+        self.directory = tempfile.TemporaryDirectory()
+        self.processes = list()
+        self.addresses = list()
+
+    def start(self):
+        for index in range(self.replicas):
+            address = os.path.join(self.directory.name, f"worker-{index}.sock")
+            for shard, shard_address in enumerate(shard_addresses(address, self.shards)):
+                partition = Partition(shard, self.shards) if self.shards > 1 else None
+                self.spawn(run_worker, shard_address, partition)
+                wait_until(lambda: os.path.exists(shard_address), 10)
+
+            port = free_port()
+            friend = self.addresses[0] if self.addresses else None
+            self.spawn(run_gateway, port, friend, address, self.gossip, self.shards)
+            self.addresses.append(f"http://127.0.0.1:{port}")
+            wait_until(lambda: responding(self.addresses[-1]), 10)
+
+        return self.addresses
+
+    def spawn(self, target, *args):
+        process = multiprocessing.Process(target=target, args=args, daemon=True)
+        process.start()
+        self.processes.append(process)
+
+    def stop(self):
+        # gateways before their workers
+        for process in reversed(self.processes):
+            process.terminate()
+        for process in self.processes:
+            process.join(5)
+        self.directory.cleanup()
+
+
+def parse_metrics(text):
+    """
+    :param text: Prometheus text format
+    :return: dictionary metric name -> sum of its samples over all labels
+    """
+    totals = defaultdict(float)
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, _, value = line.rpartition(" ")
+            totals[name.split("{")[0]] = totals[name.split("{")[0]] + float(value)
+
+    return totals
+
+
+async def replication(clients):
+    """
+    :return: replication messages, failed messages and merged payload bytes of the whole cluster so far
+    """
+    totals = defaultdict(float)
+    for client in clients:
+        response = await client.session.get(f"{client.hosts[0]}/metrics")
+        for name, value in parse_metrics(response.text).items():
+            totals[name] = totals[name] + value
+
+    return {
+        "messages": int(totals["gcrdt_peer_request_seconds_count"]),
+        "failures": int(totals["gcrdt_peer_request_failures_total"]),
+        "bytes": int(totals["gcrdt_worker_merge_payload_bytes_sum"])
+    }
+
+
+async def states(clients, sharded):
+    """
+    :return: Merkle root of each replica, that is its whole LWW state, or its live vertices when sharded since a
+    sharded replica has no single Merkle tree
+    """
+    states = list()
+    for client in clients:
+        if sharded:
+            states.append(await client.list_nodes())
+        else:
+            response = await client.session.post(f"{client.hosts[0]}/digest", data={"level": 0, "nodes": "[0]"})
+            states.append(response.json()["data"])
+
+    return states
+
+
+async def converge(clients, timeout, sharded=False, interval=0.05):
+    """
+    Wait until every replica has the same state
+    :return: seconds waited
+    """
+    start = time.perf_counter()
+    while True:
+        current = await states(clients, sharded)
+        if all(state == current[0] for state in current):
+            return time.perf_counter() - start
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"Replicas did not converge within {timeout} seconds")
+        await asyncio.sleep(interval)
+
+
+async def propagation(clients, u, timeout, interval=0.01):
+    """
+    Write a vertex on one replica and wait until all the others see it
+    :return: seconds until the last replica sees it
+    """
+    writer = random.choice(clients)
+    await writer.add_vertex(u)
+    start = time.perf_counter()
+    pending = [client for client in clients if client is not writer]
+    while pending:
+        seen = await asyncio.gather(*[client.exists_vertex(u) for client in pending])
+        pending = [client for client, status in zip(pending, seen) if not status]
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"Vertex {u} did not reach every replica within {timeout} seconds")
+        if pending:
+            await asyncio.sleep(interval)
+
+    return time.perf_counter() - start
+
+
+async def workload(clients, args, next_vertex):
+    """
+    Run the mixed workload for args.duration seconds
+    :return: dictionary operation -> list of latencies in seconds, number of failed requests
+    """
+    latencies, failures = defaultdict(list), 0
+    deadline = time.perf_counter() + args.duration
+    rng = random.Random(args.seed)
+
+    async def operation(client):
+        nonlocal next_vertex
+        if rng.random() < args.write_ratio:
+            name = rng.choices(WRITES, weights=(0.4, 0.5, 0.1))[0]
+            if name == "add_vertex":
+                next_vertex = next_vertex + 1
+                return name, client.add_vertex(next_vertex)
+            if name == "add_edge":
+                return name, client.add_edge(rng.randrange(next_vertex), rng.randrange(next_vertex))
+            return name, client.remove_vertex(rng.randrange(next_vertex))
+
+        name = rng.choices(READS, weights=(0.45, 0.45, 0.1))[0]
+        if name == "find_path":
+            return name, client.find_path(rng.randrange(next_vertex), rng.randrange(next_vertex), max_hops=6)
+        return name, getattr(client, name)(rng.randrange(next_vertex))
+
+    async def run():
+        nonlocal failures
+        while time.perf_counter() < deadline:
+            name, request = await operation(rng.choice(clients))
+            start = time.perf_counter()
+            try:
+                await request
+                latencies[name].append(time.perf_counter() - start)
+            except Exception:
+                failures = failures + 1
+
+    await asyncio.gather(*[run() for _ in range(args.concurrency)])
+    return latencies, failures
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000
+    }
+
+
+async def bench(addresses, args):
+    clients = [AsyncCRDTGraphClient(address, pool_size=args.concurrency) for address in addresses]
+    try:
+        await clients[0].batch([("add_vertex", u) for u in range(args.vertices)])
+        await clients[0].batch([("add_edge", u, random.randrange(args.vertices)) for u in range(args.vertices)])
+        await clients[0].broadcast()
+        await converge(clients, args.timeout, args.shards > 1)
+
+        before = await replication(clients)
+        start = time.perf_counter()
+        latencies, failures = await workload(clients, args, args.vertices)
+        elapsed = time.perf_counter() - start
+        convergence = await converge(clients, args.timeout, args.shards > 1)
+        after = await replication(clients)
+
+        probes = [await propagation(clients, 10 ** 9 + probe, args.timeout) for probe in range(args.probes)]
+    finally:
+        for client in clients:
+            await client.close()
+
+    operations = sum(len(values) for values in latencies.values())
+    return {
+        "replicas": len(addresses),
+        "shards": args.shards,
+        "gossip": args.gossip,
+        "duration": elapsed,
+        "operations": operations,
+        "failures": failures,
+        "throughput": operations / elapsed,
+        "latency": dict(all=summarize([value for values in latencies.values() for value in values]),
+                        **{name: summarize(values) for name, values in sorted(latencies.items())}),
+        "convergence_seconds": convergence,
+        "propagation_p50_seconds": percentile(probes, 0.5) if probes else None,
+        "propagation_max_seconds": max(probes) if probes else None,
+        "replication": {key: after[key] - before[key] for key in after}
+    }
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Local multi-replica load and convergence benchmark")
+    args.add_argument("-n", "--replicas", type=int, default=3, help="Number of replicas")
+    args.add_argument("-s", "--shards", type=int, default=1, help="Worker processes per replica")
+    args.add_argument("-g", "--gossip", action="store_true", help="Replicate through gossip instead of flooding")
+    args.add_argument("-d", "--duration", type=float, default=10, help="Seconds of workload")
+    args.add_argument("-c", "--concurrency", type=int, default=16, help="Requests in flight")
+    args.add_argument("-w", "--write_ratio", type=float, default=0.2, help="Share of the requests that write")
+    args.add_argument("-v", "--vertices", type=int, default=1000, help="Vertices loaded before the workload")
+    args.add_argument("-p", "--probes", type=int, default=5,
+                      help="Single writes timed until every replica sees them, after the workload")
+    args.add_argument("--timeout", type=float, default=60, help="Seconds to wait for the replicas to converge")
+    args.add_argument("--seed", type=int, default=42, help="Seed of the workload")
+    args.add_argument("-o", "--output", type=str, default=None, help="Write the report to this JSON file")
+    args = args.parse_args()
+    logging.disable(logging.INFO)
+    random.seed(args.seed)
+
+    cluster = LocalCluster(args.replicas, args.shards, args.gossip)
+    try:
+        report = asyncio.run(bench(cluster.start(), args))
+    finally:
+        cluster.stop()
+
+    print(f"{report['replicas']} replicas, {report['operations']} operations in {report['duration']:.1f}s: "
+          f"{report['throughput']:.0f} ops/s, {report['failures']} failures")
+    for name, latency in report["latency"].items():
+        print(f"  {name:<14} {latency['count']:>8} {latency['p50_ms']:>9.2f} ms p50 {latency['p99_ms']:>9.2f} ms p99")
+    print(f"Converged {report['convergence_seconds']:.2f}s after the writes stopped, single writes reached every "
+          f"replica in {report['propagation_p50_seconds']:.2f}s p50, {report['propagation_max_seconds']:.2f}s max")
+    print(f"Replication: {report['replication']['messages']} messages, {report['replication']['failures']} failed, "
+          f"{report['replication']['bytes']} payload bytes")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
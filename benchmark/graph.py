@@ -0,0 +1,186 @@
+"""
+Microbenchmarks of CRDTGraph in process, without gateway or worker, on synthetic graphs of several shapes and sizes:
+uniform random edges, a power-law graph grown by preferential attachment, and a square grid. Every case reports the
+operations per second of add_vertex, add_edge, get_neighbors, find_path, broadcast, merge, remove_vertex and clear.
+
+    python benchmark/graph.py --sizes 1000,100000,1000000 --output results.json
+    python benchmark/graph.py --baseline results.json --tolerance 0.2 --repeat 3
+
+With a baseline, the run fails when any case is slower than the baseline by more than the tolerance.
+"""
+import sys
+import json
+import math
+import random
+import logging
+import time
+import argparse
+import platform
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from graph_crdt.graph import CRDTGraph  # noqa: E402
+
+
+def random_graph(n, degree, rng):
+    edges = set()
+    while len(edges) < n * degree // 2:
+        u, v = rng.randrange(n), rng.randrange(n)
+        if u != v:
+            edges.add((min(u, v), max(u, v)))
+
+    return sorted(edges)
+
+
+def power_law_graph(n, degree, rng):
+    # preferential attachment: each new vertex links to degree / 2 vertices picked proportionally to their degree
+    links = max(1, degree // 2)
+    edges, targets = list(), list(range(links))
+    for u in range(links, n):
+        for v in {rng.choice(targets) for _ in range(links)}:
+            edges.append((v, u))
+            targets.append(v)
+        targets.extend([u] * links)
+
+    return edges
+
+
+def grid_graph(n, degree, rng):
+    side = int(math.sqrt(n))
+    edges = list()
+    for u in range(side * side):
+        row, column = divmod(u, side)
+        if column + 1 < side:
+            edges.append((u, u + 1))
+        if row + 1 < side:
+            edges.append((u, u + side))
+
+    return edges
+
+
+SHAPES = {
+    "random": random_graph,
+    "power_law": power_law_graph,
+    "grid": grid_graph
+}
+
+
+def measure(results, case, operation, func, ops):
+    """
+    Time func, which runs ops operations, and record the result
+    :return: return value of func
+    """
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    results.append(dict(case, operation=operation, ops=ops, seconds=elapsed, ops_per_second=ops / elapsed))
+    return value
+
+
+def bench_case(shape, size, args, results):
+    rng = random.Random(args.seed)
+    edges = SHAPES[shape](size, args.degree, rng)
+    case = {"shape": shape, "size": size, "storage": args.storage}
+    graph = CRDTGraph(storage=args.storage)
+
+    def add_vertices():
+        for u in range(size):
+            graph.add_vertex(u)
+
+    def add_edges():
+        for u, v in edges:
+            graph.add_edge(u, v)
+
+    measure(results, case, "add_vertex", add_vertices, size)
+    measure(results, dict(case, edges=len(edges)), "add_edge", add_edges, len(edges))
+
+    nodes = [rng.randrange(size) for _ in range(args.queries)]
+    measure(results, case, "get_neighbors", lambda: [graph.get_neighbors(u) for u in nodes], len(nodes))
+
+    pairs = [(rng.randrange(size), rng.randrange(size)) for _ in range(args.paths)]
+    measure(results, case, "find_path", lambda: [graph.find_path(u, v) for u, v in pairs], len(pairs))
+
+    entries = graph.size()
+    data = measure(results, case, "broadcast", graph.broadcast, entries)
+    replica = CRDTGraph(storage=args.storage)
+    measure(results, case, "merge", lambda: replica.merge(data["vertices_added"], data["vertices_removed"],
+                                                          data["edges_added"], data["edges_removed"]), entries)
+
+    # leave most of the graph to clear
+    removed = rng.sample(range(size), min(args.queries, size // 10))
+    measure(results, case, "remove_vertex", lambda: [graph.remove_vertex(u) for u in removed], len(removed))
+
+    live = len(graph.list_nodes())
+    measure(results, case, "clear", graph.clear, live)
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: results of this run
+    :param baseline: results of an earlier run
+    :param tolerance: accepted relative slowdown
+    :return: list of (result, baseline ops per second) of the cases slower than the baseline beyond tolerance
+    """
+    def key(result):
+        return result["shape"], result["size"], result["storage"], result["operation"]
+
+    previous = {key(result): result["ops_per_second"] for result in baseline["results"]}
+    return [(result, previous[key(result)]) for result in results
+            if key(result) in previous and result["ops_per_second"] < previous[key(result)] * (1 - tolerance)]
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="CRDTGraph microbenchmarks")
+    args.add_argument("-s", "--sizes", type=str, default="1000,100000",
+                      help="Comma separated numbers of vertices, 1000000 takes minutes")
+    args.add_argument("-g", "--shapes", type=str, default=",".join(SHAPES), help="Comma separated graph shapes")
+    args.add_argument("-d", "--degree", type=int, default=4, help="Average degree of the random and power-law graphs")
+    args.add_argument("-q", "--queries", type=int, default=10000,
+                      help="Number of get_neighbors queries and of removed vertices")
+    args.add_argument("-p", "--paths", type=int, default=20, help="Number of find_path queries")
+    args.add_argument("-r", "--repeat", type=int, default=1,
+                      help="Run every case this many times and keep the best rate of each operation")
+    args.add_argument("--storage", type=str, default="dict", choices=["dict", "array"], help="LWW set storage")
+    args.add_argument("--seed", type=int, default=42, help="Seed of the synthetic graphs and queries")
+    args.add_argument("-o", "--output", type=str, default=None, help="Write the results to this JSON file")
+    args.add_argument("-b", "--baseline", type=str, default=None, help="Compare with the results of an earlier run")
+    args.add_argument("-t", "--tolerance", type=float, default=0.2,
+                      help="Relative slowdown against the baseline reported as a regression")
+    args = args.parse_args()
+    logging.disable(logging.INFO)
+
+    results = list()
+    for size in map(int, args.sizes.split(",")):
+        for shape in args.shapes.split(","):
+            runs = list()
+            for _ in range(args.repeat):
+                bench_case(shape, size, args, runs)
+
+            best = dict()
+            for result in runs:
+                previous = best.get(result["operation"])
+                if previous is None or result["ops_per_second"] > previous["ops_per_second"]:
+                    best[result["operation"]] = result
+            results.extend(best.values())
+            for result in best.values():
+                print(f"{result['shape']:>10} {result['size']:>8} {result['operation']:<14} "
+                      f"{result['ops']:>8} ops {result['ops_per_second']:>12.0f} ops/s")
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "arguments": vars(args),
+        "results": results
+    }
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for result, previous in regressions:
+            print(f"Regression: {result['shape']} {result['size']} {result['operation']} "
+                  f"{result['ops_per_second']:.0f} ops/s, baseline {previous:.0f} ops/s")
+        sys.exit(1 if regressions else 0)
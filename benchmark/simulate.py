@@ -0,0 +1,98 @@
+"""
+Replication of a large cluster simulated in one process, see benchmark/simulation.py: replicas start and register, a
+random workload runs with churn, slow replicas and a partition in its middle third, then the replicas converge
+without new writes. Reports the messages and bytes of the startup, those of the workload per write, the time to
+converge and the entries each replica holds. Times are virtual, so a run is reproducible from its seed on any machine.
+
+    python benchmark/simulate.py --replicas 100 --gossip --duration 60 --write_rate 50 --loss 0.01
+    python benchmark/simulate.py --replicas 50 --churn_rate 0.2 --partition 0.3 --slow 0.1 --output sim.json
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from benchmark.simulation import SimulatedNetwork, Simulation  # noqa: E402
+
+
+def bench(args):
+    network = SimulatedNetwork(args.seed, latency=args.latency, jitter=args.jitter, loss=args.loss)
+    simulation = Simulation(args.replicas, network, gossip=args.gossip, seed=args.seed, interval=args.interval)
+
+    for replica in simulation.random.sample(simulation.replicas, int(args.slow * args.replicas)):
+        network.slow(replica.address, args.slow_delay)
+
+    started = time.perf_counter()
+    simulation.run(args.warmup)
+    startup_seconds = simulation.converge(args.timeout)
+    startup = network.stats()
+
+    if args.partition:
+        def split():
+            live = [replica.address for replica in simulation.live()]
+            cut = max(1, int(args.partition * len(live)))
+            network.partition(live[:cut], live[cut:])
+
+        network.call_later(args.duration / 3, split)
+        network.call_later(2 * args.duration / 3, network.heal)
+
+    simulation.run(args.duration, args.write_rate, args.churn_rate, args.gc_interval)
+    convergence = simulation.converge(args.timeout)
+
+    return dict(simulation.stats(since=startup), startup=dict(startup, seconds=startup_seconds),
+                convergence_seconds=convergence,
+                wall_seconds=time.perf_counter() - started, arguments=vars(args),
+                max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Simulated replication of a large cluster")
+    args.add_argument("-n", "--replicas", type=int, default=100, help="Number of replicas to start with")
+    args.add_argument("-g", "--gossip", action="store_true", help="Replicate through gossip instead of flooding")
+    args.add_argument("-i", "--interval", type=float, default=None,
+                      help="Seconds between two sync rounds without writes, defaults to the gateway's")
+    args.add_argument("-d", "--duration", type=float, default=30, help="Virtual seconds of workload")
+    args.add_argument("-w", "--write_rate", type=float, default=20, help="Writes per virtual second, whole cluster")
+    args.add_argument("-c", "--churn_rate", type=float, default=0.0,
+                      help="Replicas per virtual second crashing and replaced by a newcomer")
+    args.add_argument("--gc_interval", type=float, default=None, help="Seconds between garbage collections")
+    args.add_argument("--latency", type=float, default=0.02, help="One-way latency in seconds")
+    args.add_argument("--jitter", type=float, default=0.01, help="Maximum extra one-way latency in seconds")
+    args.add_argument("--loss", type=float, default=0.0, help="Probability that a message is lost")
+    args.add_argument("--slow", type=float, default=0.0, help="Share of the replicas that are slow")
+    args.add_argument("--slow_delay", type=float, default=0.5, help="Seconds a slow replica takes per request")
+    args.add_argument("--partition", type=float, default=0.0,
+                      help="Share of the replicas cut off from the others during the middle third of the workload")
+    args.add_argument("--warmup", type=float, default=5, help="Virtual seconds for the replicas to register")
+    args.add_argument("--timeout", type=float, default=300, help="Virtual seconds to wait for convergence")
+    args.add_argument("--seed", type=int, default=42, help="Seed of the network, the workload and the churn")
+    args.add_argument("-o", "--output", type=str, default=None, help="Write the report to this JSON file")
+    args = args.parse_args()
+    logging.disable(logging.INFO)
+
+    report = bench(args)
+    network = report["network"]
+    print(f"{report['replicas']} live replicas ({report['joined']} joined, {report['crashed']} crashed), "
+          f"{report['writes']} writes, {report['wall_seconds']:.1f}s of wall time")
+    print(f"Startup: {report['startup']['messages']} messages, {report['startup']['bytes']} bytes")
+    print(f"Messages: {network['messages']} ({report['messages_per_write']:.1f} per write), "
+          f"{network['bytes']} bytes ({report['bytes_per_write']:.0f} per write), {network['dropped']} dropped, "
+          f"{network['failures']} failed requests")
+    for path, counts in network["paths"].items():
+        print(f"  {path:<12} {counts['messages']:>10} messages {counts['bytes']:>14} bytes")
+    print(f"Merges: {report['merges']}, {report['redundant_merges']} of them changed nothing")
+    if report["convergence_seconds"] is None:
+        print(f"Did not converge within {args.timeout} virtual seconds")
+    else:
+        print(f"Converged {report['convergence_seconds']:.2f} virtual seconds after the last write")
+    for key, memory in report["memory"].items():
+        print(f"  {key:<16} {memory['total']:>10} in total {memory['max']:>8} at most per replica")
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,607 @@
+"""
+Replication of many replicas in one process, to measure message amplification, convergence time and memory under
+loss, partitions, slow peers and churn, reproducibly from a seed.
+
+SimulatedNetwork is a discrete-event simulation in a single thread: a virtual clock jumps from one event to the next,
+and the latency, loss, partitions and slow peers are drawn from one seeded random generator. The same seed and the
+same calls give the same run, message for message, whatever the speed of the machine.
+
+A SimulatedReplica is a real graph_crdt.worker.DatabaseWorker sending its requests through the SimulatedNetwork, so
+the deltas, merges, forwarding, gossip exchanges, acknowledgements, anti-entropy and garbage collection are those of
+the worker. In front of it, a simulated gateway keeps what graph_crdt.gateway does around the worker queries:
+
+- /register: a newcomer registers with a friend, which has its worker tell the friends it knows, then catches up
+  with an anti-entropy run against it, the streaming /bootstrap endpoint needing HTTP;
+- /merge: the uuids already merged are dropped, the others go to the worker with the friends to forward them to;
+- /gossip, /digest and /digest/entries go to the worker as they are;
+- like graph_crdt.scheduler.SyncScheduler, a sync round runs Config.SYNC_WRITE_DELAY seconds after a local write,
+  every sync interval otherwise, and skips the friends whose previous sync is still running.
+
+Simulated replicas only advertise the JSON encoding, the message sizes are those of JSON.
+"""
+import json
+import heapq
+import random
+import itertools
+from collections import defaultdict
+from graph_crdt import codec
+from graph_crdt.config import Config
+from graph_crdt.graph import CRDTGraph
+from graph_crdt.dedupe import DedupeCache
+from graph_crdt.merkle import check_nodes
+from graph_crdt.worker import DatabaseWorker
+from graph_crdt.network import Network, message_size
+
+
+class SimulatedNetwork(Network):
+    """
+    Every one-way message takes the latency of its link plus a uniform jitter, and is lost with the loss rate of the
+    link or when a partition separates both ends. A slow peer handles each request that many seconds late. Replies
+    travel back the same way, a request whose reply never comes fails after its timeout.
+    """
+    def __init__(self, seed=0, latency=0.01, jitter=0.005, loss=0.0, start=1.0):
+        """
+        :param seed: seed of every random draw of the network
+        :param latency: default one-way latency in seconds
+        :param jitter: default maximum extra latency in seconds
+        :param loss: default probability that a one-way message is lost
+        :param start: virtual time of the first event, replicas stamp their writes with this clock and an LWW
+                      timestamp must not be 0
+        """
+        self.random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.clock = start
+        self.events = list()
+        self.sequence = itertools.count()
+        self.handlers = dict()
+        self.links = dict()
+        self.delays = dict()
+        self.groups = None
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.failures = 0
+        self.paths = defaultdict(lambda: {"messages": 0, "bytes": 0})
+
+    def attach(self, address, handler):
+        """
+        :param address: address of a replica
+        :param handler: function called with the path and the message of every request to the address, returning
+                        the reply
+        """
+        self.handlers[address] = handler
+
+    def detach(self, address):
+        self.handlers.pop(address, None)
+
+    def now(self):
+        return self.clock
+
+    def call_later(self, delay, func):
+        heapq.heappush(self.events, (self.clock + delay, next(self.sequence), func))
+
+    def set_link(self, source, destination, latency=None, jitter=None, loss=None, both=True):
+        """
+        Override the defaults for the messages from source to destination, and back if both
+        """
+        link = {"latency": latency, "jitter": jitter, "loss": loss}
+        self.links[(source, destination)] = link
+        if both:
+            self.links[(destination, source)] = link
+
+    def slow(self, address, delay):
+        """
+        :param address: replica handling every request delay seconds late, 0 to make it normal again
+        """
+        if delay:
+            self.delays[address] = delay
+        else:
+            self.delays.pop(address, None)
+
+    def partition(self, *groups):
+        """
+        Split the network: addresses in different groups cannot reach each other, addresses in none of the groups
+        reach everyone
+        :param groups: collections of addresses
+        """
+        self.groups = {address: index for index, group in enumerate(groups) for address in group}
+
+    def heal(self):
+        self.groups = None
+
+    def reachable(self, source, destination):
+        if self.groups is None or source not in self.groups or destination not in self.groups:
+            return True
+
+        return self.groups[source] == self.groups[destination]
+
+    def transit(self, source, destination):
+        """
+        :return: seconds a message takes from source to destination, None if it is lost
+        """
+        link = self.links.get((source, destination), dict())
+        loss = link.get("loss") if link.get("loss") is not None else self.loss
+        if not self.reachable(source, destination) or (loss and self.random.random() < loss):
+            self.dropped = self.dropped + 1
+            return None
+
+        latency = link.get("latency") if link.get("latency") is not None else self.latency
+        jitter = link.get("jitter") if link.get("jitter") is not None else self.jitter
+        return latency + (self.random.uniform(0, jitter) if jitter else 0.0)
+
+    def count(self, path, message):
+        size = message_size(message)
+        self.messages = self.messages + 1
+        self.bytes = self.bytes + size
+        self.paths[path]["messages"] = self.paths[path]["messages"] + 1
+        self.paths[path]["bytes"] = self.paths[path]["bytes"] + size
+
+    def post(self, source, destination, path, message, callback, timeout=Config.REQUEST_TIMEOUT):
+        """
+        See Network.post, the callback is not called once the sender is detached
+        """
+        done = False
+
+        def finish(reply, error):
+            nonlocal done
+            if done:
+                return
+            done = True
+            if error is not None:
+                self.failures = self.failures + 1
+            if source in self.handlers:
+                callback(reply, error)
+
+        def respond(reply, error):
+            if reply is not None:
+                self.count(path, reply)
+            back = self.transit(destination, source)
+            if back is not None:
+                self.call_later(back, lambda: finish(reply, error))
+
+        def deliver():
+            handler = self.handlers.get(destination)
+            if handler is None:
+                respond(None, ConnectionRefusedError(f"{destination} is down"))
+                return
+
+            try:
+                respond(handler(path, message), None)
+            except Exception as e:
+                respond(None, e)
+
+        self.count(path, message)
+        self.call_later(timeout, lambda: finish(None, TimeoutError(f"{destination}{path} did not answer in time")))
+        delay = self.transit(source, destination)
+        if delay is not None:
+            self.call_later(delay + self.delays.get(destination, 0.0), deliver)
+
+    def run(self, until):
+        """
+        Handle the events up to a virtual time, the clock ends there
+        :param until: virtual time
+        """
+        while self.events and self.events[0][0] <= until:
+            timestamp, _, func = heapq.heappop(self.events)
+            self.clock = max(self.clock, timestamp)
+            func()
+        self.clock = max(self.clock, until)
+
+    def run_until(self, predicate, timeout, interval=0.05):
+        """
+        Run until predicate holds, checking it every interval virtual seconds
+        :return: virtual seconds it took, None if it still does not hold after timeout
+        """
+        start = self.clock
+        while not predicate():
+            if self.clock - start >= timeout:
+                return None
+            self.run(self.clock + interval)
+
+        return self.clock - start
+
+    def stats(self):
+        return {
+            "messages": self.messages,
+            "bytes": self.bytes,
+            "dropped": self.dropped,
+            "failures": self.failures,
+            "paths": {path: dict(counts) for path, counts in sorted(self.paths.items())}
+        }
+
+
+class LoopbackServer:
+    """
+    Worker transport of a simulated replica: queries are handed to DatabaseWorker.handle directly, and the address of
+    a query is the function its reply goes to
+    """
+    def __init__(self, network):
+        self.network = network
+
+    def call_soon(self, callback):
+        self.network.call_later(0, callback)
+
+    def send(self, msg, address):
+        address(json.loads(msg))
+
+
+class SimulatedReplica:
+    def __init__(self, address, network, gossip=False, interval=None, delay=Config.SYNC_WRITE_DELAY,
+                 fanout=Config.GOSSIP_FANOUT, seed=0):
+        """
+        :param address: address of the replica on the network
+        :param network: SimulatedNetwork
+        :param gossip: replicate through gossip rounds rather than flooding
+        :param interval: seconds between two rounds without local writes, defaults to the gateway's
+        :param delay: maximum seconds between a local write and the round shipping it
+        :param fanout: friends of a gossip round
+        :param seed: seed of the choice of gossip friends
+        """
+        self.address = address
+        self.network = network
+        self.gossip = gossip
+        if interval is None:
+            interval = Config.GOSSIP_INTERVAL if gossip else Config.SYNC_INTERVAL
+        self.interval = interval
+        self.delay = delay
+        self.fanout = fanout
+        self.random = random.Random(seed)
+        self.worker = DatabaseWorker(None, database=CRDTGraph(), network=network, server=LoopbackServer(network),
+                                     address=address)
+        self.database = self.worker.database
+        self.cluster_table = list()
+        self.address_set = set()
+        # uuids only expire by count, a TTL would follow the wall clock rather than the virtual one
+        self.merged_uuid = DedupeCache(ttl=None)
+        self.in_flight = set()
+        self.uuids = itertools.count(1)
+        self.round_scheduled = False
+        self.alive = False
+        self.rounds = 0
+
+    def start(self, friend=None):
+        """
+        Join the network, registering with a friend and catching up with it
+        :param friend: address of a live replica, None for the first one
+        """
+        self.alive = True
+        self.network.attach(self.address, self.handle)
+        if friend is not None:
+            self.register_cluster_table(friend)
+            self.register_with(friend)
+            if Config.BOOTSTRAP_ON_REGISTER:
+                self.query({"query": "anti_entropy", "to": friend})
+
+        # spread the periodic rounds of the replicas over the interval
+        self.network.call_later(self.random.uniform(0, self.interval), self.tick)
+
+    def register_with(self, friend):
+        self.network.post(self.address, friend, "/register", {"their_address": self.address,
+                                                              "my_address": self.address},
+                          lambda reply, error: self.registered(friend, error))
+
+    def registered(self, friend, error):
+        # a gateway whose registration fails does not start, a simulated one tries again as if restarted
+        if error is not None and self.alive:
+            self.register_with(friend)
+
+    def stop(self):
+        """
+        Crash: leave the network without telling anyone, the friends keep it in their cluster table
+        """
+        self.alive = False
+        self.network.detach(self.address)
+
+    def query(self, message, reply=None):
+        """
+        Hand a query to the worker, like the gateway does over its socket
+        :param reply: function called with the answer of the worker
+        """
+        self.worker.handle(message, reply or (lambda res: None))
+        self.worker.flush()
+
+    def ask(self, message):
+        """
+        :return: answer of a query the worker answers right away
+        """
+        replies = list()
+        self.query(message, replies.append)
+        return replies[0]
+
+    def register_cluster_table(self, address):
+        if address not in self.address_set and address != self.address:
+            self.cluster_table.append(address)
+            self.address_set.add(address)
+            return True
+
+        return False
+
+    def handle(self, path, message):
+        handlers = {
+            "/": self.status,
+            "/register": self.register,
+            "/merge": self.merge,
+            "/gossip": self.exchange,
+            "/digest": self.digest,
+            "/digest/entries": self.digest_entries
+        }
+        if path not in handlers:
+            raise ValueError(f"Unknown endpoint {path}")
+
+        return handlers[path](message)
+
+    def write(self, name, *args):
+        """
+        Apply a local mutation stamped with the virtual clock
+        :param name: add_vertex, add_edge, remove_vertex or remove_edge
+        :return: whether it changed the graph
+        """
+        status = getattr(self.database, name)(*args, timestamp=self.network.now())
+        if isinstance(status, tuple):
+            status = status[0]
+        if status:
+            self.written()
+
+        return bool(status)
+
+    def written(self):
+        if not self.round_scheduled:
+            self.round_scheduled = True
+            self.network.call_later(self.delay, self.scheduled_round)
+
+    def scheduled_round(self):
+        self.round_scheduled = False
+        if self.alive:
+            self.sync()
+
+    def tick(self):
+        if self.alive:
+            self.sync()
+            self.network.call_later(self.interval, self.tick)
+
+    def round_peers(self):
+        if self.gossip:
+            return self.random.sample(self.cluster_table, min(self.fanout, len(self.cluster_table)))
+
+        return list(self.cluster_table)
+
+    def sync(self):
+        """
+        One sync round with the friends that are not being synced already
+        :return: friends synced
+        """
+        peers, busy = list(), False
+        for peer in self.round_peers():
+            if peer in self.in_flight:
+                busy = True
+            else:
+                peers.append(peer)
+        if busy:
+            # their running sync may have missed the latest writes
+            self.written()
+
+        self.rounds = self.rounds + 1
+        self.in_flight.update(peers)
+        if self.gossip:
+            self.query({"query": "gossip_round", "peers": peers, "from_addr": self.address},
+                       lambda res: self.in_flight.difference_update(peers))
+            return peers
+
+        uuid = f"{self.address}/{next(self.uuids)}"
+        self.merged_uuid.add(uuid)
+        for peer in peers:
+            self.query({"query": "broadcast", "to": peer, "uuid": uuid, "from_addr": self.address},
+                       lambda res, peer=peer: self.in_flight.discard(peer))
+
+        return peers
+
+    def status(self, message):
+        return {"message": "OK!", "encodings": [codec.JSON_ENCODING]}
+
+    def register(self, message):
+        their_address = message["their_address"]
+        if not self.register_cluster_table(their_address):
+            return {"status": "Success", "data": "Cluster address has already been registered!"}
+
+        for address in self.cluster_table:
+            if address != their_address and address != message["my_address"]:
+                self.query({"query": "register", "from": self.address, "to": address, "data": their_address})
+
+        return {"status": "Success", "data": "Successfully register cluster address"}
+
+    def merge(self, message):
+        uuid = message["uuid"]
+        if uuid in self.merged_uuid:
+            return {"status": "Success", "data": "[]"}
+
+        self.merged_uuid.add(uuid)
+        self.ask(dict(message, query="merge", your_address=self.address,
+                      friend_list=[] if self.gossip else self.cluster_table))
+        return {"status": "Success", "data": "True"}
+
+    def exchange(self, message):
+        return self.ask(dict(message, query="gossip"))
+
+    def digest(self, message):
+        nodes = json.loads(message["nodes"])
+        check_nodes(message["level"], nodes)
+        return self.ask({"query": "digest", "level": message["level"], "nodes": nodes})
+
+    def digest_entries(self, message):
+        return self.ask(dict(message, query="digest_entries", buckets=json.loads(message["buckets"])))
+
+    def collect_garbage(self):
+        return self.ask({"query": "gc", "peers": self.cluster_table})["data"]
+
+    def root(self):
+        return self.database.merkle.digest(0, [0])
+
+    def merges(self):
+        """
+        :return: merges of the worker and how many of them changed nothing, read from its merge metrics
+        """
+        samples = list(self.worker.merge_changed.children.values())
+        return sum(sum(sample.counts) for sample in samples), sum(sample.counts[0] for sample in samples)
+
+    def memory(self):
+        """
+        :return: entries held by the replica: LWW entries, tombstones among them, changes kept for unacknowledged
+                 friends and merge uuids
+        """
+        database = self.database
+        return {
+            "entries": database.size(),
+            "tombstones": len(database.vertices.removed) + len(database.edges.removed),
+            "tracked_changes": len(database.delta_tracker.changes),
+            "dedupe_entries": len(self.merged_uuid)
+        }
+
+
+class Simulation:
+    """
+    Cluster of simulated replicas with a random workload and churn, all drawn from one seed
+    """
+    def __init__(self, replicas, network=None, gossip=False, seed=0, interval=None, delay=Config.SYNC_WRITE_DELAY,
+                 fanout=Config.GOSSIP_FANOUT):
+        """
+        :param replicas: number of replicas to start with
+        :param network: SimulatedNetwork, a default one with the same seed if None
+        :param gossip, interval, delay, fanout: see SimulatedReplica
+        :param seed: seed of the workload, the churn and the replicas
+        """
+        self.network = network if network is not None else SimulatedNetwork(seed)
+        self.random = random.Random(seed)
+        self.options = {"gossip": gossip, "interval": interval, "delay": delay, "fanout": fanout}
+        self.replicas = list()
+        self.vertices = 0
+        self.writes = 0
+        self.joined = 0
+        self.crashed = 0
+        for _ in range(replicas):
+            self.join()
+
+    def live(self):
+        return [replica for replica in self.replicas if replica.alive]
+
+    def join(self):
+        """
+        Start a new replica, registering with a random live one
+        :return: the replica
+        """
+        live = self.live()
+        replica = SimulatedReplica(f"replica-{len(self.replicas)}", self.network, seed=self.random.getrandbits(32),
+                                   **self.options)
+        self.replicas.append(replica)
+        replica.start(self.random.choice(live).address if live else None)
+        self.joined = self.joined + 1
+        return replica
+
+    def crash(self):
+        """
+        Stop a random live replica, unless it is the last one
+        :return: the replica, None if none was stopped
+        """
+        live = self.live()
+        if len(live) < 2:
+            return None
+
+        replica = self.random.choice(live)
+        replica.stop()
+        self.crashed = self.crashed + 1
+        return replica
+
+    def write(self):
+        """
+        One random mutation on a random live replica, most of them additions
+        :return: whether it changed the graph
+        """
+        replica = self.random.choice(self.live())
+        name = self.random.choices(("add_vertex", "add_edge", "remove_vertex", "remove_edge"),
+                                   weights=(0.4, 0.4, 0.15, 0.05))[0]
+        if name == "add_vertex" or self.vertices == 0:
+            self.vertices = self.vertices + 1
+            status = replica.write("add_vertex", self.vertices)
+        elif name in ("add_edge", "remove_edge"):
+            status = replica.write(name, self.random.randint(1, self.vertices), self.random.randint(1, self.vertices))
+        else:
+            status = replica.write(name, self.random.randint(1, self.vertices))
+
+        if status:
+            self.writes = self.writes + 1
+        return status
+
+    def schedule(self, rate, func, until):
+        """
+        Call func at the times of a Poisson process of rate events per virtual second, up to until
+        """
+        if rate <= 0:
+            return
+
+        def fire():
+            func()
+            self.schedule(rate, func, until)
+
+        delay = self.random.expovariate(rate)
+        if self.network.now() + delay <= until:
+            self.network.call_later(delay, fire)
+
+    def run(self, duration, write_rate=0.0, churn_rate=0.0, gc_interval=None):
+        """
+        Run the workload for some virtual seconds
+        :param write_rate: mutations per second over the whole cluster
+        :param churn_rate: replicas per second that crash, each replaced by a newcomer
+        :param gc_interval: seconds between two garbage collections on every replica, None for none
+        """
+        until = self.network.now() + duration
+        self.schedule(write_rate, self.write, until)
+        self.schedule(churn_rate, lambda: self.crash() and self.join(), until)
+        if gc_interval:
+            def collect():
+                for replica in self.live():
+                    replica.collect_garbage()
+                if self.network.now() + gc_interval <= until:
+                    self.network.call_later(gc_interval, collect)
+
+            self.network.call_later(gc_interval, collect)
+
+        self.network.run(until)
+
+    def converged(self):
+        roots = [replica.root() for replica in self.live()]
+        return all(root == roots[0] for root in roots)
+
+    def converge(self, timeout, interval=0.05):
+        """
+        Run without new writes until all the live replicas hold the same state
+        :return: virtual seconds it took, None if they did not converge within timeout
+        """
+        return self.network.run_until(self.converged, timeout, interval)
+
+    def stats(self, since=None):
+        """
+        :param since: network stats taken earlier, to only count the messages sent after them
+        """
+        network = self.network.stats()
+        if since is not None:
+            paths = {path: {key: counts[key] - since["paths"].get(path, dict()).get(key, 0) for key in counts}
+                     for path, counts in network["paths"].items()}
+            network = dict({key: network[key] - since[key] for key in ("messages", "bytes", "dropped", "failures")},
+                           paths=paths)
+        memory = [replica.memory() for replica in self.live()]
+        merges = [replica.merges() for replica in self.replicas]
+        return {
+            "replicas": len(memory),
+            "joined": self.joined,
+            "crashed": self.crashed,
+            "writes": self.writes,
+            "rounds": sum(replica.rounds for replica in self.replicas),
+            "network": network,
+            "messages_per_write": network["messages"] / self.writes if self.writes else 0.0,
+            "bytes_per_write": network["bytes"] / self.writes if self.writes else 0.0,
+            "merges": sum(total for total, _ in merges),
+            "redundant_merges": sum(redundant for _, redundant in merges),
+            "memory": {key: {"total": sum(entry[key] for entry in memory), "max": max(entry[key] for entry in memory)}
+                       for key in memory[0]}
+        }
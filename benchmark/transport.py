@@ -0,0 +1,76 @@
+"""
+Compare the gateway -> worker transports: round trips per second of small queries over UDP and the framed stream
+transport, each against a worker in its own process, then the stream transport alone with replies far beyond the
+UDP buffer size.
+
+    python benchmark/transport.py -n 20000
+"""
+import sys
+import json
+import logging
+import time
+import argparse
+import multiprocessing
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from graph_crdt.graph import CRDTGraph  # noqa: E402
+from graph_crdt.worker import DatabaseWorker  # noqa: E402
+from graph_crdt.transport import make_client  # noqa: E402
+
+
+def run_worker(address, transport):
+    logging.disable(logging.INFO)
+    DatabaseWorker(socket_internal=address, database=CRDTGraph(), transport=transport).execute()
+
+
+def start_worker(address, transport):
+    process = multiprocessing.Process(target=run_worker, args=(address, transport), daemon=True)
+    process.start()
+    time.sleep(0.5)
+    return process
+
+
+def query(client, data):
+    return json.loads(client.request(json.dumps(data).encode()).decode("utf-8"))
+
+
+def round_trips(client, n):
+    query(client, {"query": "add_vertex", "u": 1})
+    start = time.perf_counter()
+    for _ in range(n):
+        query(client, {"query": "exists_vertex", "u": 1})
+    return n / (time.perf_counter() - start)
+
+
+def large_replies(client, degree, n):
+    query(client, {"query": "add_vertex", "u": 0})
+    for v in range(1, degree + 1):
+        query(client, {"query": "add_vertex", "u": v})
+        query(client, {"query": "add_edge", "u": 0, "v": v})
+
+    start = time.perf_counter()
+    for _ in range(n):
+        reply = query(client, {"query": "get_neighbors", "u": 0})
+    elapsed = time.perf_counter() - start
+    return len(reply["status"]), n / elapsed
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Gateway to worker transport benchmark")
+    args.add_argument("-n", "--queries", type=int, default=10000, help="Number of small queries per transport")
+    args.add_argument("-d", "--degree", type=int, default=20000, help="Neighbors of the vertex used for large replies")
+    args = args.parse_args()
+    logging.disable(logging.INFO)
+
+    for transport, address in [("udp", ("127.0.0.1", 21901)), ("tcp", ("127.0.0.1", 21902)),
+                               ("tcp", "/tmp/gcrdt-benchmark.sock")]:
+        start_worker(address, transport)
+        client = make_client(address, transport)
+        print(f"{transport:>4} {str(address):<28} {round_trips(client, args.queries):>10.0f} queries/s")
+
+    address = ("127.0.0.1", 21903)
+    start_worker(address, "tcp")
+    neighbors, rate = large_replies(make_client(address, "tcp"), args.degree, 50)
+    print(f" tcp {str(address):<28} {rate:>10.1f} get_neighbors/s with {neighbors} neighbors per reply")
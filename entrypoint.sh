@@ -1,7 +1,7 @@
 #!/bin/bash
 
-python3 graph_crdt/executor.py -e worker &
-python3 graph_crdt/executor.py -e gateway -a $1 -f $2 &
+python3 graph_crdt/executor.py -e worker -s ${STORAGE:-dict} -t ${TRANSPORT:-tcp} ${DATA_DIR:+-d $DATA_DIR} ${SHARDS:+-n $SHARDS} &
+python3 graph_crdt/executor.py -e gateway -a $1 -f $2 -t ${TRANSPORT:-tcp} ${GOSSIP:+-g} ${SHARDS:+-n $SHARDS} &
 
 wait -n
 
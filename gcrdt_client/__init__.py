@@ -1 +1,2 @@
 from .gcrdt import CRDTGraphClient
+from .aio import AsyncCRDTGraphClient
@@ -0,0 +1,86 @@
+import itertools
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class AsyncCRDTGraphClient:
+    """
+    Asyncio client sharing one pool of keep-alive connections between any number of concurrent requests. Reads are
+    spread round-robin over the given replicas, mutations all go to the first one so that a client reads its own
+    writes once they have been broadcast.
+    """
+    def __init__(self, hosts, pool_size: int = 100, timeout: float = 10):
+        """
+        :param hosts: address of a database instance, or list of addresses of several replicas
+        :param pool_size: maximum number of open connections, further requests wait for a free one
+        :param timeout: seconds to wait for each response, not counting the wait for a free connection
+        """
+        if httpx is None:
+            raise ImportError("AsyncCRDTGraphClient requires httpx, install it with: pip install graph_crdt[async]")
+
+        if isinstance(hosts, str):
+            hosts = [hosts]
+        self.hosts = [host.rstrip("/") for host in hosts]
+        self.readers = itertools.cycle(self.hosts)
+        self.session = httpx.AsyncClient(limits=httpx.Limits(max_connections=pool_size,
+                                                             max_keepalive_connections=pool_size),
+                                         timeout=httpx.Timeout(timeout, pool=None))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        await self.session.aclose()
+
+    async def read(self, path, params=None):
+        response = await self.session.get(f"{next(self.readers)}{path}", params=params)
+        return response.json()
+
+    async def write(self, path):
+        response = await self.session.get(f"{self.hosts[0]}{path}")
+        return response.json()
+
+    async def add_vertex(self, u):
+        return await self.write(f"/add_vertex/{u}")
+
+    async def add_edge(self, u, v):
+        return await self.write(f"/add_edge/{u}/{v}")
+
+    async def remove_vertex(self, u):
+        return await self.write(f"/remove_vertex/{u}")
+
+    async def remove_edge(self, u, v):
+        return await self.write(f"/remove_edge/{u}/{v}")
+
+    async def batch(self, operations):
+        response = await self.session.post(f"{self.hosts[0]}/batch",
+                                           json=[list(operation) for operation in operations])
+        return response.json()["data"]
+
+    async def exists_vertex(self, u):
+        return (await self.read(f"/check_exists/{u}"))["data"]
+
+    async def exists_edge(self, u, v):
+        return (await self.read(f"/check_exists/{u}/{v}"))["data"]
+
+    async def find_path(self, u, v, max_hops=None):
+        params = {"max_hops": max_hops} if max_hops is not None else None
+        return await self.read(f"/find_path/{u}/{v}", params=params)
+
+    async def get_neighbors(self, u):
+        return (await self.read(f"/get_neighbors/{u}"))["data"]
+
+    async def list_nodes(self):
+        return (await self.read("/list_nodes"))["data"]
+
+    async def clear(self):
+        return (await self.write("/clear"))["data"]
+
+    async def broadcast(self):
+        return (await self.write("/broadcast"))["status"]
@@ -1,49 +1,88 @@
 import requests
+from requests.adapters import HTTPAdapter
 
 
 class CRDTGraphClient:
-    def __init__(self, host: str):
+    def __init__(self, host: str, pool_size: int = 10, timeout: float = 10):
+        """
+        :param host: address of the database instance
+        :param pool_size: number of keep-alive connections kept open to the instance
+        :param timeout: seconds to wait for each response
+        """
         while host[-1] == "/":
             host = host[: -1]
 
         self.host = host
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def get(self, path, params=None):
+        return self.session.get(f"{self.host}{path}", params=params, timeout=self.timeout)
 
     def add_vertex(self, u):
-        response = requests.get(f"{self.host}/add_vertex/{u}")
+        response = self.get(f"/add_vertex/{u}")
         return response.json()
 
     def add_edge(self, u, v):
-        response = requests.get(f"{self.host}/add_edge/{u}/{v}")
+        response = self.get(f"/add_edge/{u}/{v}")
         return response.json()
 
     def remove_vertex(self, u):
-        response = requests.get(f"{self.host}/remove_vertex/{u}")
+        response = self.get(f"/remove_vertex/{u}")
         return response.json()
 
     def remove_edge(self, u, v):
-        response = requests.get(f"{self.host}/remove_edge/{u}/{v}")
+        response = self.get(f"/remove_edge/{u}/{v}")
         return response.json()
 
+    def batch(self, operations):
+        """
+        Apply many mutations in one request
+        :param operations: iterable of ("add_vertex", u), ("add_edge", u, v), ("remove_vertex", u) or
+                           ("remove_edge", u, v)
+        :return: list of [status, message], one per operation
+        """
+        response = self.session.post(f"{self.host}/batch", json=[list(operation) for operation in operations],
+                                     timeout=self.timeout)
+        return response.json()["data"]
+
     def exists_vertex(self, u):
-        response = requests.get(f"{self.host}/check_exists/{u}")
+        response = self.get(f"/check_exists/{u}")
         return response.json()["data"]
 
     def exists_edge(self, u, v):
-        response = requests.get(f"{self.host}/check_exists/{u}/{v}")
+        response = self.get(f"/check_exists/{u}/{v}")
         return response.json()["data"]
 
-    def find_path(self, u, v):
-        response = requests.get(f"{self.host}/find_path/{u}/{v}")
+    def find_path(self, u, v, max_hops=None):
+        params = {"max_hops": max_hops} if max_hops is not None else None
+        response = self.get(f"/find_path/{u}/{v}", params=params)
         return response.json()
 
     def get_neighbors(self, u):
-        response = requests.get(f"{self.host}/get_neighbors/{u}")
+        response = self.get(f"/get_neighbors/{u}")
+        return response.json()["data"]
+
+    def list_nodes(self):
+        response = self.get("/list_nodes")
         return response.json()["data"]
 
     def clear(self):
-        response = requests.get(f"{self.host}/clear")
+        response = self.get(f"/clear")
         return response.json()["data"]
 
     def broadcast(self):
-        response = requests.get(f"{self.host}/broadcast")
+        response = self.get(f"/broadcast")
         return response.json()["status"]
@@ -0,0 +1,79 @@
+from array import array
+from bisect import bisect_left
+
+
+class AdjacencyIndex:
+    """
+    Per-vertex index of the edges that are currently present in the LWW edge set
+    """
+    def __init__(self, bidirection=True):
+        self.bidirection = bidirection
+        self.successors = dict()
+        self.predecessors = dict()
+
+    def add(self, u, v):
+        self._add(self.successors, u, v)
+        if self.bidirection is True:
+            self._add(self.successors, v, u)
+        else:
+            self._add(self.predecessors, v, u)
+
+    def discard(self, u, v):
+        self._discard(self.successors, u, v)
+        if self.bidirection is True:
+            self._discard(self.successors, v, u)
+        else:
+            self._discard(self.predecessors, v, u)
+
+    @staticmethod
+    def _add(index, u, v):
+        index.setdefault(u, set()).add(v)
+
+    @staticmethod
+    def _discard(index, u, v):
+        nodes = index.get(u)
+        if nodes is None:
+            return
+
+        nodes.discard(v)
+        if not nodes:
+            index.pop(u)
+
+    def neighbors(self, u):
+        return self.successors.get(u, ())
+
+    def reverse_neighbors(self, u):
+        if self.bidirection is True:
+            return self.successors.get(u, ())
+
+        return self.predecessors.get(u, ())
+
+
+class CompactAdjacencyIndex(AdjacencyIndex):
+    """
+    Adjacency index of the array storage: the neighbors of a vertex are a sorted int64 array, 8 bytes per edge end
+    instead of a set slot and a boxed int. Adding or removing an edge costs a binary search and a memmove of the
+    array, O(degree) rather than O(1).
+    """
+    @staticmethod
+    def _add(index, u, v):
+        nodes = index.get(u)
+        if nodes is None:
+            index[u] = array("q", [v])
+            return
+
+        position = bisect_left(nodes, v)
+        if position == len(nodes) or nodes[position] != v:
+            nodes.insert(position, v)
+
+    @staticmethod
+    def _discard(index, u, v):
+        nodes = index.get(u)
+        if nodes is None:
+            return
+
+        position = bisect_left(nodes, v)
+        if position < len(nodes) and nodes[position] == v:
+            nodes.pop(position)
+        if not nodes:
+            index.pop(u)
@@ -0,0 +1,127 @@
+"""
+Streaming state transfer to a newly registered replica. The friend walks a copy of its keys taken when the transfer
+starts and reads the current timestamps chunk by chunk, the newcomer merges every chunk as soon as it arrives.
+Entries changed during the transfer reach the newcomer through the regular merges anyway.
+
+    stream := frame* | end
+    frame  := payload length (uint32, little-endian) | chunk payload in the graph_crdt.codec format
+    end    := zero length (uint32), so that a transfer cut short is never mistaken for a complete one
+"""
+import time
+import uuid
+import struct
+from graph_crdt import codec
+from graph_crdt.config import Config
+
+_frame = struct.Struct("<I")
+
+
+class BootstrapCursor:
+    def __init__(self, database):
+        self.database = database
+        self.tables = database.state()
+        self.keys = [list(table.keys()) for table in self.tables]
+        self.table = 0
+        self.offset = 0
+        self.touched = time.monotonic()
+
+    def total(self):
+        return sum(len(keys) for keys in self.keys)
+
+    def done(self):
+        return self.table >= len(self.keys)
+
+    def next(self, size):
+        """
+        Read the current timestamps of the next keys
+        :param size: maximum number of entries
+        :return: vertices_added, vertices_removed, edges_added, edges_removed, entries freed meanwhile are left out
+        """
+        self.touched = time.monotonic()
+        chunk = [dict() for _ in codec.TABLES]
+        while size > 0 and not self.done():
+            keys = self.keys[self.table][self.offset: self.offset + size]
+            table = self.tables[self.table]
+            for key in keys:
+                timestamp = table.get(key)
+                if timestamp is not None:
+                    chunk[self.table][key] = timestamp
+
+            size = size - len(keys)
+            self.offset = self.offset + len(keys)
+            if self.offset >= len(self.keys[self.table]):
+                self.keys[self.table] = None
+                self.table = self.table + 1
+                self.offset = 0
+
+        return tuple(chunk)
+
+
+class BootstrapSessions:
+    """
+    Cursors of the transfers in progress, abandoned ones expire after Config.BOOTSTRAP_SESSION_TTL seconds
+    """
+    def __init__(self):
+        self.cursors = dict()
+
+    def open(self, database):
+        self.expire()
+        session = str(uuid.uuid4())
+        self.cursors[session] = BootstrapCursor(database)
+        return session, self.cursors[session].total()
+
+    def chunk(self, session, size=Config.BOOTSTRAP_CHUNK_SIZE):
+        """
+        :return: next chunk payload in the codec format, whether the transfer is complete
+        :raise KeyError: unknown or expired session
+        """
+        cursor = self.cursors[session]
+        payload = codec.encode(*cursor.next(size))
+        if cursor.done():
+            del self.cursors[session]
+
+        return payload, cursor.done()
+
+    def expire(self):
+        now = time.monotonic()
+        for session in [s for s, cursor in self.cursors.items()
+                        if now - cursor.touched > Config.BOOTSTRAP_SESSION_TTL]:
+            del self.cursors[session]
+
+
+def frame(payload):
+    return _frame.pack(len(payload)) + payload
+
+
+END = _frame.pack(0)
+
+
+def read_exactly(stream, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data.extend(chunk)
+
+    return bytes(data)
+
+
+def read_frames(stream):
+    """
+    Split a bootstrap stream into chunk payloads
+    :param stream: file-like object with a read(n) method
+    :return: generator of payloads
+    """
+    while True:
+        header = read_exactly(stream, _frame.size)
+        if len(header) < _frame.size:
+            raise ConnectionError("Bootstrap stream ended before the end of the transfer")
+
+        size, = _frame.unpack(header)
+        if size == 0:
+            return
+        payload = read_exactly(stream, size)
+        if len(payload) < size:
+            raise ConnectionError("Bootstrap stream ended before the end of the transfer")
+        yield payload
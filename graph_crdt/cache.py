@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from .config import Config
+
+
+class ReadCache:
+    """
+    Bounded LRU cache of query results keyed on (query, arguments, graph version). Any write moves the graph to a new
+    version, so a result is only ever served for the exact state it was computed on, and the entries of older versions
+    are dropped as soon as a lookup sees a newer one.
+    """
+    def __init__(self, capacity=Config.READ_CACHE_SIZE):
+        self.capacity = capacity
+        self.version = None
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        """
+        :param key: (query, arguments) tuple
+        :param version: current graph version
+        :return: cached result, None on a miss
+        """
+        if version != self.version:
+            self.evictions = self.evictions + len(self.entries)
+            self.entries.clear()
+            self.version = version
+
+        result = self.entries.get((key, version))
+        if result is None:
+            self.misses = self.misses + 1
+            return None
+
+        self.entries.move_to_end((key, version))
+        self.hits = self.hits + 1
+        return result
+
+    def put(self, key, version, result):
+        if self.capacity <= 0 or version != self.version:
+            return
+
+        self.entries[(key, version)] = result
+        self.entries.move_to_end((key, version))
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions = self.evictions + 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "version": self.version,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
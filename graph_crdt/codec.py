@@ -0,0 +1,105 @@
+"""
+Binary wire format of the LWW timestamp tables (little-endian):
+
+    header  := MAGIC (4 bytes) | VERSION (uint8) | table count (uint8)
+    table   := table id (uint8) | entry count n (uint64) | keys | timestamps
+    keys    := n int64 vertex ids, or 2n int64 edge endpoints (u0, v0, u1, v1, ...)
+    timestamps := n float64
+"""
+import struct
+
+MAGIC = b"GCRD"
+VERSION = 1
+ENCODING = f"binary/{VERSION}"
+JSON_ENCODING = "json"
+TABLES = ("vertices_added", "vertices_removed", "edges_added", "edges_removed")
+
+_header = struct.Struct("<4sBB")
+_table_header = struct.Struct("<BQ")
+
+
+def encode(vertices_added, vertices_removed, edges_added, edges_removed):
+    """
+    Pack the four LWW timestamp tables
+    :return: bytes
+    :raise struct.error: if a vertex id does not fit into an int64
+    """
+    chunks = [_header.pack(MAGIC, VERSION, len(TABLES))]
+    for table_id, table in enumerate((vertices_added, vertices_removed, edges_added, edges_removed)):
+        n = len(table)
+        chunks.append(_table_header.pack(table_id, n))
+        if table_id < 2:
+            chunks.append(struct.pack(f"<{n}q", *table.keys()))
+        else:
+            chunks.append(struct.pack(f"<{2 * n}q", *[x for edge in table.keys() for x in edge]))
+        chunks.append(struct.pack(f"<{n}d", *table.values()))
+
+    return b"".join(chunks)
+
+
+def layout(payload):
+    """
+    Walk the table headers of a binary payload without unpacking its columns
+    :param payload: bytes-like object
+    :return: list of (table id, entry count, offset of the keys)
+    :raise ValueError: if the payload is not in a supported format version, is truncated or has trailing bytes
+    """
+    if len(payload) < _header.size:
+        raise ValueError("Truncated payload")
+
+    magic, version, count = _header.unpack_from(payload, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a graph CRDT payload")
+    if version != VERSION:
+        raise ValueError(f"Unsupported payload version {version}")
+
+    tables = list()
+    offset = _header.size
+    for _ in range(count):
+        if len(payload) < offset + _table_header.size:
+            raise ValueError("Truncated payload")
+        table_id, n = _table_header.unpack_from(payload, offset)
+        if table_id >= len(TABLES):
+            raise ValueError(f"Unknown table {table_id}")
+        offset = offset + _table_header.size
+        tables.append((table_id, n, offset))
+        offset = offset + 8 * (n if table_id < 2 else 2 * n) + 8 * n
+        if len(payload) < offset:
+            raise ValueError("Truncated payload")
+
+    if offset != len(payload):
+        raise ValueError("Trailing bytes in payload")
+
+    return tables
+
+
+def check(payload):
+    """
+    Validate a binary payload, one that passes decodes without error
+    :param payload:
+    :return: None
+    :raise ValueError: if the payload is not in a supported format version, is truncated or has trailing bytes
+    """
+    layout(payload)
+
+
+def decode(payload):
+    """
+    Unpack the four LWW timestamp tables, each column in a single bulk unpack
+    :param payload: bytes-like object
+    :return: vertices_added, vertices_removed, edges_added, edges_removed
+    :raise ValueError: if the payload does not pass check
+    """
+    tables = [dict() for _ in TABLES]
+
+    for table_id, n, offset in layout(payload):
+        width = n if table_id < 2 else 2 * n
+        keys = struct.unpack_from(f"<{width}q", payload, offset)
+        timestamps = struct.unpack_from(f"<{n}d", payload, offset + 8 * width)
+
+        if table_id < 2:
+            tables[table_id] = dict(zip(keys, timestamps))
+        else:
+            tables[table_id] = dict(zip(zip(keys[0::2], keys[1::2]), timestamps))
+
+    return tuple(tables)
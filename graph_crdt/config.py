@@ -1,3 +1,30 @@
 class Config:
     REQUEST_TIMEOUT = 3
+    RPC_TIMEOUT = 30
+    FANOUT_WORKERS = 8
+    FANOUT_POOL_SIZE = 4
     BUFFER_SIZE = 2048
+    TRANSPORT = "tcp"
+    STREAM_CHUNK_SIZE = 1 << 16
+    DELTA_FULL_STATE_RATIO = 0.5
+    PEER_EXPIRY_FAILURES = 20
+    MERKLE_BUCKETS = 4096
+    MERKLE_FANOUT = 16
+    WAL_FSYNC = True
+    SNAPSHOT_WAL_BYTES = 64 << 20
+    SNAPSHOT_INTERVAL = 300
+    BOOTSTRAP_ON_REGISTER = True
+    BOOTSTRAP_CHUNK_SIZE = 50000
+    BOOTSTRAP_WINDOW = 2
+    BOOTSTRAP_SESSION_TTL = 60
+    DEDUPE_CAPACITY = 100000
+    DEDUPE_TTL = 3600
+    DEDUPE_BLOOM_ERROR_RATE = 0.001
+    GOSSIP = False
+    GOSSIP_FANOUT = 3
+    GOSSIP_INTERVAL = 1.0
+    SYNC_SCHEDULER = True
+    SYNC_INTERVAL = 30
+    SYNC_WRITE_DELAY = 0.5
+    SYNC_WRITE_BURST = 1000
+    READ_CACHE_SIZE = 10000
@@ -0,0 +1,118 @@
+import math
+import time
+import hashlib
+from collections import OrderedDict
+from .config import Config
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter over strings, sized for a number of items and a false-positive rate
+    """
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits / capacity * math.log(2))))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def positions(self, item):
+        # double hashing: k positions out of the two halves of one 128 bits digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self.positions(item):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.count = self.count + 1
+
+    def __contains__(self, item):
+        return all(self.array[position >> 3] & (1 << (position & 7)) for position in self.positions(item))
+
+    def full(self):
+        return self.count >= self.capacity
+
+
+class DedupeCache:
+    """
+    Bounded set of the merge UUIDs seen recently. UUIDs are kept exactly for at most ttl seconds and up to capacity
+    of them, the least recently seen going first. With a false-positive rate, evicted UUIDs are still remembered by
+    two rotating Bloom filters of capacity entries each, so a late duplicate is usually caught for a while longer.
+    A false positive only makes the gateway answer that a new merge was already applied, the sender then does not get
+    an acknowledgement and ships the same entries again on its next broadcast.
+    """
+    def __init__(self, capacity=Config.DEDUPE_CAPACITY, ttl=Config.DEDUPE_TTL,
+                 error_rate=Config.DEDUPE_BLOOM_ERROR_RATE):
+        """
+        :param capacity: maximum number of UUIDs kept exactly
+        :param ttl: seconds a UUID is kept exactly, None to only bound the size
+        :param error_rate: false-positive rate of the Bloom filters, None to disable them
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.error_rate = error_rate
+        self.entries = OrderedDict()
+        self.filters = [self.new_filter(), self.new_filter()] if error_rate else []
+        self.hits = 0
+        self.bloom_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def new_filter(self):
+        return BloomFilter(self.capacity, self.error_rate)
+
+    def expire(self):
+        if self.ttl is None:
+            return
+
+        deadline = time.monotonic() - self.ttl
+        while self.entries:
+            _, seen = next(iter(self.entries.items()))
+            if seen > deadline:
+                break
+            self.evict()
+
+    def evict(self):
+        item, _ = self.entries.popitem(last=False)
+        self.evictions = self.evictions + 1
+        if self.filters:
+            if self.filters[-1].full():
+                self.filters = [self.filters[-1], self.new_filter()]
+            self.filters[-1].add(item)
+
+    def __contains__(self, item):
+        self.expire()
+        if item in self.entries:
+            self.entries[item] = time.monotonic()
+            self.entries.move_to_end(item)
+            self.hits = self.hits + 1
+            return True
+
+        if any(item in bloom for bloom in self.filters):
+            self.bloom_hits = self.bloom_hits + 1
+            return True
+
+        self.misses = self.misses + 1
+        return False
+
+    def add(self, item):
+        self.expire()
+        self.entries[item] = time.monotonic()
+        self.entries.move_to_end(item)
+        while len(self.entries) > self.capacity:
+            self.evict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        return {
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "bloom_hits": self.bloom_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bloom_bytes": sum(len(bloom.array) for bloom in self.filters)
+        }
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from .config import Config
+
+
+class DeltaTracker:
+    """
+    Remember which LWW entries changed, in order, and up to which change each peer has acknowledged.
+    Only the changes after the slowest acknowledged peer are kept, and nothing is kept while no peer has
+    acknowledged anything, since such peers get a full-state transfer anyway. A peer whose syncs keep failing expires:
+    it is forgotten until it is reached again, so a dead peer does not pin the changes nor stop garbage collection.
+    """
+    def __init__(self, expiry=Config.PEER_EXPIRY_FAILURES):
+        """
+        :param expiry: failed syncs in a row after which a peer expires
+        """
+        self.sequence = 0
+        self.horizon = 0
+        self.changes = OrderedDict()
+        self.acked = dict()
+        self.expiry = expiry
+        self.failures = dict()
+        self.expired = set()
+
+    def record(self, table, changes):
+        """
+        LWWSet observer: stamp the changed entries with new sequence numbers
+        :return:
+        """
+        for item, _, new_timestamp in changes:
+            key = (table, item)
+            if new_timestamp is None:
+                # freed entries are always dominated by another one, so peers never need them
+                self.changes.pop(key, None)
+                continue
+
+            self.sequence = self.sequence + 1
+            if not self.acked:
+                self.horizon = self.sequence
+                continue
+
+            self.changes[key] = self.sequence
+            self.changes.move_to_end(key)
+
+    def since(self, sequence):
+        """
+        Entries changed after the given sequence number, newest first
+        :param sequence:
+        :return: list of (table, item), None if the changes are no longer known that far back
+        """
+        if sequence < self.horizon:
+            return None
+
+        keys = list()
+        for key in reversed(self.changes):
+            if self.changes[key] <= sequence:
+                break
+            keys.append(key)
+
+        return keys
+
+    def stable(self, peers):
+        """
+        Sequence number up to which every given peer has acknowledged the changes of this replica
+        :param peers: addresses of all the other known replicas
+        :return: -1 as long as one of them has never acknowledged anything
+        """
+        peers = [peer for peer in peers if peer not in self.expired]
+        if not peers:
+            return self.sequence
+
+        return min(self.acked.get(peer, -1) for peer in peers)
+
+    def stamp(self, table, item):
+        """
+        Sequence number of the last change of an entry, or an upper bound of it once the change is no longer tracked
+        :return:
+        """
+        return self.changes.get((table, item), self.horizon)
+
+    def acknowledge(self, peer, sequence):
+        self.reached(peer)
+        if sequence > self.acked.get(peer, -1):
+            self.acked[peer] = sequence
+            self.prune()
+
+    def reached(self, peer):
+        self.failures.pop(peer, None)
+        self.expired.discard(peer)
+
+    def unreachable(self, peer):
+        """
+        Count a failed sync with a peer, forgetting the peer once it reaches the expiry. An expired peer gets a full
+        state when it is back, but removed elements whose tombstones were collected meanwhile may come back with it.
+        :return: whether the peer has just expired
+        """
+        self.failures[peer] = self.failures.get(peer, 0) + 1
+        if self.failures[peer] < self.expiry or peer in self.expired:
+            return False
+
+        self.expired.add(peer)
+        self.forget(peer)
+        return True
+
+    def forget(self, peer):
+        self.acked.pop(peer, None)
+        self.prune()
+
+    def prune(self):
+        if not self.acked:
+            self.changes.clear()
+            self.horizon = self.sequence
+            return
+
+        slowest = min(self.acked.values())
+        while self.changes:
+            key, sequence = next(iter(self.changes.items()))
+            if sequence > slowest:
+                break
+            self.changes.popitem(last=False)
+
+        self.horizon = max(self.horizon, slowest)
@@ -1,21 +1,62 @@
+import os
 import argparse
+import multiprocessing
+from multiprocessing.connection import wait
 from graph_crdt import DatabaseGateway
 from graph_crdt import DatabaseWorker
+from graph_crdt import CRDTGraph
+from graph_crdt.shard import Partition, shard_addresses
+
+
+def run_worker(socket_internal, storage, transport, data_dir, partition=None):
+    instance = DatabaseWorker(socket_internal=socket_internal,
+                              database=CRDTGraph(storage=storage, partition=partition),
+                              transport=transport, data_dir=data_dir)
+    instance.execute()
+
 
 if __name__ == "__main__":
     args = argparse.ArgumentParser(description="Graph CRDT Executor")
     args.add_argument("-e", "--executor", type=str, default="gateway", help="Executor type")
     args.add_argument("-a", "--address", type=str, default="http://127.0.0.1:8000", help="Cluster address")
     args.add_argument("-f", "--friend_address", type=str, default=None, help="Friend address")
+    args.add_argument("-s", "--storage", type=str, default="dict", choices=["dict", "array"],
+                      help="LWW set storage of the worker")
+    args.add_argument("-t", "--transport", type=str, default="tcp", choices=["tcp", "udp"],
+                      help="Gateway to worker transport")
+    args.add_argument("-d", "--data_dir", type=str, default=None,
+                      help="Directory of the worker write-ahead log and snapshots, in memory only if not set")
+    args.add_argument("-g", "--gossip", action="store_true",
+                      help="Replicate through push-pull gossip rounds instead of flooding every merge")
+    args.add_argument("-n", "--shards", type=int, default=1,
+                      help="Number of worker processes the graph is partitioned over, the same for both executors")
     args = args.parse_args()
     print(args)
 
+    if args.shards > 1 and args.gossip:
+        raise SystemExit("Gossip replication is not supported by sharded replicas")
+
     if args.executor == "gateway":
         instance = DatabaseGateway()
         if args.friend_address == "-1":
             args.friend_address = None
         instance.execute(host="0.0.0.0", port=8000, your_address=args.address, friend_address=args.friend_address,
-                         socket_internal=("127.0.0.1", 20000))
+                         socket_internal=("127.0.0.1", 20000), transport=args.transport,
+                         gossip=args.gossip or None, shards=args.shards)
+    elif args.shards == 1:
+        run_worker(("127.0.0.1", 20000), args.storage, args.transport, args.data_dir)
     else:
-        instance = DatabaseWorker(socket_internal=("127.0.0.1", 20000))
-        instance.execute()
+        processes = list()
+        for index, address in enumerate(shard_addresses(("127.0.0.1", 20000), args.shards)):
+            data_dir = os.path.join(args.data_dir, f"shard-{index}") if args.data_dir is not None else None
+            processes.append(multiprocessing.Process(
+                target=run_worker, args=(address, args.storage, args.transport, data_dir,
+                                         Partition(index, args.shards))))
+
+        for process in processes:
+            process.start()
+
+        # the replica is down as soon as any of its shards is
+        wait([process.sentinel for process in processes])
+        for process in processes:
+            process.terminate()
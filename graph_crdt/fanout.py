@@ -0,0 +1,119 @@
+import time
+import requests
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from graph_crdt.config import Config
+from graph_crdt.metrics import MetricsRegistry
+from graph_crdt.network import Network
+
+
+class Fanout(Network):
+    """
+    Network of a real replica: send requests to peers over HTTP from a bounded thread pool, so that slow peers never
+    hold up the worker loop. Each peer gets its own session keeping a small pool of keep-alive connections.
+    """
+    def __init__(self, call_soon, workers=Config.FANOUT_WORKERS, pool_size=Config.FANOUT_POOL_SIZE, metrics=None):
+        """
+        :param call_soon: thread-safe function scheduling a callback on the worker loop
+        :param workers: maximum number of requests in flight
+        :param pool_size: maximum number of keep-alive connections per peer
+        :param metrics: graph_crdt.metrics.MetricsRegistry the peer request metrics are registered in
+        """
+        self.call_soon = call_soon
+        self.pool_size = pool_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout")
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        metrics = metrics if metrics is not None else MetricsRegistry()
+        self.request_seconds = metrics.histogram("peer_request_seconds", "Duration of the POST requests to peers",
+                                                 ("endpoint", ))
+        self.request_failures = metrics.counter("peer_request_failures_total",
+                                                "POST requests to peers that failed or got an error status",
+                                                ("endpoint", ))
+
+    def session(self, peer):
+        with self.lock:
+            if peer not in self.sessions:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[peer] = session
+
+            return self.sessions[peer]
+
+    def send(self, peer, path, **kwargs):
+        """
+        POST to an endpoint of a peer, recording the request metrics
+        :param peer: peer address
+        :param path: endpoint path, also the label of the metrics
+        :return: requests.Response
+        """
+        started = time.perf_counter()
+        try:
+            response = self.session(peer).post(f"{peer}{path}", **kwargs)
+        except Exception:
+            self.request_failures.labels(path).inc()
+            raise
+        finally:
+            self.request_seconds.labels(path).observe(time.perf_counter() - started)
+
+        if response.status_code >= 400:
+            self.request_failures.labels(path).inc()
+        return response
+
+    def request(self, peer, path, message, timeout):
+        """
+        Send a message over HTTP, runs on the pool. The status endpoint takes a GET, the gossip endpoint a JSON body,
+        a binary merge its payload as the body and the other endpoints form fields.
+        :return: decoded reply
+        :raise requests.HTTPError: if the peer answers with an error status
+        """
+        if path == "/":
+            response = self.session(peer).get(f"{peer}/", timeout=timeout)
+        elif path == "/gossip":
+            response = self.send(peer, path, json=message, timeout=timeout)
+        elif path == "/merge/binary":
+            response = self.send(peer, path, params={"uuid": message["uuid"], "from_addr": message["from_addr"]},
+                                 data=message["payload"], headers={"Content-Type": "application/octet-stream"},
+                                 timeout=timeout)
+        else:
+            response = self.send(peer, path, data=message, timeout=timeout)
+
+        response.raise_for_status()
+        return response.json()
+
+    def post(self, source, destination, path, message, callback, timeout=Config.REQUEST_TIMEOUT):
+        """
+        Network.post over HTTP: the request runs on the pool and the callback on the worker loop. The source is not
+        needed, a gateway only knows its peers by their address.
+        """
+        def done(future):
+            try:
+                reply, error = future.result(), None
+            except Exception as e:
+                reply, error = None, e
+            callback(reply, error)
+
+        self.submit(self.request, destination, path, message, timeout, callback=done)
+
+    def submit(self, func, *args, callback=None):
+        """
+        Run func(*args) on the pool
+        :param callback: called on the worker loop with the finished concurrent.futures.Future
+        :return: future
+        """
+        future = self.executor.submit(func, *args)
+        if callback is not None:
+            future.add_done_callback(lambda done: self.call_soon(partial(callback, done)))
+
+        return future
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions.clear()
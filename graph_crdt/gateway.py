@@ -1,12 +1,27 @@
 import json
+import time
 import uuid
-import socket
+import random
+import base64
+import asyncio
 import uvicorn
 import requests
+from graph_crdt import codec
 from graph_crdt.config import Config
-from fastapi import FastAPI, Form
+from fastapi import FastAPI, Form, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from graph_crdt.utils import get_logger
+from graph_crdt.transport import make_async_client, pack_message
+from graph_crdt.bootstrap import END, frame
+from graph_crdt.dedupe import DedupeCache
+from graph_crdt.scheduler import SyncScheduler
+from graph_crdt.gossip import check_message
+from graph_crdt.graph import CRDTGraph
+from graph_crdt.merkle import check_buckets, check_nodes
+from graph_crdt.router import ShardRouter
+from graph_crdt.shard import shard_addresses
+from graph_crdt.metrics import CONTENT_TYPE, MetricsRegistry, render, with_labels
 
 
 logger = get_logger("Database Instance")
@@ -36,24 +51,99 @@ class DatabaseGateway:
     your_address = None
     friend_address = None
     bidirection = True
-    UDPClientSocket = None
+    gossip = Config.GOSSIP
+    internal_client = None
+    router = None
+    scheduler = None
     socket_internal = None
-    merged_uuid = set()
+    merged_uuid = DedupeCache()
     cluster_table = []
     address_set = set()
+    metrics = MetricsRegistry()
+    rpc_seconds = metrics.histogram("gateway_rpc_seconds", "Time the gateway waits for a worker reply", ("query", ))
+    rpc_failures = metrics.counter("gateway_rpc_failures_total", "Worker requests that timed out or failed",
+                                   ("query", ))
+    dedupe_entries = metrics.gauge("gateway_dedupe_entries", "Merge UUIDs in the dedupe cache")
+    dedupe_hits = metrics.counter("gateway_dedupe_hits_total", "Merges dropped as duplicates", ("filter", ))
+    dedupe_bloom_bytes = metrics.gauge("gateway_dedupe_bloom_bytes", "Memory of the dedupe Bloom filters")
+    sync_rounds = metrics.counter("gateway_sync_rounds_total", "Sync rounds of the scheduler")
+    sync_writes = metrics.counter("gateway_sync_coalesced_writes_total", "Local writes shipped by the sync rounds")
 
     @staticmethod
-    def send_socket(data):
+    async def send_socket(data, timeout=None, attachment=None):
         """
-        Send message from REST gateway to UDP socket worker
+        Send message from REST gateway to the socket worker without blocking the event loop, any number of
+        requests can wait for their replies at once
         :param data: message content as dictionary
-        :return: received message from UDP socket worker
+        :param timeout: seconds to wait for the reply, defaults to Config.RPC_TIMEOUT
+        :param attachment: raw bytes sent along with the message, see graph_crdt.transport.pack_message
+        :return: decoded reply of the socket worker
         """
-        msg = json.dumps(data)
-        msg = str.encode(msg)
-        DatabaseGateway.UDPClientSocket.sendto(msg, DatabaseGateway.socket_internal)
-        rcv_msg = DatabaseGateway.UDPClientSocket.recvfrom(Config.BUFFER_SIZE)
-        return rcv_msg
+        msg = pack_message(data, attachment)
+        started, failed = time.perf_counter(), True
+        try:
+            rcv_msg = await DatabaseGateway.internal_client.request(msg, timeout)
+            failed = False
+        finally:
+            DatabaseGateway.observe_rpc(data["query"], time.perf_counter() - started, failed)
+
+        return DatabaseGateway.decode(rcv_msg)
+
+    @staticmethod
+    def observe_rpc(query, seconds, failed=False):
+        DatabaseGateway.rpc_seconds.labels(query).observe(seconds)
+        if failed:
+            DatabaseGateway.rpc_failures.labels(query).inc()
+
+    @staticmethod
+    async def query(data):
+        """
+        Run a graph query on the worker, or on the shards owning its vertices in a sharded replica
+        :param data: message content as dictionary
+        :return: decoded reply, the same whether the replica is sharded or not
+        """
+        if DatabaseGateway.router is None:
+            return await DatabaseGateway.send_socket(data)
+
+        return await DatabaseGateway.router.query(data)
+
+    @staticmethod
+    async def send_all(data):
+        """
+        Send the same message to every shard worker
+        :return: list of the decoded replies, in shard order
+        """
+        if DatabaseGateway.router is None:
+            return [await DatabaseGateway.send_socket(data)]
+
+        return await DatabaseGateway.router.scatter(data)
+
+    @staticmethod
+    def shard_data(replies):
+        # the worker's own data when there is a single one, a list with one entry per shard otherwise
+        if len(replies) == 1:
+            return replies[0]["data"]
+
+        return [rcv_msg["data"] for rcv_msg in replies]
+
+    @staticmethod
+    def unsharded(feature):
+        if DatabaseGateway.router is None:
+            return None
+
+        return DatabaseGateway.response(False, "", data={}, error_msg=f"{feature} is not supported by sharded replicas")
+
+    @staticmethod
+    @communication_server.exception_handler(asyncio.TimeoutError)
+    async def worker_timeout(request, exc):
+        return JSONResponse(status_code=504, content=DatabaseGateway.response(
+            False, "", error_msg=f"Worker did not answer {request.url.path} in time"))
+
+    @staticmethod
+    @communication_server.exception_handler(ConnectionError)
+    async def worker_unavailable(request, exc):
+        return JSONResponse(status_code=503, content=DatabaseGateway.response(
+            False, "", error_msg=f"Worker is unavailable: {exc}"))
 
     @staticmethod
     def register_cluster_table(address):
@@ -80,7 +170,7 @@ class DatabaseGateway:
             "query": "set_dir",
             "dir": DatabaseGateway.bidirection
         }
-        _ = DatabaseGateway.send_socket(data)
+        _ = await DatabaseGateway.send_all(data)
 
         logger.info("Initialized CRDTGraph database instance!")
         logger.info(f"Communication server listening at {DatabaseGateway.your_address}")
@@ -96,9 +186,80 @@ class DatabaseGateway:
 
             logger.info(f"Register to {DatabaseGateway.friend_address}: {response}")
 
+            if Config.BOOTSTRAP_ON_REGISTER:
+                # the worker pulls the friend's state in the background, each shard keeping the entries it owns
+                _ = await DatabaseGateway.send_all({"query": "bootstrap", "from": DatabaseGateway.friend_address})
+
+        if Config.SYNC_SCHEDULER:
+            DatabaseGateway.scheduler = SyncScheduler(
+                DatabaseGateway.round_peers, DatabaseGateway.sync_peers,
+                interval=Config.GOSSIP_INTERVAL if DatabaseGateway.gossip else Config.SYNC_INTERVAL)
+            asyncio.ensure_future(DatabaseGateway.scheduler.run())
+
+    @staticmethod
+    def round_peers():
+        """
+        :return: Config.GOSSIP_FANOUT random friends in gossip mode, all of them otherwise
+        """
+        if DatabaseGateway.gossip:
+            return random.sample(DatabaseGateway.cluster_table, min(Config.GOSSIP_FANOUT,
+                                                                    len(DatabaseGateway.cluster_table)))
+
+        return list(DatabaseGateway.cluster_table)
+
+    @staticmethod
+    async def sync_peers(peers):
+        """
+        Ship the local changes to some friends, returns once all of them are done
+        :param peers: friend addresses
+        :return:
+        """
+        if not peers:
+            return
+
+        if DatabaseGateway.gossip:
+            # exchange deltas with each of them, see graph_crdt.gossip
+            data = {
+                "query": "gossip_round",
+                "peers": peers,
+                "from_addr": DatabaseGateway.your_address
+            }
+            _ = await DatabaseGateway.send_socket(data)
+            return
+
+        data = {
+            "query": "broadcast",
+            "uuid": str(uuid.uuid4()),
+            "from_addr": DatabaseGateway.your_address
+        }
+        DatabaseGateway.merged_uuid.add(data["uuid"])
+        router = DatabaseGateway.router
+        if router is not None:
+            # every shard ships the entries it owns as a merge of its own
+            for shard in range(len(router)):
+                DatabaseGateway.merged_uuid.add(f"{data['uuid']}-{shard}")
+
+        async def send(friend):
+            # send to other friend new updates, the worker talks to all of them concurrently
+            if router is None:
+                rcv_msg = (await DatabaseGateway.send_socket(dict(data, to=friend)))["status"]
+            else:
+                replies = await asyncio.gather(*[router.request(shard, dict(data, to=friend,
+                                                                            uuid=f"{data['uuid']}-{shard}"))
+                                                 for shard in range(len(router))])
+                rcv_msg = [reply["status"] for reply in replies]
+            logger.info(f"Broadcasted merge request to {friend}: {rcv_msg}")
+
+        await asyncio.gather(*[send(friend) for friend in peers])
+
+    @staticmethod
+    def written(count=1):
+        if DatabaseGateway.scheduler is not None:
+            DatabaseGateway.scheduler.written(count)
+
     @staticmethod
     def execute(host: str = "0.0.0.0", port: int = 8000, your_address=None, friend_address=None, bidirection=True,
-                socket_internal=None):
+                socket_internal=None, transport=None, gossip=None, shards=1):
         """
         Execute REST gateway
         :param host:
@@ -106,13 +267,23 @@ class DatabaseGateway:
         :param your_address:
         :param friend_address:
         :param bidirection:
-        :param socket_internal:
+        :param socket_internal: worker address, (host, port) or a Unix socket path
+        :param transport: "tcp" (framed stream) or "udp", defaults to Config.TRANSPORT
+        :param gossip: replicate through push-pull gossip rounds rather than flooding, defaults to Config.GOSSIP
+        :param shards: number of shard workers, listening at the addresses of graph_crdt.shard.shard_addresses
         :return:
         """
         DatabaseGateway.bidirection = bidirection
+        if gossip is not None:
+            DatabaseGateway.gossip = gossip
+        if shards > 1 and DatabaseGateway.gossip:
+            raise ValueError("Gossip replication is not supported by sharded replicas")
+
         DatabaseGateway.your_address = your_address
         DatabaseGateway.friend_address = friend_address
-        DatabaseGateway.UDPClientSocket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        clients = [make_async_client(address, transport) for address in shard_addresses(socket_internal, shards)]
+        DatabaseGateway.internal_client = clients[0]
+        DatabaseGateway.router = ShardRouter(clients, DatabaseGateway.observe_rpc) if shards > 1 else None
         DatabaseGateway.socket_internal = socket_internal
 
         while host[-1] == "/":
@@ -141,7 +312,8 @@ class DatabaseGateway:
     @communication_server.get("/")
     async def status():
         return {
-            "message": "OK!"
+            "message": "OK!",
+            "encodings": [codec.ENCODING, codec.JSON_ENCODING]
         }
 
     @staticmethod
@@ -170,7 +342,7 @@ class DatabaseGateway:
                     "data": their_address
                 }
 
-                rcv_msg = DatabaseGateway.send_socket(data)
+                rcv_msg = await DatabaseGateway.send_socket(data)
                 logger.info(f"Received message: {rcv_msg}")
 
         logger.info(f"Successfully registered and broadcasted: {their_address}")
@@ -189,9 +361,10 @@ class DatabaseGateway:
             "u": u
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status, _ = rcv_msg["status"], rcv_msg["_"]
+        if status:
+            DatabaseGateway.written()
 
         return DatabaseGateway.response(status, f"Successfully added vertex {u}", error_msg=_)
 
@@ -204,9 +377,10 @@ class DatabaseGateway:
             "v": v
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status, _ = rcv_msg["status"], rcv_msg["_"]
+        if status:
+            DatabaseGateway.written()
 
         return DatabaseGateway.response(status, f"Successfully added edge {u}-{v}", error_msg=_)
 
@@ -218,9 +392,10 @@ class DatabaseGateway:
             "u": u
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status = rcv_msg["status"]
+        if status:
+            DatabaseGateway.written()
 
         return DatabaseGateway.response(status, f"Successfully removed vertex {u}")
 
@@ -233,12 +408,47 @@ class DatabaseGateway:
             "v": v
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status = rcv_msg["status"]
+        if status:
+            DatabaseGateway.written()
 
         return DatabaseGateway.response(status, f"Successfully removed edge {u}-{v}")
 
+    @staticmethod
+    def valid_operation(operation):
+        return isinstance(operation, list) and len(operation) > 0 and isinstance(operation[0], str) and \
+            all(isinstance(arg, int) and not isinstance(arg, bool) for arg in operation[1:])
+
+    @staticmethod
+    @communication_server.post("/batch")
+    async def batch(request: Request):
+        """
+        Apply many add/remove operations in one request
+        :param request: JSON list of operations, [name, u] or [name, u, v] with name one of add_vertex, add_edge,
+                        remove_vertex, remove_edge
+        :return: list of [status, message], one per operation
+        """
+        try:
+            operations = await request.json()
+        except ValueError as e:
+            return DatabaseGateway.response(False, "", data=[], error_msg=f"Invalid batch: {e}")
+
+        if not isinstance(operations, list) or not all(DatabaseGateway.valid_operation(op) for op in operations):
+            return DatabaseGateway.response(False, "", data=[],
+                                            error_msg="A batch must be a list of [name, vertex ids...] operations")
+
+        data = {
+            "query": "batch",
+            "operations": operations
+        }
+
+        rcv_msg = await DatabaseGateway.query(data)
+        DatabaseGateway.written(sum(1 for status, _ in rcv_msg["data"] if status))
+
+        return DatabaseGateway.response("Success", data=rcv_msg["data"],
+                                        success_msg=f"Successfully applied {len(operations)} operations")
+
     @staticmethod
     @communication_server.get("/check_exists/{u}")
     async def exists_vertex(u: int):
@@ -247,8 +457,7 @@ class DatabaseGateway:
             "u": u
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status, _ = rcv_msg["status"], rcv_msg["_"]
 
         return DatabaseGateway.response(_, data=status, success_msg=f"check_exists {u}: {status}")
@@ -262,8 +471,7 @@ class DatabaseGateway:
             "v": v
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status, _ = rcv_msg["status"], rcv_msg["_"]
 
         return DatabaseGateway.response(_, data=status, success_msg=f"check_exists {u}-{v}: {status}")
@@ -276,23 +484,22 @@ class DatabaseGateway:
             "u": u
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status, _ = rcv_msg["status"], rcv_msg["_"]
 
         return DatabaseGateway.response(_, data=status, success_msg=f"Successfully get neighbors of {status}")
 
     @staticmethod
     @communication_server.get("/find_path/{u}/{v}")
-    async def find_path(u: int, v: int):
+    async def find_path(u: int, v: int, max_hops: int = None):
         data = {
             "query": "find_path",
             "u": u,
-            "v": v
+            "v": v,
+            "max_hops": max_hops
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status, path = rcv_msg["status"], rcv_msg["path"]
 
         return DatabaseGateway.response(status, data=path,
@@ -302,24 +509,263 @@ class DatabaseGateway:
     @staticmethod
     @communication_server.get("/broadcast")
     async def broadcast():
-        uid = str(uuid.uuid4())
+        """
+        Sync with the friends right away, the scheduler does it in the background anyway
+        :return: friends synced with
+        """
+        if DatabaseGateway.scheduler is not None:
+            # goes through the scheduler, so that it never overlaps with a background sync to the same friend
+            peers = await DatabaseGateway.scheduler.round()
+        else:
+            peers = DatabaseGateway.round_peers()
+            await DatabaseGateway.sync_peers(peers)
+
+        return DatabaseGateway.response("Success", data=peers, success_msg=f"Successfully synced with {peers}")
+
+    @staticmethod
+    @communication_server.get("/sync/stats")
+    async def sync_stats():
+        stats = DatabaseGateway.scheduler.stats() if DatabaseGateway.scheduler is not None else {}
+        return DatabaseGateway.response("Success", data=stats, success_msg="Successfully returned sync statistics")
+
+    @staticmethod
+    @communication_server.get("/bootstrap")
+    async def bootstrap():
+        """
+        Stream the current LWW state in chunks to a newly registered replica, see graph_crdt.bootstrap
+        :return:
+        """
+        # one session per shard, streamed one after the other
+        sessions = await DatabaseGateway.send_all({"query": "bootstrap_open"})
+        total = sum(rcv_msg["total"] for rcv_msg in sessions)
+
+        async def request(shard, data):
+            if DatabaseGateway.router is None:
+                return await DatabaseGateway.send_socket(data)
+
+            return await DatabaseGateway.router.request(shard, data)
+
+        async def chunks():
+            for shard, opened in enumerate(sessions):
+                session = opened["session"]
+                while True:
+                    rcv_msg = await request(shard, {"query": "bootstrap_chunk", "session": session})
+                    if rcv_msg["status"] != ResponseStatus.success:
+                        raise ConnectionError(f"Bootstrap session {session} failed")
+
+                    yield frame(base64.b64decode(rcv_msg["payload"]))
+                    if rcv_msg["done"]:
+                        break
+            yield END
+
+        logger.info(f"Streaming {total} entries with bootstrap sessions {[opened['session'] for opened in sessions]}")
+        return StreamingResponse(chunks(), media_type="application/octet-stream",
+                                 headers={"X-Bootstrap-Entries": str(total)})
+
+    @staticmethod
+    @communication_server.get("/anti_entropy")
+    async def anti_entropy():
+        error = DatabaseGateway.unsharded("Anti-entropy")
+        if error is not None:
+            return error
+
+        stats = dict()
+        for friend in DatabaseGateway.cluster_table:
+            data = {
+                "query": "anti_entropy",
+                "to": friend
+            }
+
+            rcv_msg = await DatabaseGateway.send_socket(data)
+            stats[friend] = rcv_msg["data"]
+
+            logger.info(f"Anti-entropy with {friend}: {rcv_msg['status']}")
+
+        return DatabaseGateway.response("Success", data=stats, success_msg="Successfully synchronized digests")
+
+    @staticmethod
+    @communication_server.get("/gc")
+    async def gc():
+        """
+        Drop the tombstones all known replicas have acknowledged, see CRDTGraph.collect_garbage
+        :return:
+        """
         data = {
-            "query": "broadcast",
-            "uuid": uid,
-            "from_addr": DatabaseGateway.your_address
+            "query": "gc",
+            "peers": DatabaseGateway.cluster_table
         }
-        DatabaseGateway.merged_uuid.add(data["uuid"])
 
-        for friend in DatabaseGateway.cluster_table:
-            # send to other friend new updates
-            data["to"] = friend
-            rcv_msg = DatabaseGateway.send_socket(data)
-            rcv_msg = DatabaseGateway.decode(rcv_msg[0])["status"]
+        replies = await DatabaseGateway.send_all(data)
+        stats = {key: sum(rcv_msg["data"][key] for rcv_msg in replies) for key in replies[0]["data"]}
 
-            logger.info(f"Broadcasted merge request to {friend}: {rcv_msg}")
+        return DatabaseGateway.response(all(rcv_msg["status"] for rcv_msg in replies), data=stats,
+                                        success_msg="Successfully collected garbage")
+
+    @staticmethod
+    @communication_server.post("/gossip")
+    async def gossip_exchange(request: Request):
+        """
+        Merge the delta of a gossiping friend and answer with ours, see graph_crdt.gossip
+        :param request: JSON body with from_addr, sequence, ack and the encoded tables
+        :return:
+        """
+        error = DatabaseGateway.unsharded("Gossip")
+        if error is not None:
+            return error
+
+        try:
+            data = await request.json()
+            check_message(data)
+            data["query"] = "gossip"
+        except ValueError as e:
+            return DatabaseGateway.response(False, "", data={}, error_msg=f"Invalid gossip message: {e}")
+
+        rcv_msg = await DatabaseGateway.send_socket(data)
+
+        return DatabaseGateway.response(rcv_msg["status"] == ResponseStatus.success, data=rcv_msg["data"],
+                                        success_msg=f"Successfully gossiped with {data['from_addr']}",
+                                        error_msg=f"Could not merge the gossip of {data['from_addr']}")
+
+    @staticmethod
+    @communication_server.get("/cache/stats")
+    async def cache_stats():
+        replies = await DatabaseGateway.send_all({"query": "read_cache_stats"})
 
-        return DatabaseGateway.response("Success", data=data,
-                                        success_msg=f"Successfully broadcast with uuid: {uid}")
+        return DatabaseGateway.response("Success", data=DatabaseGateway.shard_data(replies),
+                                        success_msg="Successfully returned read cache statistics")
+
+    @staticmethod
+    @communication_server.get("/gossip/stats")
+    async def gossip_stats():
+        replies = await DatabaseGateway.send_all({"query": "gossip_stats"})
+
+        return DatabaseGateway.response("Success", data=DatabaseGateway.shard_data(replies),
+                                        success_msg="Successfully returned gossip statistics")
+
+    @staticmethod
+    @communication_server.post("/digest")
+    async def digest(level: int = Form(...),
+                     nodes: str = Form(...)):
+        """
+        Return the Merkle hashes of some nodes at a tree level so a peer can find out which buckets differ
+        :param level: tree level, 0 is the root
+        :param nodes: JSON list of node indices within the level
+        :return:
+        """
+        error = DatabaseGateway.unsharded("Anti-entropy")
+        if error is not None:
+            return error
+
+        try:
+            nodes = json.loads(nodes)
+            check_nodes(level, nodes)
+        except ValueError as e:
+            return DatabaseGateway.response(False, "", data="[]", error_msg=str(e))
+
+        data = {
+            "query": "digest",
+            "level": level,
+            "nodes": nodes
+        }
+
+        rcv_msg = await DatabaseGateway.send_socket(data)
+
+        return DatabaseGateway.response("Success", data=rcv_msg["data"],
+                                        success_msg=f"Returned digest at level {level}")
+
+    @staticmethod
+    @communication_server.post("/digest/entries")
+    async def digest_entries(buckets=Form(...),
+                             vertices_added=Form(...),
+                             vertices_removed=Form(...),
+                             edges_added=Form(...),
+                             edges_removed=Form(...)):
+        """
+        Exchange the entries of differing buckets: merge the peer's entries and return ours
+        :param buckets: JSON list of leaf bucket indices
+        :return:
+        """
+        error = DatabaseGateway.unsharded("Anti-entropy")
+        if error is not None:
+            return error
+
+        try:
+            buckets = json.loads(buckets)
+            check_buckets(buckets)
+            CRDTGraph.deserialize(vertices_added, vertices_removed, edges_added, edges_removed)
+        except ValueError as e:
+            return DatabaseGateway.response(False, "", data={}, error_msg=str(e))
+
+        data = {
+            "query": "digest_entries",
+            "buckets": buckets,
+            "vertices_added": vertices_added,
+            "vertices_removed": vertices_removed,
+            "edges_added": edges_added,
+            "edges_removed": edges_removed
+        }
+
+        rcv_msg = await DatabaseGateway.send_socket(data)
+
+        return DatabaseGateway.response(rcv_msg["status"] == ResponseStatus.success, data=rcv_msg["data"],
+                                        success_msg="Exchanged bucket entries", error_msg="Could not merge the entries")
+
+    @staticmethod
+    @communication_server.get("/dedupe")
+    async def dedupe():
+        return DatabaseGateway.response("Success", data=DatabaseGateway.merged_uuid.stats(),
+                                        success_msg="Successfully returned merge dedupe statistics")
+
+    @staticmethod
+    async def send_merge(data, payload=None):
+        """
+        Hand a merge over to the worker, or split its tables between the shards owning their entries
+        :param data: merge message, with the JSON tables unless payload is given
+        :param payload: tables in the binary wire format, see graph_crdt.codec
+        :return: decoded reply
+        """
+        if DatabaseGateway.router is None:
+            return await DatabaseGateway.send_socket(data, attachment=payload)
+
+        # a sharded replica does not flood, see README
+        if payload is not None:
+            tables = codec.decode(payload)
+        else:
+            tables = CRDTGraph.deserialize(*[data[table] for table in codec.TABLES])
+        data = {key: value for key, value in data.items() if key not in codec.TABLES}
+        return await DatabaseGateway.router.merge(dict(data, friend_list=[]), tables)
+
+    @staticmethod
+    @communication_server.get("/list_nodes")
+    async def list_nodes():
+        rcv_msg = await DatabaseGateway.query({"query": "list_nodes"})
+
+        return DatabaseGateway.response("Success", data=rcv_msg["data"],
+                                        success_msg=f"Successfully listed {len(rcv_msg['data'])} vertices")
+
+    @staticmethod
+    @communication_server.get("/metrics")
+    async def metrics_text():
+        """
+        Metrics of the gateway and its workers in the Prometheus text format, see graph_crdt.metrics
+        :return:
+        """
+        dedupe = DatabaseGateway.merged_uuid.stats()
+        DatabaseGateway.dedupe_entries.set(dedupe["size"])
+        DatabaseGateway.dedupe_hits.labels("lru").set(dedupe["hits"])
+        DatabaseGateway.dedupe_hits.labels("bloom").set(dedupe["bloom_hits"])
+        DatabaseGateway.dedupe_bloom_bytes.set(dedupe["bloom_bytes"])
+        if DatabaseGateway.scheduler is not None:
+            sync = DatabaseGateway.scheduler.stats()
+            DatabaseGateway.sync_rounds.set(sync["rounds"])
+            DatabaseGateway.sync_writes.set(sync["coalesced_writes"])
+
+        families = DatabaseGateway.metrics.collect()
+        replies = await DatabaseGateway.send_all({"query": "metrics"})
+        for shard, rcv_msg in enumerate(replies):
+            families.extend(with_labels(rcv_msg["data"], shard=str(shard)) if len(replies) > 1 else rcv_msg["data"])
+
+        return PlainTextResponse(render(families), media_type=CONTENT_TYPE)
 
     @staticmethod
     @communication_server.get("/get_friend")
@@ -334,9 +780,10 @@ class DatabaseGateway:
             "query": "clear"
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])
+        rcv_msg = await DatabaseGateway.query(data)
         status = rcv_msg["data"]
+        if status:
+            DatabaseGateway.written()
 
         return DatabaseGateway.response(status, data=status, success_msg="Successfully clear database")
 
@@ -348,6 +795,11 @@ class DatabaseGateway:
                     vertices_removed=Form(...),
                     edges_added=Form(...),
                     edges_removed=Form(...)):
+        try:
+            CRDTGraph.deserialize(vertices_added, vertices_removed, edges_added, edges_removed)
+        except ValueError as e:
+            return DatabaseGateway.response(False, "", data="[]", error_msg=str(e))
+
         if uuid in DatabaseGateway.merged_uuid:
             return DatabaseGateway.response("Success", data="[]",
                                             success_msg=f"This uuid {uuid} has already been merged")
@@ -362,11 +814,47 @@ class DatabaseGateway:
             "vertices_removed": vertices_removed,
             "edges_added": edges_added,
             "edges_removed": edges_removed,
-            "friend_list": DatabaseGateway.cluster_table
+            "friend_list": [] if DatabaseGateway.gossip else DatabaseGateway.cluster_table
+        }
+
+        rcv_msg = await DatabaseGateway.send_merge(data)
+        logger.info(f"Received message: {rcv_msg['data']}")
+
+        return DatabaseGateway.response(rcv_msg.get("status") != ResponseStatus.error, data="True",
+                                        success_msg="Successfully merged!", error_msg=rcv_msg["data"])
+
+    @staticmethod
+    @communication_server.post("/merge/binary")
+    async def merge_binary(request: Request, uuid: str, from_addr: str):
+        """
+        Merge LWW tables sent in the binary wire format (see graph_crdt.codec) as the request body
+        :param request:
+        :param uuid:
+        :param from_addr:
+        :return:
+        """
+        payload = await request.body()
+        try:
+            codec.check(payload)
+        except ValueError as e:
+            return DatabaseGateway.response(False, "", data="[]", error_msg=str(e))
+
+        if uuid in DatabaseGateway.merged_uuid:
+            return DatabaseGateway.response("Success", data="[]",
+                                            success_msg=f"This uuid {uuid} has already been merged")
+
+        DatabaseGateway.merged_uuid.add(uuid)
+        data = {
+            "your_address": DatabaseGateway.your_address,
+            "from_addr": from_addr,
+            "query": "merge",
+            "uuid": uuid,
+            "friend_list": [] if DatabaseGateway.gossip else DatabaseGateway.cluster_table
         }
 
-        rcv_msg = DatabaseGateway.send_socket(data)
-        rcv_msg = DatabaseGateway.decode(rcv_msg[0])["data"]
-        logger.info(f"Received message: {rcv_msg}")
+        # the payload goes to the worker as it is, after the JSON of the message
+        rcv_msg = await DatabaseGateway.send_merge(data, payload)
+        logger.info(f"Received message: {rcv_msg['data']}")
 
-        return DatabaseGateway.response("Success", data="True", success_msg="Successfully merged!")
+        return DatabaseGateway.response(rcv_msg.get("status") != ResponseStatus.error, data="True",
+                                        success_msg="Successfully merged!", error_msg=rcv_msg["data"])
@@ -0,0 +1,143 @@
+"""
+Push-pull gossip between replicas, an alternative to flooding every merge to the whole cluster. Every
+Config.GOSSIP_INTERVAL seconds a gateway picks Config.GOSSIP_FANOUT random friends and its worker exchanges deltas
+with each of them in one round trip:
+
+    request := {from_addr, sequence, ack, delta of the sender for the receiver}
+    reply   := {sequence, ack, delta of the receiver for the sender}
+
+sequence is the change number of the sender the delta goes up to, and ack the sequence of the last delta received
+from the other side and merged. Acknowledgements thus travel with the next exchange, in either direction, and keep
+the per-peer deltas of graph_crdt.delta as small as with broadcasts. An update reaches all N replicas within
+O(log N) rounds with about fan-out messages per replica and round, instead of O(N^2) messages per update.
+"""
+import time
+import base64
+import struct
+from contextlib import contextmanager
+from graph_crdt import codec
+from graph_crdt.graph import CRDTGraph
+
+
+def encode_tables(tables):
+    """
+    :param tables: vertices_added, vertices_removed, edges_added, edges_removed
+    :return: message fields, the binary format in base64 or JSON tables for ids outside of the int64 range
+    """
+    try:
+        return {
+            "encoding": codec.ENCODING,
+            "payload": base64.b64encode(codec.encode(*tables)).decode()
+        }
+    except struct.error:
+        return dict(CRDTGraph.serialize(*tables), encoding=codec.JSON_ENCODING)
+
+
+def payload_size(message):
+    return sum(len(message[field]) for field in ("payload", ) + codec.TABLES if field in message)
+
+
+def decode_tables(message):
+    if message.get("encoding", codec.JSON_ENCODING) == codec.ENCODING:
+        return codec.decode(base64.b64decode(message["payload"], validate=True))
+
+    return CRDTGraph.deserialize(*[message[table] for table in codec.TABLES])
+
+
+def check_message(message, payload=True):
+    """
+    Validate a gossip request before it reaches the worker
+    :param message: decoded JSON body
+    :param payload: whether to also walk the binary payload, see graph_crdt.codec.check
+    :return: None
+    :raise ValueError: if a field is missing or malformed
+    """
+    if not isinstance(message, dict):
+        raise ValueError("A gossip message must be a JSON object")
+    if not isinstance(message.get("from_addr"), str):
+        raise ValueError("Missing from_addr")
+    if not isinstance(message.get("sequence"), int) or not isinstance(message.get("ack", 0), (int, type(None))):
+        raise ValueError("sequence and ack must be change numbers")
+    if "ack" not in message:
+        raise ValueError("Missing ack")
+
+    encoding = message.get("encoding", codec.JSON_ENCODING)
+    if encoding == codec.ENCODING:
+        if not isinstance(message.get("payload"), str):
+            raise ValueError("Missing payload")
+        if payload:
+            codec.check(base64.b64decode(message["payload"], validate=True))
+    elif encoding == codec.JSON_ENCODING:
+        if not all(isinstance(message.get(table), str) for table in codec.TABLES):
+            raise ValueError(f"Missing one of the tables {', '.join(codec.TABLES)}")
+    else:
+        raise ValueError(f"Unsupported encoding {encoding}")
+
+
+class GossipMetrics:
+    """
+    Message counts of the gossip exchanges, and the propagation delay of the entries learned through them: the time
+    from the write on its origin replica, the entry timestamp, to its arrival here
+    """
+    def __init__(self):
+        self.rounds = 0
+        self.exchanges = 0
+        self.failures = 0
+        self.messages_sent = 0
+        self.messages_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.entries_received = 0
+        self.delay_total = 0.0
+        self.delay_max = 0.0
+        self.recording = False
+
+    def track(self, database):
+        database.vertices.observers.append(self.observe)
+        database.edges.observers.append(self.observe)
+
+    def observe(self, table, changes):
+        """
+        LWWSet observer, only counts the changes made while merging a gossip delta
+        :return:
+        """
+        if not self.recording:
+            return
+
+        now = time.time()
+        for _, _, new_timestamp in changes:
+            if new_timestamp is not None:
+                delay = max(0.0, now - new_timestamp)
+                self.entries_received = self.entries_received + 1
+                self.delay_total = self.delay_total + delay
+                self.delay_max = max(self.delay_max, delay)
+
+    @contextmanager
+    def merging(self):
+        self.recording = True
+        try:
+            yield
+        finally:
+            self.recording = False
+
+    def sent(self, size):
+        self.messages_sent = self.messages_sent + 1
+        self.bytes_sent = self.bytes_sent + size
+
+    def received(self, size):
+        self.messages_received = self.messages_received + 1
+        self.bytes_received = self.bytes_received + size
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "exchanges": self.exchanges,
+            "failures": self.failures,
+            "messages_sent": self.messages_sent,
+            "messages_received": self.messages_received,
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "entries_received": self.entries_received,
+            "propagation_delay_avg": self.delay_total / self.entries_received if self.entries_received else 0.0,
+            "propagation_delay_max": self.delay_max
+        }
@@ -1,20 +1,80 @@
 import json
+import math
+from . import codec
 from .lww import LWWSet
+from .lock import ReadWriteLock, reading, writing
+from .delta import DeltaTracker
+from .merkle import MerkleTree
+from .config import Config
+from .adjacency import AdjacencyIndex, CompactAdjacencyIndex
+from .path import bidirectional_bfs
 from .utils import get_logger
 
 logger = get_logger("Graph")
 
 
 class CRDTGraph:
-    def __init__(self, bidirection=True):
-        self.vertices = LWWSet()
-        self.edges = LWWSet()
+    """
+    Reads only resolve the LWW sets and never change them, so they run under the shared side of a readers-writer
+    lock and many threads can serve them at once. Writes, merges and compaction passes hold it alone.
+    """
+    def __init__(self, bidirection=True, storage="dict", partition=None):
+        """
+        :param bidirection: whether edges are undirected
+        :param storage: LWW set storage, "dict" or "array", which also keeps the adjacency index in int64 arrays
+        :param partition: graph_crdt.shard.Partition of a sharded replica, None if this graph holds everything
+        """
+        self.partition = partition
+        self.lock = ReadWriteLock()
+        self.vertices = LWWSet("vertices", storage=storage)
+        self.edges = LWWSet("edges", storage=storage, edge_keys=True)
+        self.delta_tracker = DeltaTracker()
+        self.vertices.observers.append(self.delta_tracker.record)
+        self.edges.observers.append(self.delta_tracker.record)
+        self.merkle = MerkleTree()
+        self.merkle.track(self.vertices)
+        self.merkle.track(self.edges)
+        self.version = 0
+        self.vertices.observers.append(self.changed)
+        self.edges.observers.append(self.changed)
         self.cluster_table = []
         self.address_set = set()
         self.bidirection = bidirection
-
+        self.adjacency_index = CompactAdjacencyIndex if storage == "array" else AdjacencyIndex
+        self.adjacency = self.adjacency_index(bidirection)
+
+    def changed(self, table, changes):
+        """
+        LWWSet observer: move to a new version whenever an entry is written, freeing a dominated entry or a collected
+        tombstone does not change any query result
+        :return:
+        """
+        if any(new_timestamp is not None for _, _, new_timestamp in changes):
+            self.version = self.version + 1
+
+    @writing
     def set_dir(self, dir):
         self.bidirection = dir
+        self.version = self.version + 1
+        self.rebuild_adjacency()
+
+    def rebuild_adjacency(self):
+        self.adjacency = self.adjacency_index(self.bidirection)
+        for u, v in list(self.edges.added.keys()):
+            self.refresh_edge(u, v)
+
+    def refresh_edge(self, u, v):
+        """
+        Re-resolve the LWW state of an edge and reflect it in the adjacency index
+        :param u:
+        :param v:
+        :return:
+        """
+        u, v = self.convert_edge(u, v)
+        if self.edges.exists(self.convert_edge(u, v)):
+            self.adjacency.add(u, v)
+        else:
+            self.adjacency.discard(u, v)
 
     def get_cluster_table(self):
         return self.cluster_table
@@ -35,154 +95,146 @@ class CRDTGraph:
 
         return u, v
 
+    @reading
     def list_nodes(self):
         nodes = list()
         for node in list(self.vertices.added.keys()):
-            if self.contains_vertex(node)[1]:
+            if self.vertices.exists(node):
                 nodes.append(node)
 
         return nodes
 
-    def get_neighbors(self, u):
-        try:
-            neighbors = list()
-            if self.contains_vertex(u)[1] is False:
-                return False, neighbors
+    def owns(self, u):
+        return self.partition is None or self.partition.owns(u)
 
-            for node in list(self.vertices.added.keys()):
-                if node == u:
-                    continue
+    def live_neighbors(self, u, nodes):
+        # the owner shard of a vertex checks it is alive
+        return [node for node in nodes if node != u and (not self.owns(node) or self.vertices.exists(node))]
 
-                if self.contains_vertex(node)[1]:
-                    _u, _node = u, node
-                    u, node = self.convert_edge(u, node)
-                    if self.contains_edge(u, node)[1]:
-                        neighbors.append(_node)
+    @reading
+    def get_neighbors(self, u):
+        try:
+            if not self.vertices.exists(u):
+                return False, []
 
-            return True, sorted(neighbors)
+            return True, sorted(self.live_neighbors(u, self.adjacency.neighbors(u)))
         except Exception as e:
             logger.exception(e)
             return False, []
 
-    def add_vertex(self, u):
-        if self.contains_vertex(u)[1]:
+    @writing
+    def add_vertex(self, u, timestamp=None):
+        if self.vertices.exists(u):
             return False, "Duplicated"
 
-        return self.vertices.add(u), ""
+        return self.vertices.add(u, timestamp), ""
 
-    def add_edge(self, u, v):
-        # check if u and v exists
-        if self.contains_vertex(u)[1] is False or self.contains_vertex(v)[1] is False:
+    @writing
+    def add_edge(self, u, v, timestamp=None):
+        # check if u and v exists, the gateway checks the vertices owned by other shards
+        if (self.owns(u) and not self.vertices.exists(u)) or \
+                (self.owns(v) and not self.vertices.exists(v)):
             return False, f"Not valid vertex ({u} - {v})"
 
-        if self.contains_edge(u, v)[1]:
+        if self.edges.exists(self.convert_edge(u, v)):
             return False, "Duplicated"
 
         u, v = self.convert_edge(u, v)
-        self.edges.add((u, v))
+        if self.edges.add((u, v), timestamp) is False:
+            return False, f"Not valid edge ({u} - {v})"
+
+        # an add older than the tombstone of the edge does not make it live
+        self.refresh_edge(u, v)
         return True, ""
 
-    def remove_vertex(self, u):
-        if self.contains_vertex(u)[1] is False:
+    @writing
+    def remove_vertex(self, u, timestamp=None):
+        if not self.vertices.exists(u):
             return False
 
-        self.vertices.remove(u)
+        self.vertices.remove(u, timestamp)
 
         # remove all connected edges of u
-        for node in list(self.vertices.added.keys()):
-            if self.contains_vertex(node)[1]:
-                u, node = self.convert_edge(u, node)
-                if self.contains_edge(u, node)[1]:
-                    self.remove_edge(u, node)
+        for node in list(self.adjacency.neighbors(u)):
+            self.remove_edge(u, node, timestamp)
 
         return True
 
-    def remove_edge(self, u, v):
+    @writing
+    def remove_edge(self, u, v, timestamp=None):
         u, v = self.convert_edge(u, v)
-        return self.edges.remove((u, v))
+        status = self.edges.remove((u, v), timestamp)
+        self.refresh_edge(u, v)
+        return status
 
+    @reading
     def contains_vertex(self, u):
-        added_timestamp, removed_timestamp = None, None
-        if u in self.vertices.added:
-            added_timestamp = self.vertices.added[u]
-
-        if u in self.vertices.removed:
-            removed_timestamp = self.vertices.removed[u]
-
-        if added_timestamp is None:
-            return True, False
-
-        if removed_timestamp is None:
-            return True, True
-
-        if added_timestamp >= removed_timestamp:
-            self.vertices.free_removed(u)
-            return True, True
-        else:
-            self.vertices.free_added(u)
-            return True, False
+        return True, self.vertices.exists(u)
 
+    @reading
     def contains_edge(self, u, v):
-        u, v = self.convert_edge(u, v)
-        added_timestamp, removed_timestamp = None, None
-
-        if (u, v) in self.edges.added:
-            added_timestamp = self.edges.added[(u, v)]
-
-        if (u, v) in self.edges.removed:
-            removed_timestamp = self.edges.removed[(u, v)]
-
-        if added_timestamp is None:
-            return True, False
-
-        if removed_timestamp is None:
-            return True, True
-
-        if added_timestamp >= removed_timestamp:
-            self.edges.free_removed((u, v))
-            return True, True
-        else:
-            self.edges.free_added((u, v))
-            return True, False
-
-    def find_path(self, source, target):
-        # Breath-first search for the shortest path between u and v
+        return True, self.edges.exists(self.convert_edge(u, v))
+
+    @writing
+    def batch(self, operations):
+        """
+        Apply many mutations in one pass
+        :param operations: list of [name, u] or [name, u, v] with name one of add_vertex, add_edge, remove_vertex,
+                           remove_edge
+        :return: list of [status, message], one per operation
+        """
+        # exact arity, the timestamp parameter of the write methods is not for clients
+        apply = {
+            "add_vertex": (1, self.add_vertex),
+            "add_edge": (2, self.add_edge),
+            "remove_vertex": (1, lambda u: (self.remove_vertex(u), "")),
+            "remove_edge": (2, lambda u, v: (self.remove_edge(u, v), ""))
+        }
 
+        results = list()
+        for operation in operations:
+            if not isinstance(operation, list) or not operation or not isinstance(operation[0], str):
+                results.append([False, f"Invalid operation {operation}"])
+                continue
+
+            name, args = operation[0], operation[1:]
+            if name not in apply:
+                results.append([False, f"Unknown operation {name}"])
+                continue
+
+            arity, func = apply[name]
+            if len(args) != arity:
+                results.append([False, f"Invalid operation {operation}: {name} takes {arity} vertex ids"])
+                continue
+
+            try:
+                status, message = func(*map(int, args))
+            except (TypeError, ValueError) as e:
+                status, message = False, f"Invalid operation {operation}: {e}"
+            results.append([status, message])
+
+        return results
+
+    @reading
+    def find_path(self, source, target, max_hops=None):
+        # Bidirectional breath-first search for the shortest path between u and v
         try:
-            q = [source]
-            head = 0
-            visited, trace = set(), dict()
-            trace[source] = source
-
-            while q.__len__() - head > 0:
-                u = q[head]
-                head = head + 1
-                visited.add(u)
-
-                if u == target:
-                    break
-
-                logger.debug(self.get_neighbors(u)[1])
-                for v in self.get_neighbors(u)[1]:
-                    if v in visited:
-                        continue
-
-                    trace[v] = u
-                    q.append(v)
+            if not self.vertices.exists(source) or not self.vertices.exists(target):
+                return False, []
 
-            if target not in visited:
+            path = bidirectional_bfs(source, target,
+                                     lambda u: self.live_neighbors(u, self.adjacency.neighbors(u)),
+                                     lambda u: self.live_neighbors(u, self.adjacency.reverse_neighbors(u)),
+                                     max_hops=max_hops)
+            if path is None:
                 return False, []
 
-            path = list()
-            while trace[target] != target:
-                path.append(target)
-                target = trace[target]
-            path.append(source)
-            return True, path[:: - 1]
+            return True, path
         except Exception as e:
             logger.exception(e)
             return False, []
 
+    @writing
     def clear(self):
         try:
             for node in self.list_nodes():
@@ -192,53 +244,252 @@ class CRDTGraph:
             logger.exception(e)
             return False
 
-    def broadcast(self):
+    @staticmethod
+    def serialize(vertices_added, vertices_removed, edges_added, edges_removed):
         return {
-            "vertices_added": json.dumps(self.vertices.added),
-            "vertices_removed": json.dumps(self.vertices.removed),
-            "edges_added": json.dumps({f"{k[0]}_{k[1]}": v for k, v in self.edges.added.items()}),
-            "edges_removed": json.dumps({f"{k[0]}_{k[1]}": v for k, v in self.edges.removed.items()})
+            "vertices_added": json.dumps(dict(vertices_added.items())),
+            "vertices_removed": json.dumps(dict(vertices_removed.items())),
+            "edges_added": json.dumps({f"{k[0]}_{k[1]}": v for k, v in edges_added.items()}),
+            "edges_removed": json.dumps({f"{k[0]}_{k[1]}": v for k, v in edges_removed.items()})
+        }
+
+    @staticmethod
+    def deserialize(vertices_added, vertices_removed, edges_added, edges_removed):
+        """
+        Parse the JSON tables produced by serialize back into vertex ids and (u, v) edge keys
+        :return: vertices_added, vertices_removed, edges_added, edges_removed
+        :raise ValueError: if a table is not a JSON object of integer ids, or u_v edges, to finite timestamps
+        """
+        def parse(table):
+            if not isinstance(table, (str, bytes)):
+                raise ValueError("A table must be a JSON string")
+            entries = json.loads(table)
+            if not isinstance(entries, dict):
+                raise ValueError("A table must be a JSON object")
+            try:
+                valid = set(map(type, entries.values())) <= {int, float} and all(map(math.isfinite, entries.values()))
+            except OverflowError:
+                valid = False
+            if not valid:
+                raise ValueError("Timestamps must be finite numbers")
+            return entries
+
+        def parse_edges(table):
+            edges = dict()
+            for k, z in parse(table).items():
+                u, _, v = k.partition("_")
+                edges[(int(u), int(v))] = z
+            return edges
+
+        return {int(k): v for k, v in parse(vertices_added).items()}, \
+            {int(k): v for k, v in parse(vertices_removed).items()}, \
+            parse_edges(edges_added), parse_edges(edges_removed)
+
+    @staticmethod
+    def encode(tables, encoding=codec.JSON_ENCODING):
+        """
+        Encode LWW tables for the wire
+        :param tables: vertices_added, vertices_removed, edges_added, edges_removed
+        :param encoding: codec.ENCODING for the binary format, codec.JSON_ENCODING for JSON form fields
+        :return: bytes for the binary format, dictionary of form fields for JSON
+        """
+        if encoding == codec.ENCODING:
+            return codec.encode(*tables)
+
+        return CRDTGraph.serialize(*tables)
+
+    def state(self):
+        return self.vertices.added, self.vertices.removed, self.edges.added, self.edges.removed
+
+    @reading
+    def broadcast(self):
+        return self.serialize(*self.state())
+
+    def size(self):
+        return len(self.vertices.added) + len(self.vertices.removed) + len(self.edges.added) + \
+            len(self.edges.removed)
+
+    @reading
+    def delta_tables(self, peer):
+        """
+        Collect the entries a peer has not acknowledged yet. New peers, and peers lagging so far behind that
+        the delta would not be much smaller than the whole state, get a full-state transfer instead.
+        :param peer: peer address
+        :return: tables, sequence number to acknowledge once the peer has merged them, whether it is a full state
+        """
+        sequence = self.delta_tracker.sequence
+        acked = self.delta_tracker.acked.get(peer)
+        if acked is None:
+            return self.state(), sequence, True
+
+        changes = self.delta_tracker.since(acked)
+        if changes is None or len(changes) > Config.DELTA_FULL_STATE_RATIO * self.size():
+            return self.state(), sequence, True
+
+        tables = {
+            "vertices_added": (self.vertices.added, dict()),
+            "vertices_removed": (self.vertices.removed, dict()),
+            "edges_added": (self.edges.added, dict()),
+            "edges_removed": (self.edges.removed, dict())
         }
+        for table, item in changes:
+            source, delta = tables[table]
+            if item in source:
+                delta[item] = source[item]
+
+        return tuple(delta for _, delta in tables.values()), sequence, False
+
+    def delta(self, peer, encoding=codec.JSON_ENCODING):
+        tables, sequence, full_state = self.delta_tables(peer)
+        return self.encode(tables, encoding), sequence, full_state
+
+    @reading
+    def bucket_entries(self, buckets):
+        """
+        Serialize the entries that fall into the given Merkle buckets
+        :param buckets: list of leaf bucket indices
+        :return:
+        """
+        buckets = set(buckets)
+        bucket = self.merkle.bucket
+        return self.serialize({k: v for k, v in self.vertices.added.items() if bucket(k) in buckets},
+                              {k: v for k, v in self.vertices.removed.items() if bucket(k) in buckets},
+                              {k: v for k, v in self.edges.added.items() if bucket(k) in buckets},
+                              {k: v for k, v in self.edges.removed.items() if bucket(k) in buckets})
+
+    @writing
+    def acknowledge(self, peer, sequence):
+        self.delta_tracker.acknowledge(peer, sequence)
+
+    @writing
+    def reached(self, peer):
+        self.delta_tracker.reached(peer)
+
+    @writing
+    def unreachable(self, peer):
+        """
+        Count a failed sync with a peer, see DeltaTracker.unreachable
+        :return: whether the peer has just expired
+        """
+        return self.delta_tracker.unreachable(peer)
+
+    @writing
+    def collect_garbage(self, peers):
+        """
+        Compaction pass that also frees the tombstones that are causally stable: every known replica has acknowledged
+        a delta holding them, so none of them can ship the older add entry back and resurrect the element.
+        :param peers: addresses of all the other known replicas, the expired ones are left out
+        :return: see compact
+        """
+        return self.compact(self.delta_tracker.stable(peers))
+
+    @writing
+    def compact(self, stable=None):
+        """
+        Free the entries dominated by the other side of their element, they do not change the resolved state. With
+        a change sequence number, the tombstones recorded up to it are freed too, together with the add entries they
+        hide.
+        :param stable: sequence number every known replica has acknowledged, None to keep all the tombstones
+        :return: number of entries and tombstones freed, estimated memory and full-state payload bytes saved
+        """
+        stats = {
+            "entries": 0,
+            "tombstones": 0,
+            "memory_bytes": 0,
+            "payload_bytes": 0
+        }
+
+        # binary payload bytes of an entry: int64 key(s) and a float64 timestamp
+        for lww, entry_bytes in ((self.vertices, 16), (self.edges, 24)):
+            added, removed = list(), list()
+            for item, removed_timestamp in list(lww.removed.items()):
+                added_timestamp = lww.added.get(item)
+                if added_timestamp is not None and added_timestamp >= removed_timestamp:
+                    removed.append(item)
+                elif stable is not None and self.delta_tracker.stamp(f"{lww.name}_removed", item) <= stable:
+                    removed.append(item)
+                    stats["tombstones"] = stats["tombstones"] + 1
+                    if added_timestamp is not None:
+                        added.append(item)
+                elif added_timestamp is not None:
+                    added.append(item)
+
+            # the add entries go first, so the Merkle tree never sees a tombstoned element as live in between
+            for side, items in (("added", added), ("removed", removed)):
+                stats["memory_bytes"] = stats["memory_bytes"] + lww.footprint(side, items)
+                lww.free(side, items)
+                stats["entries"] = stats["entries"] + len(items)
+                stats["payload_bytes"] = stats["payload_bytes"] + entry_bytes * len(items)
+
+        logger.info(f"Compacted {stats['entries']} entries, {stats['tombstones']} of them tombstones, "
+                    f"stable up to change {stable}")
+        return stats
 
     def merge(self, vertices_added, vertices_removed, edges_added, edges_removed):
-        vertices_added = json.loads(vertices_added)
-        vertices_removed = json.loads(vertices_removed)
-        edges_added = json.loads(edges_added)
-        edges_removed = json.loads(edges_removed)
-
-        for k, v in vertices_added.items():
-            k = int(k)
-            if k in self.vertices.added:
-                if self.vertices.added[k] >= v:
-                    continue
-            self.vertices.added[k] = v
-
-        for k, v in vertices_removed.items():
-            k = int(k)
-            if k in self.vertices.removed:
-                if self.vertices.removed[k] >= v:
-                    continue
-            self.vertices.removed[k] = v
-
-        for k, z in edges_added.items():
-            u, v = int(k.split("_")[0]), int(k.split("_")[1])
-            u, v = self.convert_edge(u, v)
-
-            if (u, v) in self.edges.added:
-                if self.edges.added[(u, v)] >= z:
-                    continue
-
-            self.edges.added[(u, v)] = z
-
-        for k, z in edges_removed.items():
-            u, v = int(k.split("_")[0]), int(k.split("_")[1])
-            u, v = self.convert_edge(u, v)
-
-            if (u, v) in self.edges.removed:
-                if self.edges.removed[(u, v)] >= z:
-                    continue
-
-            self.edges.removed[(u, v)] = z
+        return self.merge_tables(*self.deserialize(vertices_added, vertices_removed, edges_added, edges_removed))
+
+    def merge_binary(self, payload):
+        return self.merge_tables(*codec.decode(payload))
+
+    def convert_edges(self, edges):
+        """
+        Convert the keys of an incoming edge table, keeping the latest timestamp when (u, v) and (v, u) collapse
+        :param edges: dictionary (u, v) -> timestamp
+        :return: list of keys and list of timestamps
+        """
+        if self.bidirection is False or all(u <= v for u, v in edges):
+            return list(edges.keys()), list(edges.values())
+
+        converted = dict()
+        for (u, v), z in edges.items():
+            key = (u, v) if u <= v else (v, u)
+            if key not in converted or converted[key] < z:
+                converted[key] = z
+
+        return list(converted.keys()), list(converted.values())
+
+    @writing
+    def merge_tables(self, vertices_added, vertices_removed, edges_added, edges_removed):
+        """
+        Merge incoming LWW tables one whole column at a time, a shard only keeps the entries it owns
+        :return: number of entries that actually changed the local state
+        """
+        if self.partition is not None:
+            vertices_added, vertices_removed = [{u: z for u, z in table.items() if self.partition.owns(u)}
+                                                for table in (vertices_added, vertices_removed)]
+            edges_added, edges_removed = [{e: z for e, z in table.items() if self.partition.owns_edge(e)}
+                                          for table in (edges_added, edges_removed)]
+
+        changed = len(self.vertices.merge_column("added", list(vertices_added.keys()), list(vertices_added.values())))
+        changed = changed + len(self.vertices.merge_column("removed", list(vertices_removed.keys()),
+                                                           list(vertices_removed.values())))
+
+        touched_edges = set()
+        for side, table in (("added", edges_added), ("removed", edges_removed)):
+            edges = self.edges.merge_column(side, *self.convert_edges(table))
+            changed = changed + len(edges)
+            touched_edges.update(edge for edge, _, _ in edges)
+
+        for u, v in touched_edges:
+            self.refresh_edge(u, v)
+
+        return changed
+
+    def restore(self, tables):
+        """
+        Merge tables persisted by this replica, whose edge keys are already in the stored orientation
+        :param tables: vertices_added, vertices_removed, edges_added, edges_removed
+        :return: number of entries that changed the local state
+        """
+        changed = 0
+        for lww, side, table in zip((self.vertices, self.vertices, self.edges, self.edges),
+                                    ("added", "removed", "added", "removed"), tables):
+            changed = changed + len(lww.merge_column(side, list(table.keys()), list(table.values())))
+
+        if changed:
+            self.rebuild_adjacency()
+
+        return changed
 
 
 database_instance = CRDTGraph()
@@ -0,0 +1,100 @@
+import threading
+from functools import wraps
+
+
+class ReadWriteLock:
+    """
+    Readers-writer lock: any number of threads may read at a time, a writer is alone. Waiting writers go first, so
+    a steady stream of reads cannot starve merges. Both sides are reentrant and the writer may also read, but a
+    reader cannot upgrade to a writer since two upgrading readers would wait for each other forever.
+    """
+    def __init__(self):
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        self.readers = 0
+        self.waiting_writers = 0
+        self.writer = None
+        self.depth = 0
+        # read depth of each reading thread, every thread only touches its own entry
+        self.reads = dict()
+
+    def acquire_read(self):
+        ident = threading.get_ident()
+        if self.writer == ident:
+            self.depth = self.depth + 1
+            return
+
+        reads = self.reads.get(ident, 0)
+        if reads == 0:
+            # the condition shares this mutex and is only waited on while a writer holds or wants the lock
+            with self.mutex:
+                while self.writer is not None or self.waiting_writers:
+                    self.condition.wait()
+                self.readers = self.readers + 1
+        self.reads[ident] = reads + 1
+
+    def release_read(self):
+        ident = threading.get_ident()
+        if self.writer == ident:
+            self.depth = self.depth - 1
+            return
+
+        reads = self.reads.pop(ident) - 1
+        if reads:
+            self.reads[ident] = reads
+        else:
+            with self.mutex:
+                self.readers = self.readers - 1
+                if self.readers == 0 and self.waiting_writers:
+                    self.condition.notify_all()
+
+    def acquire_write(self):
+        if self.writer == threading.get_ident():
+            self.depth = self.depth + 1
+            return
+
+        if threading.get_ident() in self.reads:
+            raise RuntimeError("A reader cannot upgrade to a writer")
+
+        with self.condition:
+            self.waiting_writers = self.waiting_writers + 1
+            while self.writer is not None or self.readers:
+                self.condition.wait()
+            self.waiting_writers = self.waiting_writers - 1
+            self.writer = threading.get_ident()
+            self.depth = 1
+
+    def release_write(self):
+        self.depth = self.depth - 1
+        if self.depth == 0:
+            with self.condition:
+                self.writer = None
+                self.condition.notify_all()
+
+
+def reading(method):
+    """
+    Run a method of an object with a lock attribute under its read side
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire_read()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.lock.release_read()
+    return wrapper
+
+
+def writing(method):
+    """
+    Run a method of an object with a lock attribute under its write side
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.lock.acquire_write()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.lock.release_write()
+    return wrapper
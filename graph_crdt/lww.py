@@ -1,4 +1,6 @@
+import sys
 import time
+from .storage import ColumnStore, ColumnView, EdgeKeys, VertexKeys
 from .utils import get_logger
 
 
@@ -17,22 +19,131 @@ def try_catch(func, *args, **kwargs):
 
 
 class LWWSet:
-    def __init__(self):
-        self.added = dict()
-        self.removed = dict()
+    def __init__(self, name="lww", storage="dict", edge_keys=False):
+        """
+        :param name: prefix of the table names reported to observers
+        :param storage: "dict" for Python dictionaries, "array" for the compact column storage
+        :param edge_keys: whether items are (u, v) edges rather than vertex ids, required by the array storage
+        """
+        self.name = name
+        self.observers = list()
 
-    @try_catch
-    def add(self, item: object):
-        self.added[item] = time.time()
+        self.store = None
+        if storage == "dict":
+            self.added = dict()
+            self.removed = dict()
+        elif storage == "array":
+            self.store = ColumnStore(EdgeKeys if edge_keys else VertexKeys)
+            self.added = ColumnView(self.store, 0)
+            self.removed = ColumnView(self.store, 1)
+        else:
+            raise ValueError(f"Unknown storage {storage}")
 
-    @try_catch
-    def remove(self, item: object):
-        self.removed[item] = time.time()
+    def notify(self, side, changes):
+        """
+        Let observers know some entries of this set have changed
+        :param side: "added" or "removed"
+        :param changes: list of (item, old timestamp or None if the entry did not exist,
+                        new timestamp or None if the entry has been freed)
+        :return:
+        """
+        table = f"{self.name}_{side}"
+        for observer in self.observers:
+            observer(table, changes)
 
     @try_catch
-    def free_added(self, item: object):
-        self.added.pop(item)
+    def add(self, item: object, timestamp=None):
+        timestamp = timestamp or time.time()
+        old_timestamp = self.added.get(item)
+        self.added[item] = timestamp
+        self.notify("added", [(item, old_timestamp, timestamp)])
 
     @try_catch
-    def free_removed(self, item: object):
-        self.removed.pop(item)
+    def remove(self, item: object, timestamp=None):
+        timestamp = timestamp or time.time()
+        old_timestamp = self.removed.get(item)
+        self.removed[item] = timestamp
+        self.notify("removed", [(item, old_timestamp, timestamp)])
+
+    def exists(self, item: object):
+        """
+        Last-writer-wins resolution of an item, an add wins ties. Only reads the tables: dominated entries are left
+        for an explicit compaction pass, see CRDTGraph.compact
+        :return: whether the item is in the set
+        """
+        if self.store is not None:
+            return self.store.exists(item)
+
+        added_timestamp = self.added.get(item)
+        if added_timestamp is None:
+            return False
+
+        removed_timestamp = self.removed.get(item)
+        return removed_timestamp is None or added_timestamp >= removed_timestamp
+
+    def free(self, side, items):
+        """
+        Free many entries at once, notifying observers with a single batch
+        :param side: "added" or "removed"
+        :param items: items that have an entry on this side
+        :return: list of (item, old timestamp, None)
+        """
+        table = getattr(self, side)
+        changes = [(item, table.pop(item), None) for item in items]
+        if changes:
+            self.notify(side, changes)
+
+        return changes
+
+    def footprint(self, side, items):
+        """
+        Estimate the memory held by some entries: the boxed key and timestamp objects of a dict entry, the timestamp
+        cell of the array storage
+        :return: bytes
+        """
+        table = getattr(self, side)
+        if isinstance(table, dict):
+            return sum(sys.getsizeof(item) + sys.getsizeof(table[item]) for item in items)
+
+        return table.store.columns[table.column].itemsize * len(items)
+
+    def merge_column(self, side, items, timestamps):
+        """
+        Last-writer-wins merge of a whole column of incoming entries
+        :param side: "added" or "removed"
+        :param items: sequence of distinct items
+        :param timestamps: sequence of timestamps aligned with items
+        :return: list of (item, old timestamp, new timestamp) for the entries that changed
+        """
+        if side == "added" and len(self.removed):
+            # an add hidden by a local tombstone is a no-op: storing it again after a compaction freed it would make
+            # it a new change, shipped to peers that may have collected the tombstone already
+            removed = list(map(self.removed.get, items))
+            kept = [index for index, timestamp in enumerate(timestamps)
+                    if removed[index] is None or removed[index] <= timestamp]
+            if len(kept) < len(removed):
+                items = [items[index] for index in kept]
+                timestamps = [timestamps[index] for index in kept]
+
+        table = getattr(self, side)
+        if isinstance(table, dict):
+            changed = merge_dict(table, items, timestamps)
+        else:
+            changed = table.merge(items, timestamps)
+
+        if changed:
+            self.notify(side, changed)
+
+        return changed
+
+
+def merge_dict(table, items, timestamps):
+    """
+    Compare and assign a column of entries with C-level builtins: one bulk lookup, one filter, one bulk update
+    :return: list of (item, old timestamp, new timestamp) for the entries that changed
+    """
+    olds = list(map(table.get, items))
+    changed = [(item, old, timestamp) for item, old, timestamp in zip(items, olds, timestamps)
+               if old is None or old < timestamp]
+    table.update((item, timestamp) for item, _, timestamp in changed)
+    return changed
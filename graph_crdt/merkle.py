@@ -0,0 +1,164 @@
+import hashlib
+from .config import Config
+
+
+class MerkleTree:
+    """
+    Hash tree over the LWW sets. Entries are bucketed by vertex id (edges by their first endpoint), each leaf is the
+    XOR of its entry hashes so it can be updated in O(1) on every mutation, and inner nodes are rebuilt lazily along
+    the paths of dirty leaves. Only the add timestamp of each live element is hashed, so replicas holding the same
+    resolved state agree on the digest even if one of them has freed dominated entries or collected tombstones.
+    """
+    def __init__(self, buckets=Config.MERKLE_BUCKETS, fanout=Config.MERKLE_FANOUT):
+        self.buckets = buckets
+        self.fanout = fanout
+        self.depth = 0
+        while fanout ** self.depth < buckets:
+            self.depth = self.depth + 1
+        if fanout ** self.depth != buckets:
+            raise ValueError(f"Number of buckets {buckets} is not a power of fanout {fanout}")
+
+        self.leaves = [0] * buckets
+        self.levels = [[0] * (fanout ** level) for level in range(self.depth)] + [self.leaves]
+        self.dirty = set(range(buckets))
+
+    def track(self, lww):
+        lww.observers.append(lambda table, changes: self.update(lww, table, changes))
+
+    def bucket(self, item):
+        if isinstance(item, tuple):
+            item = item[0]
+        return item % self.buckets
+
+    @staticmethod
+    def resolve(added_timestamp, removed_timestamp):
+        if added_timestamp is None:
+            return None
+
+        if removed_timestamp is None or added_timestamp >= removed_timestamp:
+            return "+", added_timestamp
+
+        return None
+
+    @staticmethod
+    def entry_hash(name, item, state):
+        entry = f"{name}|{item}|{state[0]}{state[1]!r}".encode()
+        return int.from_bytes(hashlib.blake2b(entry, digest_size=8).digest(), "big")
+
+    def update(self, lww, table, changes):
+        """
+        LWWSet observer: swap the old resolved state of each changed element for the new one in its leaf
+        :return:
+        """
+        added = table == f"{lww.name}_added"
+        other = lww.removed if added else lww.added
+        resolve, entry_hash, leaves, buckets = self.resolve, self.entry_hash, self.leaves, self.buckets
+
+        for item, old_timestamp, new_timestamp in changes:
+            other_timestamp = other.get(item)
+            if added:
+                before = resolve(old_timestamp, other_timestamp)
+                after = resolve(new_timestamp, other_timestamp)
+            else:
+                before = resolve(other_timestamp, old_timestamp)
+                after = resolve(other_timestamp, new_timestamp)
+
+            if before == after:
+                continue
+
+            bucket = (item[0] if isinstance(item, tuple) else item) % buckets
+            if before is not None:
+                leaves[bucket] ^= entry_hash(lww.name, item, before)
+            if after is not None:
+                leaves[bucket] ^= entry_hash(lww.name, item, after)
+            self.dirty.add(bucket)
+
+    def refresh(self):
+        nodes = self.dirty
+        for level in range(self.depth - 1, -1, -1):
+            nodes = {node // self.fanout for node in nodes}
+            children = self.levels[level + 1]
+            for node in nodes:
+                first = node * self.fanout
+                content = b"".join(child.to_bytes(8, "big") for child in children[first: first + self.fanout])
+                self.levels[level][node] = int.from_bytes(hashlib.blake2b(content, digest_size=8).digest(), "big")
+
+        self.dirty = set()
+
+    def digest(self, level, nodes):
+        """
+        Hashes of the given nodes at a tree level (0 is the root, depth holds the leaves)
+        :param level:
+        :param nodes: node indices within the level
+        :return: list of hex digests
+        """
+        if self.dirty:
+            self.refresh()
+
+        return [format(self.levels[level][node], "016x") for node in nodes]
+
+    def children(self, node):
+        return range(node * self.fanout, (node + 1) * self.fanout)
+
+
+def check_nodes(level, nodes, buckets=Config.MERKLE_BUCKETS, fanout=Config.MERKLE_FANOUT):
+    """
+    Validate the nodes of a digest request against the shape of a tree, before they reach MerkleTree.digest
+    :param level: tree level, 0 is the root
+    :param nodes: node indices within the level
+    :return: None
+    :raise ValueError: if the level or a node is not in the tree
+    """
+    width = 1
+    for _ in range(level):
+        width = width * fanout
+        if width > buckets:
+            break
+    if level < 0 or width > buckets:
+        raise ValueError(f"No level {level} in the tree")
+    if not isinstance(nodes, list) or not all(type(node) is int and 0 <= node < width for node in nodes):
+        raise ValueError(f"Nodes must be a list of indices below {width} at level {level}")
+
+
+def check_buckets(buckets, count=Config.MERKLE_BUCKETS):
+    """
+    Validate the leaf buckets of an entries request, before they reach CRDTGraph.bucket_entries
+    :param buckets: leaf bucket indices
+    :return: None
+    :raise ValueError: if a bucket is not in the tree
+    """
+    if not isinstance(buckets, list) or not all(type(bucket) is int and 0 <= bucket < count for bucket in buckets):
+        raise ValueError(f"Buckets must be a list of indices below {count}")
+
+
+def descend(tree, level, nodes, theirs):
+    """
+    One step of diff_buckets, for walks that get the remote digests asynchronously
+    :param tree: local MerkleTree
+    :param level: tree level of the nodes
+    :param nodes: node indices within the level
+    :param theirs: remote hex digests of these nodes
+    :return: differing leaf buckets and None once the walk is over, else None and the nodes to compare a level below
+    """
+    mine = tree.digest(level, nodes)
+    differing = [node for node, a, b in zip(nodes, mine, theirs) if a != b]
+    if level == tree.depth or not differing:
+        return differing, None
+
+    return None, [child for node in differing for child in tree.children(node)]
+
+
+def diff_buckets(tree, remote_digest):
+    """
+    Walk down both trees from the root, descending only into the nodes whose hashes differ
+    :param tree: local MerkleTree
+    :param remote_digest: callable (level, nodes) -> list of the remote hex digests of these nodes
+    :return: list of leaf buckets that differ, empty if both replicas are in sync
+    """
+    level, nodes = 0, [0]
+    while True:
+        buckets, nodes = descend(tree, level, nodes, remote_digest(level, nodes))
+        if buckets is not None:
+            return buckets
+
+        level = level + 1
@@ -0,0 +1,203 @@
+"""
+In-process metrics in the Prometheus text exposition format. Recording a sample costs a dictionary lookup for the
+labels, a short lock and, for histograms, a binary search over the buckets, so the metrics stay on in production.
+The gateway serves its own metrics together with the ones its worker processes collect, see GET /metrics.
+"""
+import math
+import threading
+from bisect import bisect_left
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+SIZE_BUCKETS = tuple(4 ** exponent for exponent in range(3, 14))
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Sample:
+    """
+    Value of a counter or gauge for one combination of label values
+    """
+    def __init__(self):
+        self.value = 0.0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value = self.value + amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name):
+        return [(name, dict(), self.value)]
+
+
+class HistogramSample:
+    """
+    Bucket counts, sum and count of a histogram for one combination of label values
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] = self.counts[index] + 1
+            self.sum = self.sum + value
+
+    def samples(self, name):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+
+        samples, cumulative = list(), 0
+        for bound, count in zip(self.buckets + (math.inf, ), counts):
+            cumulative = cumulative + count
+            samples.append((f"{name}_bucket", {"le": format_value(bound)}, cumulative))
+        samples.append((f"{name}_sum", dict(), total))
+        samples.append((f"{name}_count", dict(), cumulative))
+        return samples
+
+
+class Metric:
+    def __init__(self, name, kind, documentation, labels=(), buckets=None):
+        """
+        :param name: metric name
+        :param kind: "counter", "gauge" or "histogram"
+        :param documentation: help text
+        :param labels: label names
+        :param buckets: upper bounds of the histogram buckets, in increasing order
+        """
+        self.name = name
+        self.kind = kind
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets) if buckets is not None else None
+        self.children = dict()
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        """
+        :param values: one value per label name
+        :return: sample of these label values, created on first use
+        """
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = HistogramSample(self.buckets) if self.kind == "histogram" else Sample()
+                    self.children[values] = child
+
+        return child
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def family(self):
+        samples = list()
+        for values, child in list(self.children.items()):
+            labels = dict(zip(self.label_names, map(str, values)))
+            for name, extra, value in child.samples(self.name):
+                samples.append([name, dict(labels, **extra), value])
+
+        return {"name": self.name, "type": self.kind, "help": self.documentation, "samples": samples}
+
+
+class MetricsRegistry:
+    def __init__(self, prefix="gcrdt"):
+        self.prefix = prefix
+        self.metrics = list()
+        self.collectors = list()
+
+    def register(self, name, kind, documentation, labels=(), buckets=None):
+        metric = Metric(f"{self.prefix}_{name}", kind, documentation, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(name, "counter", documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self.register(name, "gauge", documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(name, "histogram", documentation, labels, buckets)
+
+    def collector(self, func):
+        """
+        Register a function run on every collection, to set gauges from state that is cheap to read but would be
+        costly to track on every change
+        :param func: function without arguments
+        :return: func
+        """
+        self.collectors.append(func)
+        return func
+
+    def collect(self):
+        """
+        :return: JSON serializable list of metric families with their samples, see render
+        """
+        for func in self.collectors:
+            func()
+
+        return [metric.family() for metric in self.metrics]
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def with_labels(families, **labels):
+    """
+    Add constant labels to every sample, e.g. the shard of a worker
+    :return: families
+    """
+    for family in families:
+        for sample in family["samples"]:
+            sample[1] = dict(sample[1], **labels)
+
+    return families
+
+
+def render(families):
+    """
+    Prometheus text format of metric families, the families sharing a name are written as one
+    :param families: list of {"name", "type", "help", "samples": [[name, labels, value]]}
+    :return: text
+    """
+    merged = dict()
+    for family in families:
+        if family["name"] not in merged:
+            merged[family["name"]] = dict(family, samples=list())
+        merged[family["name"]]["samples"].extend(family["samples"])
+
+    lines = list()
+    for family in merged.values():
+        lines.append(f"# HELP {family['name']} {escape(family['help'])}")
+        lines.append(f"# TYPE {family['name']} {family['type']}")
+        for name, labels, value in family["samples"]:
+            if labels:
+                name = name + "{" + ",".join(f'{key}="{escape(label)}"' for key, label in labels.items()) + "}"
+            lines.append(f"{name} {format_value(value)}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,25 @@
+"""
+Networks carrying the requests between replicas. The worker sends every request to its friends through a Network and
+gets the reply in a callback on its loop, so the replication protocol runs the same over HTTP, with
+graph_crdt.fanout.Fanout, and in the single-process simulation of benchmark/simulation.py.
+"""
+import json
+from graph_crdt.config import Config
+
+
+def message_size(message):
+    return len(json.dumps(message))
+
+
+class Network:
+    def post(self, source, destination, path, message, callback, timeout=Config.REQUEST_TIMEOUT):
+        """
+        Send a request, callback gets either the reply and None or None and the error of a failed request
+        :param source: sender address
+        :param destination: receiver address
+        :param path: endpoint of the receiver
+        :param message: JSON serializable dictionary, except for the bytes payload of a binary merge
+        :param callback: function of the reply and the error
+        :param timeout: seconds until a request without reply fails
+        """
+        raise NotImplementedError
@@ -0,0 +1,68 @@
+def bidirectional_bfs(source, target, successors, predecessors, max_hops=None):
+    """
+    Shortest path search growing one breadth-first frontier from each end and always expanding the smaller one.
+    Visited vertices are kept in two parent maps, so memory is proportional to the explored region only.
+    :param source:
+    :param target:
+    :param successors: callable returning the out-neighbors of a vertex
+    :param predecessors: callable returning the in-neighbors of a vertex
+    :param max_hops: maximum number of edges in the returned path, None for unbounded
+    :return: list of vertices from source to target, None if there is no such path
+    """
+    if source == target:
+        return [source]
+
+    forward, backward = {source: None}, {target: None}
+    forward_frontier, backward_frontier = [source], [target]
+    hops = 0
+
+    while forward_frontier and backward_frontier:
+        if max_hops is not None and hops >= max_hops:
+            return None
+
+        hops = hops + 1
+        if len(forward_frontier) <= len(backward_frontier):
+            forward_frontier, meet = _expand(forward_frontier, forward, backward, successors)
+        else:
+            backward_frontier, meet = _expand(backward_frontier, backward, forward, predecessors)
+
+        if meet is not None:
+            return _join(meet, forward, backward)
+
+    return None
+
+
+def _expand(frontier, parents, other_parents, neighbors):
+    """
+    Expand one whole BFS level, stopping early as soon as it touches the opposite search
+    :return: next frontier and the meeting vertex (None if the searches have not met yet)
+    """
+    next_frontier = list()
+    for u in frontier:
+        for v in neighbors(u):
+            if v in parents:
+                continue
+
+            parents[v] = u
+            if v in other_parents:
+                return next_frontier, v
+
+            next_frontier.append(v)
+
+    return next_frontier, None
+
+
+def _join(meet, forward, backward):
+    path = list()
+    node = meet
+    while node is not None:
+        path.append(node)
+        node = forward[node]
+    path.reverse()
+
+    node = backward[meet]
+    while node is not None:
+        path.append(node)
+        node = backward[node]
+
+    return path
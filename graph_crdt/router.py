@@ -0,0 +1,257 @@
+import json
+import time
+import struct
+import asyncio
+from collections import defaultdict
+from graph_crdt import codec
+from graph_crdt.graph import CRDTGraph
+from graph_crdt.shard import partition_tables, shard_of
+from graph_crdt.transport import pack_message
+
+
+def merge_message(data, tables):
+    """
+    :return: merge message and its binary payload, or the message with JSON tables and None for ids outside of the
+             int64 range
+    """
+    try:
+        return data, codec.encode(*tables)
+    except struct.error:
+        return dict(data, **CRDTGraph.serialize(*tables)), None
+
+
+class ShardRouter:
+    """
+    Gateway side of a sharded replica, see graph_crdt.shard. Point queries go to the shard owning the vertex, edge
+    writes to the owners of both endpoints with one timestamp, and find_path runs a breadth-first search level by level
+    with one batched request per shard and level. Every method answers with the same fields as a single worker.
+    """
+    def __init__(self, clients, observe=None):
+        """
+        :param clients: graph_crdt.transport.AsyncClient of each shard worker, in shard order
+        :param observe: function called with the query, the seconds waited for the reply and whether it failed
+        """
+        self.clients = clients
+        self.observe = observe
+
+    def __len__(self):
+        return len(self.clients)
+
+    def owner(self, u):
+        return shard_of(u, len(self.clients))
+
+    async def request(self, shard, data, timeout=None, attachment=None):
+        started, failed = time.perf_counter(), True
+        try:
+            rcv_msg = await self.clients[shard].request(pack_message(data, attachment), timeout)
+            failed = False
+        finally:
+            if self.observe is not None:
+                self.observe(data["query"], time.perf_counter() - started, failed)
+
+        return json.loads(rcv_msg.decode("utf-8"))
+
+    async def route(self, u, data, timeout=None):
+        return await self.request(self.owner(u), data, timeout)
+
+    async def scatter(self, data, timeout=None):
+        """
+        Send the same query to every shard
+        :return: list of the replies, in shard order
+        """
+        return await asyncio.gather(*[self.request(shard, data, timeout) for shard in range(len(self.clients))])
+
+    def group(self, nodes):
+        groups = defaultdict(list)
+        for u in nodes:
+            groups[self.owner(u)].append(u)
+
+        return groups
+
+    async def alive(self, nodes):
+        """
+        :param nodes: vertex ids
+        :return: set of the nodes that are alive on their owner shard
+        """
+        groups = self.group(nodes)
+        replies = await asyncio.gather(*[self.request(shard, {"query": "exists_batch", "nodes": group})
+                                         for shard, group in groups.items()])
+
+        return {u for group, reply in zip(groups.values(), replies)
+                for u, status in zip(group, reply["data"]) if status}
+
+    async def neighbors(self, nodes):
+        """
+        Live neighbors of many live vertices
+        :param nodes: vertex ids
+        :return: dictionary vertex -> list of neighbors
+        """
+        groups = self.group(nodes)
+        replies = await asyncio.gather(*[self.request(shard, {"query": "neighbors_batch", "nodes": group})
+                                         for shard, group in groups.items()])
+
+        candidates = dict()
+        for group, reply in zip(groups.values(), replies):
+            for u, (_, neighbors) in zip(group, reply["data"]):
+                candidates[u] = neighbors
+
+        # an owner only vouches for its own vertices, the others are checked by theirs
+        foreign = {v for u, neighbors in candidates.items() for v in neighbors if self.owner(v) != self.owner(u)}
+        alive = await self.alive(foreign) if foreign else set()
+        return {u: [v for v in neighbors if self.owner(v) == self.owner(u) or v in alive]
+                for u, neighbors in candidates.items()}
+
+    def edge_shards(self, u, v):
+        # the owner of u first, its reply stands for both copies
+        return [self.owner(u)] if self.owner(u) == self.owner(v) else [self.owner(u), self.owner(v)]
+
+    async def query(self, data):
+        """
+        Run a gateway query on the shards
+        :param data: message a single worker would get
+        :return: the reply a single worker would give
+        """
+        queries = {
+            "add_vertex": lambda: self.add_vertex(data["u"]),
+            "add_edge": lambda: self.add_edge(data["u"], data["v"]),
+            "remove_vertex": lambda: self.remove_vertex(data["u"]),
+            "remove_edge": lambda: self.remove_edge(data["u"], data["v"]),
+            "exists_vertex": lambda: self.exists_vertex(data["u"]),
+            "exists_edge": lambda: self.exists_edge(data["u"], data["v"]),
+            "get_neighbors": lambda: self.get_neighbors(data["u"]),
+            "find_path": lambda: self.find_path(data["u"], data["v"], data.get("max_hops")),
+            "list_nodes": lambda: self.list_nodes(),
+            "batch": lambda: self.batch(data["operations"]),
+            "clear": lambda: self.clear()
+        }
+        if data["query"] not in queries:
+            raise ValueError(f"Query {data['query']} is not supported by sharded replicas")
+
+        return await queries[data["query"]]()
+
+    async def add_vertex(self, u):
+        return await self.route(u, {"query": "add_vertex", "u": u})
+
+    async def exists_vertex(self, u):
+        return await self.route(u, {"query": "exists_vertex", "u": u})
+
+    async def exists_edge(self, u, v):
+        return await self.route(u, {"query": "exists_edge", "u": u, "v": v})
+
+    async def add_edge(self, u, v):
+        if len(await self.alive([u, v])) < len({u, v}):
+            return {"status": False, "_": f"Not valid vertex ({u} - {v})"}
+
+        data = {"query": "add_edge", "u": u, "v": v, "timestamp": time.time()}
+        replies = await asyncio.gather(*[self.request(shard, data) for shard in self.edge_shards(u, v)])
+        return replies[0]
+
+    async def remove_edge(self, u, v):
+        data = {"query": "remove_edge", "u": u, "v": v, "timestamp": time.time()}
+        replies = await asyncio.gather(*[self.request(shard, data) for shard in self.edge_shards(u, v)])
+        return replies[0]
+
+    async def remove_vertex(self, u):
+        owner = self.owner(u)
+        rcv_msg = await self.request(owner, {"query": "get_neighbors", "u": u})
+        if not rcv_msg["_"]:
+            return {"status": False}
+
+        # the copies of its edges held by the owners of the neighbors go with the same timestamp
+        timestamp = time.time()
+        foreign = defaultdict(list)
+        for v in rcv_msg["status"]:
+            if self.owner(v) != owner:
+                foreign[self.owner(v)].append([u, v])
+
+        replies = await asyncio.gather(
+            self.request(owner, {"query": "remove_vertex", "u": u, "timestamp": timestamp}),
+            *[self.request(shard, {"query": "remove_edges", "edges": edges, "timestamp": timestamp})
+              for shard, edges in foreign.items()])
+        return replies[0]
+
+    async def get_neighbors(self, u):
+        rcv_msg = await self.route(u, {"query": "get_neighbors", "u": u})
+        if not rcv_msg["_"]:
+            return rcv_msg
+
+        return {"_": True, "status": (await self.neighbors([u]))[u]}
+
+    async def find_path(self, u, v, max_hops=None):
+        if len(await self.alive([u, v])) < len({u, v}):
+            return {"status": False, "path": []}
+
+        parents = {u: None}
+        frontier, hops = [u], 0
+        while frontier and v not in parents and (max_hops is None or hops < max_hops):
+            neighbors = await self.neighbors(frontier)
+            next_frontier = list()
+            for node in sorted(frontier):
+                for neighbor in sorted(neighbors[node]):
+                    if neighbor not in parents:
+                        parents[neighbor] = node
+                        next_frontier.append(neighbor)
+            frontier, hops = next_frontier, hops + 1
+
+        if v not in parents:
+            return {"status": False, "path": []}
+
+        path = [v]
+        while parents[path[-1]] is not None:
+            path.append(parents[path[-1]])
+        return {"status": True, "path": path[::-1]}
+
+    async def list_nodes(self):
+        replies = await self.scatter({"query": "list_nodes"})
+        return {"data": sorted(u for reply in replies for u in reply["data"])}
+
+    async def batch(self, operations):
+        """
+        Apply the operations one after the other, since an edge may depend on a vertex added earlier in the batch
+        :return: worker-like reply with a [status, message] per operation
+        """
+        apply = {
+            "add_vertex": self.add_vertex,
+            "add_edge": self.add_edge,
+            "remove_vertex": self.remove_vertex,
+            "remove_edge": self.remove_edge
+        }
+
+        results = list()
+        for operation in operations:
+            if not isinstance(operation, list) or not operation or not isinstance(operation[0], str):
+                results.append([False, f"Invalid operation {operation}"])
+                continue
+
+            name, args = operation[0], operation[1:]
+            if name not in apply:
+                results.append([False, f"Unknown operation {name}"])
+                continue
+
+            try:
+                rcv_msg = await apply[name](*map(int, args))
+                results.append([rcv_msg["status"], rcv_msg.get("_", "")])
+            except (TypeError, ValueError) as e:
+                results.append([False, f"Invalid operation {operation}: {e}"])
+
+        return {"data": results}
+
+    async def clear(self):
+        replies = await self.scatter({"query": "clear"})
+        return {"data": all(reply["data"] for reply in replies)}
+
+    async def merge(self, data, tables):
+        """
+        Merge incoming tables, each shard getting the entries it owns
+        :param data: merge message without the tables
+        :param tables: vertices_added, vertices_removed, edges_added, edges_removed
+        :return: reply of the first shard
+        """
+        messages = [merge_message(data, part) for part in partition_tables(tables, len(self.clients))]
+        replies = await asyncio.gather(*[self.request(shard, message, attachment=payload)
+                                         for shard, (message, payload) in enumerate(messages)])
+        errors = [reply for reply in replies if reply.get("status") == "Error"]
+        if errors:
+            return errors[0]
+
+        return {"data": replies[0]["data"], "changed": sum(reply.get("changed", 0) for reply in replies)}
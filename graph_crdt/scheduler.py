@@ -0,0 +1,129 @@
+import time
+import asyncio
+from graph_crdt.config import Config
+from graph_crdt.utils import get_logger
+
+logger = get_logger("Scheduler")
+
+
+class SyncScheduler:
+    """
+    Replicate in the background instead of waiting for clients to call /broadcast. A sync round runs every interval
+    seconds, at most delay seconds after the first local write since the last round, and right away once burst writes
+    have piled up, so that all the writes in between are coalesced into a single round. A peer is never synced twice
+    at a time: a round skips the peers whose previous sync is still running and schedules another round for them.
+    """
+    def __init__(self, peers, sync, interval=Config.SYNC_INTERVAL, delay=Config.SYNC_WRITE_DELAY,
+                 burst=Config.SYNC_WRITE_BURST):
+        """
+        :param peers: function returning the peers of the next round
+        :param sync: coroutine function syncing with a list of peers
+        :param interval: seconds between two rounds without local writes
+        :param delay: maximum seconds between a local write and the round shipping it
+        :param burst: number of local writes starting a round right away
+        """
+        self.peers = peers
+        self.sync = sync
+        self.interval = interval
+        self.delay = delay
+        self.burst = burst
+        self.in_flight = set()
+        self.writes = 0
+        self.retry = False
+        self.first_write = None
+        self.wakeup = None
+        self.rounds = 0
+        self.peer_syncs = 0
+        self.skipped = 0
+        self.coalesced_writes = 0
+        self.last_round = 0.0
+
+    def written(self, count=1):
+        """
+        Record local writes, waking the scheduler up on the first one and once a burst is complete
+        :param count: number of writes
+        :return:
+        """
+        if count <= 0:
+            return
+
+        if self.writes == 0 and not self.retry:
+            self.first_write = time.monotonic()
+        self.writes = self.writes + count
+        if self.wakeup is not None and (self.writes == count or self.writes >= self.burst):
+            self.wakeup.set()
+
+    def due(self):
+        """
+        :return: seconds until the next round is due, 0 if it is
+        """
+        if self.writes >= self.burst:
+            return 0
+
+        due = self.last_round + self.interval
+        if self.writes or self.retry:
+            due = min(due, self.first_write + self.delay)
+
+        return max(0.0, due - time.monotonic())
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        self.last_round = time.monotonic()
+        while True:
+            timeout = self.due()
+            if timeout > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+
+            try:
+                await self.round()
+            except Exception as e:
+                logger.exception(e)
+
+    async def round(self):
+        """
+        Sync with the peers of this round that are not being synced already
+        :return: peers synced
+        """
+        writes, self.writes, self.retry = self.writes, 0, False
+        self.last_round = time.monotonic()
+
+        peers, busy = list(), list()
+        for peer in self.peers():
+            (busy if peer in self.in_flight else peers).append(peer)
+        if busy:
+            # their running sync may have missed the latest writes
+            self.skipped = self.skipped + len(busy)
+            self.retry = True
+            self.first_write = self.last_round
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+        self.rounds = self.rounds + 1
+        self.coalesced_writes = self.coalesced_writes + writes
+        if not peers:
+            return peers
+
+        self.in_flight.update(peers)
+        try:
+            await self.sync(peers)
+            self.peer_syncs = self.peer_syncs + len(peers)
+        finally:
+            self.in_flight.difference_update(peers)
+
+        logger.info(f"Synced with {len(peers)} peers, {writes} local writes coalesced")
+        return peers
+
+    def stats(self):
+        return {
+            "rounds": self.rounds,
+            "peer_syncs": self.peer_syncs,
+            "skipped": self.skipped,
+            "coalesced_writes": self.coalesced_writes,
+            "pending_writes": self.writes,
+            "in_flight": sorted(self.in_flight)
+        }
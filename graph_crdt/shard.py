@@ -0,0 +1,72 @@
+"""
+Hash partitioning of a replica over several worker processes. Every shard owns the vertices hashing to it, and keeps
+a copy of every edge with an owned endpoint, so the neighbors of a vertex are all known to its owner. The two copies of
+an edge always get the same timestamps: the gateway stamps edge writes itself and sends them to both owners.
+"""
+from graph_crdt import codec
+
+_MASK64 = 2 ** 64 - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+
+
+def shard_of(u, shards):
+    if shards == 1:
+        return 0
+
+    return ((u * _GOLDEN) & _MASK64) % shards
+
+
+class Partition:
+    def __init__(self, index, shards):
+        """
+        :param index: index of this shard
+        :param shards: number of shards
+        """
+        self.index = index
+        self.shards = shards
+
+    def owns(self, u):
+        return shard_of(u, self.shards) == self.index
+
+    def owns_edge(self, edge):
+        return self.owns(edge[0]) or self.owns(edge[1])
+
+
+def partition_tables(tables, shards):
+    """
+    Split LWW tables between the shards owning their entries
+    :param tables: vertices_added, vertices_removed, edges_added, edges_removed
+    :param shards: number of shards
+    :return: list of tables, one per shard
+    """
+    parts = [tuple(dict() for _ in codec.TABLES) for _ in range(shards)]
+    for table_id, table in enumerate(tables):
+        if table_id < 2:
+            for u, timestamp in table.items():
+                parts[shard_of(u, shards)][table_id][u] = timestamp
+            continue
+
+        for (u, v), timestamp in table.items():
+            first, second = shard_of(u, shards), shard_of(v, shards)
+            parts[first][table_id][(u, v)] = timestamp
+            if second != first:
+                parts[second][table_id][(u, v)] = timestamp
+
+    return parts
+
+
+def shard_addresses(address, shards):
+    """
+    Internal addresses of the shard workers: consecutive ports after a TCP/UDP address, numbered Unix socket paths
+    :param address: address of the first shard
+    :param shards: number of shards
+    :return: list of addresses
+    """
+    if shards == 1:
+        return [address]
+
+    if isinstance(address, str):
+        return [f"{address}.{index}" for index in range(shards)]
+
+    host, port = address
+    return [(host, port + index) for index in range(shards)]
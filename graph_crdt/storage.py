@@ -0,0 +1,281 @@
+import random
+from array import array
+from collections.abc import MutableMapping
+
+EMPTY = -2 ** 63
+DELETED = EMPTY + 1
+NAN = float("nan")
+_MASK64 = 2 ** 64 - 1
+_GOLDEN = 0x9E3779B97F4A7C15
+_MAX_LOAD = 0.7
+
+
+class VertexKeys:
+    @staticmethod
+    def pack(item):
+        if not DELETED < item < 2 ** 63:
+            raise ValueError(f"Vertex id {item} does not fit into the array storage")
+        return item
+
+    @staticmethod
+    def unpack(key):
+        return key
+
+
+class EdgeKeys:
+    """
+    Pack an edge (u, v) into one int64, both endpoints must be within the int32 range
+    """
+    @staticmethod
+    def pack(item):
+        u, v = item
+        if not (-2 ** 31 <= u < 2 ** 31 and -2 ** 31 <= v < 2 ** 31):
+            raise ValueError(f"Edge {item} does not fit into the array storage")
+        key = (u << 32) | (v + 2 ** 31)
+        if key <= DELETED:
+            raise ValueError(f"Edge {item} does not fit into the array storage")
+        return key
+
+    @staticmethod
+    def unpack(key):
+        return key >> 32, (key & 0xFFFFFFFF) - 2 ** 31
+
+
+class ColumnStore:
+    """
+    Open-addressed hash table made of flat typed arrays: one int64 key column and one float64 timestamp column
+    per LWW side (added, removed), NaN marking a missing timestamp. An entry costs about 24 bytes per slot instead
+    of the 100+ bytes of a dict entry with boxed keys and floats.
+    """
+    def __init__(self, keys=VertexKeys, capacity=8):
+        self.key_codec = keys
+        # a random odd multiplier per table: with a shared one, the entries of a peer's table come in the order of
+        # our own hash, and merging them into a smaller table piles them up into a single probe run
+        self.multiplier = random.getrandbits(64) | (1 << 63) | 1
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        self.capacity = capacity
+        self.bits = capacity.bit_length() - 1
+        self.mask = capacity - 1
+        self.keys = array("q", [EMPTY]) * capacity
+        self.columns = [array("d", [NAN]) * capacity, array("d", [NAN]) * capacity]
+        self.sizes = [0, 0]
+        self.used = 0
+
+    def slot(self, key):
+        if not self.bits:
+            return 0
+
+        key = (key * self.multiplier) & _MASK64
+        return (((key ^ (key >> 29)) * _GOLDEN) & _MASK64) >> (64 - self.bits)
+
+    def find(self, key):
+        keys, mask = self.keys, self.mask
+        slot = self.slot(key)
+        while True:
+            k = keys[slot]
+            if k == key:
+                return slot
+            if k == EMPTY:
+                return -1
+            slot = (slot + 1) & mask
+
+    def claim(self, key):
+        """
+        Find the slot of a key, inserting the key if it is not in the table yet
+        :param key: packed key
+        :return: slot index
+        """
+        keys, mask = self.keys, self.mask
+        slot, free = self.slot(key), -1
+        while True:
+            k = keys[slot]
+            if k == key:
+                return slot
+            if k == EMPTY:
+                break
+            if k == DELETED and free < 0:
+                free = slot
+            slot = (slot + 1) & mask
+
+        if free >= 0:
+            keys[free] = key
+            return free
+
+        if self.used + 1 > _MAX_LOAD * self.capacity:
+            self.resize()
+            return self.claim(key)
+
+        keys[slot] = key
+        self.used = self.used + 1
+        return slot
+
+    def resize(self, extra=1):
+        """
+        Rehash the live entries into a table that leaves room for extra more keys
+        :param extra: number of keys about to be inserted
+        :return:
+        """
+        live = max(self.sizes[0], self.sizes[1], sum(1 for a, r in zip(*self.columns) if a == a or r == r))
+        capacity = self.capacity
+        while live + extra > _MAX_LOAD * capacity / 2:
+            capacity = capacity * 2
+
+        old_keys, (old_added, old_removed), sizes = self.keys, self.columns, self.sizes
+        self.allocate(capacity)
+        for key, added, removed in zip(old_keys, old_added, old_removed):
+            if added == added or removed == removed:
+                slot = self.claim(key)
+                self.columns[0][slot] = added
+                self.columns[1][slot] = removed
+        self.sizes = sizes
+
+    def get(self, column, item):
+        slot = self.find(self.key_codec.pack(item))
+        if slot < 0:
+            return None
+
+        timestamp = self.columns[column][slot]
+        return None if timestamp != timestamp else timestamp
+
+    def exists(self, item):
+        """
+        Last-writer-wins resolution of an item with a single probe for both columns, an add wins ties
+        :return: whether the item is in the set
+        """
+        try:
+            slot = self.find(self.key_codec.pack(item))
+        except (ValueError, TypeError):
+            return False
+        if slot < 0:
+            return False
+
+        added = self.columns[0][slot]
+        return added == added and not added < self.columns[1][slot]
+
+    def set(self, column, item, timestamp):
+        slot = self.claim(self.key_codec.pack(item))
+        values = self.columns[column]
+        if values[slot] != values[slot]:
+            self.sizes[column] = self.sizes[column] + 1
+        values[slot] = timestamp
+
+    def delete(self, column, item):
+        slot = self.find(self.key_codec.pack(item))
+        values = self.columns[column]
+        if slot < 0 or values[slot] != values[slot]:
+            raise KeyError(item)
+
+        values[slot] = NAN
+        self.sizes[column] = self.sizes[column] - 1
+        other = self.columns[1 - column][slot]
+        if other != other:
+            self.keys[slot] = DELETED
+
+    def merge(self, column, items, timestamps):
+        """
+        Last-writer-wins merge of a whole column of entries. The table is resized up front for the keys that are
+        certainly new, so the probing loop below mostly runs on local variables. It is still a Python loop, one
+        iteration per entry: the array module has no bulk hash-join, so this stays slower than merge_dict on the
+        dict storage.
+        :return: list of (item, old timestamp, new timestamp) for the entries that changed
+        """
+        # pack every key up front, an id that does not fit raises before the column is touched
+        keys = list(map(self.key_codec.pack, items))
+        # at most `used` of the keys are already in the table, growing for more would waste memory on a no-op merge
+        if len(keys) > _MAX_LOAD * self.capacity:
+            self.resize(len(keys) - self.used)
+
+        table, values, mask, used = self.keys, self.columns[column], self.mask, self.used
+        multiplier, shift, limit = self.multiplier, 64 - self.bits, _MAX_LOAD * self.capacity
+        changed = list()
+        for item, key, timestamp in zip(items, keys, timestamps):
+            # slot and claim, inlined
+            h = (key * multiplier) & _MASK64
+            slot = (((h ^ (h >> 29)) * _GOLDEN) & _MASK64) >> shift
+            free = -1
+            k = table[slot]
+            while k != key:
+                if k == EMPTY:
+                    if free >= 0:
+                        table[free] = key
+                        slot = free
+                    elif used + 1 > limit:
+                        # more new keys than the table was sized for
+                        self.used = used
+                        slot = self.claim(key)
+                        table, values, mask, used = self.keys, self.columns[column], self.mask, self.used
+                        shift, limit = 64 - self.bits, _MAX_LOAD * self.capacity
+                    else:
+                        table[slot] = key
+                        used = used + 1
+                    break
+                if k == DELETED and free < 0:
+                    free = slot
+                slot = (slot + 1) & mask
+                k = table[slot]
+
+            old = values[slot]
+            if old != old:
+                values[slot] = timestamp
+                changed.append((item, None, timestamp))
+            elif old < timestamp:
+                values[slot] = timestamp
+                changed.append((item, old, timestamp))
+
+        self.used = used
+        self.sizes[column] = self.sizes[column] + sum(1 for _, old, _ in changed if old is None)
+        return changed
+
+    def items(self, column):
+        unpack = self.key_codec.unpack
+        for key, timestamp in zip(self.keys, self.columns[column]):
+            if timestamp == timestamp:
+                yield unpack(key), timestamp
+
+
+class ColumnView(MutableMapping):
+    """
+    Dictionary-like view of one timestamp column of a ColumnStore
+    """
+    def __init__(self, store, column):
+        self.store = store
+        self.column = column
+
+    def __getitem__(self, item):
+        timestamp = self.get(item)
+        if timestamp is None:
+            raise KeyError(item)
+        return timestamp
+
+    def get(self, item, default=None):
+        try:
+            timestamp = self.store.get(self.column, item)
+        except (ValueError, TypeError):
+            return default
+        return default if timestamp is None else timestamp
+
+    def __contains__(self, item):
+        return self.get(item) is not None
+
+    def __setitem__(self, item, timestamp):
+        self.store.set(self.column, item, timestamp)
+
+    def __delitem__(self, item):
+        self.store.delete(self.column, item)
+
+    def __iter__(self):
+        return (item for item, _ in self.store.items(self.column))
+
+    def __len__(self):
+        return self.store.sizes[self.column]
+
+    def merge(self, items, timestamps):
+        return self.store.merge(self.column, items, timestamps)
+
+    def items(self):
+        return self.store.items(self.column)
+
+    def values(self):
+        return (timestamp for _, timestamp in self.store.items(self.column))
@@ -0,0 +1,450 @@
+"""
+Internal gateway <-> worker transports. The stream transport carries length-prefixed frames of any size over one
+persistent TCP loopback connection, or a Unix domain socket when the address is a filesystem path. The datagram
+transport is the original single UDP datagram per message, limited to Config.BUFFER_SIZE bytes.
+
+Every message carries a request id which the worker echoes in its reply, so a client can keep many requests in
+flight on one connection and match the replies to them in whatever order they arrive.
+
+A message is a JSON object, optionally followed by a newline and raw bytes, e.g. the binary merge payload of
+graph_crdt.codec, which then travels as it is rather than in base64 within the JSON.
+"""
+import os
+import json
+import socket
+import struct
+import asyncio
+import selectors
+import itertools
+from collections import deque
+from graph_crdt.config import Config
+
+_header = struct.Struct("!IQ")
+_request_id = struct.Struct("!Q")
+
+
+def _family(address):
+    return socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+
+
+def pack_message(data, attachment=None):
+    """
+    :param data: JSON serializable dictionary
+    :param attachment: bytes sent along as they are, None for none
+    :return: message bytes
+    """
+    message = json.dumps(data).encode()
+    if attachment is None:
+        return message
+
+    # json.dumps escapes the newlines within strings, so the first one ends the JSON
+    return b"\n".join((message, attachment))
+
+
+def unpack_message(message):
+    """
+    :param message: message bytes
+    :return: decoded dictionary and the attached bytes, None if there are none
+    """
+    end = message.find(b"\n")
+    if end < 0:
+        return json.loads(message), None
+
+    return json.loads(message[:end]), message[end + 1:] or None
+
+
+def pack_frame(payload, request_id):
+    return _header.pack(len(payload), request_id) + payload
+
+
+def send_frame(sock, payload, request_id):
+    # one write per frame, a separate header write would cost an extra segment with TCP_NODELAY
+    sock.sendall(pack_frame(payload, request_id))
+
+
+def read_frame(reader):
+    """
+    Read one frame from a buffered socket file, which usually takes a single recv for header and body together
+    :return: payload and request id
+    """
+    header = reader.read(_header.size)
+    if len(header) < _header.size:
+        raise ConnectionError("Connection closed by peer")
+
+    size, request_id = _header.unpack(header)
+    payload = reader.read(size)
+    if len(payload) < size:
+        raise ConnectionError("Connection closed by peer")
+
+    return payload, request_id
+
+
+class StreamClient:
+    """
+    Blocking client with one request in flight at a time
+    """
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.reader = None
+        self.ids = itertools.count(1)
+
+    def connect(self):
+        self.sock = socket.socket(_family(self.address), socket.SOCK_STREAM)
+        self.sock.connect(self.address)
+        if self.sock.family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb", buffering=Config.STREAM_CHUNK_SIZE)
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+            self.reader = None
+
+    def request(self, payload):
+        """
+        Send one message and wait for its reply, reconnecting once if the persistent connection was dropped
+        :param payload: bytes
+        :return: reply bytes
+        """
+        request_id = next(self.ids)
+        for attempt in range(2):
+            try:
+                if self.sock is None:
+                    self.connect()
+                send_frame(self.sock, payload, request_id)
+                while True:
+                    reply, reply_id = read_frame(self.reader)
+                    if reply_id == request_id:
+                        return reply
+            except (ConnectionError, BrokenPipeError):
+                self.close()
+                if attempt == 1:
+                    raise
+
+
+class DatagramClient:
+    def __init__(self, address):
+        self.address = address
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.ids = itertools.count(1)
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, payload):
+        request_id = next(self.ids)
+        self.sock.sendto(_request_id.pack(request_id) + payload, self.address)
+        while True:
+            reply = self.sock.recvfrom(Config.BUFFER_SIZE)[0]
+            if _request_id.unpack_from(reply)[0] == request_id:
+                return reply[_request_id.size:]
+
+
+class AsyncClient:
+    """
+    Asyncio client multiplexing any number of concurrent requests: each request registers a future under its id in
+    the pending table, and the replies resolve these futures as they come in
+    """
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self.timeout = timeout or Config.RPC_TIMEOUT
+        self.ids = itertools.count(1)
+        self.pending = dict()
+        self.connecting = None
+
+    async def open(self):
+        raise NotImplementedError
+
+    def connected(self):
+        raise NotImplementedError
+
+    def write(self, payload, request_id):
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def resolve(self, reply, request_id):
+        future = self.pending.pop(request_id, None)
+        # replies to requests that have timed out in the meantime are dropped
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    def fail(self, exc):
+        pending, self.pending = self.pending, dict()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(exc)
+
+    async def ensure_connected(self):
+        if self.connected():
+            return
+
+        # concurrent requests share one connection attempt
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self.open())
+        connecting = self.connecting
+        try:
+            await asyncio.shield(connecting)
+        finally:
+            if self.connecting is connecting:
+                self.connecting = None
+
+    async def request(self, payload, timeout=None):
+        """
+        Send one message and wait for its reply
+        :param payload: bytes
+        :param timeout: seconds, defaults to the client timeout
+        :return: reply bytes, raise asyncio.TimeoutError if the worker did not answer in time
+        """
+        await self.ensure_connected()
+
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.write(payload, request_id)
+            return await asyncio.wait_for(future, timeout or self.timeout)
+        finally:
+            self.pending.pop(request_id, None)
+
+
+class AsyncStreamClient(AsyncClient):
+    def __init__(self, address, timeout=None):
+        super().__init__(address, timeout)
+        self.writer = None
+        self.reading = None
+
+    async def open(self):
+        if isinstance(self.address, str):
+            reader, self.writer = await asyncio.open_unix_connection(self.address)
+        else:
+            reader, self.writer = await asyncio.open_connection(*self.address)
+            self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reading = asyncio.ensure_future(self.read_replies(reader))
+
+    def connected(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    def write(self, payload, request_id):
+        self.writer.write(pack_frame(payload, request_id))
+
+    async def read_replies(self, reader):
+        try:
+            while True:
+                size, request_id = _header.unpack(await reader.readexactly(_header.size))
+                self.resolve(await reader.readexactly(size), request_id)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            self.close()
+            self.fail(ConnectionError(f"Connection to worker {self.address} lost: {e!r}"))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        self.client.resolve(data[_request_id.size:], _request_id.unpack_from(data)[0])
+
+
+class AsyncDatagramClient(AsyncClient):
+    def __init__(self, address, timeout=None):
+        super().__init__(address, timeout)
+        self.endpoint = None
+
+    async def open(self):
+        self.endpoint, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _DatagramProtocol(self), remote_addr=self.address)
+
+    def connected(self):
+        return self.endpoint is not None and not self.endpoint.is_closing()
+
+    def write(self, payload, request_id):
+        self.endpoint.sendto(_request_id.pack(request_id) + payload)
+
+    def close(self):
+        if self.endpoint is not None:
+            self.endpoint.close()
+            self.endpoint = None
+
+
+class Server:
+    """
+    Base of the worker-side transports. Besides incoming messages, the worker loop also runs the callbacks that
+    other threads hand over with call_soon, so their results are applied on the thread owning the database.
+    """
+    def __init__(self, address):
+        self.address = address
+        self.selector = selectors.DefaultSelector()
+        self.callbacks = deque()
+        self.waker, self.wakeup_sock = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakeup_sock.setblocking(False)
+        self.selector.register(self.waker, selectors.EVENT_READ)
+
+    def call_soon(self, callback):
+        """
+        Thread-safe: run the callback on the worker loop as soon as possible
+        :param callback: function without arguments
+        :return:
+        """
+        self.callbacks.append(callback)
+        try:
+            self.wakeup_sock.send(b"\0")
+        except BlockingIOError:
+            # the wakeup buffer is full, so the loop is about to wake up anyway
+            pass
+
+    def run_callbacks(self):
+        try:
+            while self.waker.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        while self.callbacks:
+            self.callbacks.popleft()()
+
+    def close(self):
+        self.selector.close()
+        self.waker.close()
+        self.wakeup_sock.close()
+
+
+class StreamServer(Server):
+    """
+    Accept any number of persistent connections and hand out complete frames one at a time
+    """
+    def __init__(self, address):
+        super().__init__(address)
+        self.sock = socket.socket(_family(address), socket.SOCK_STREAM)
+        self.buffers = dict()
+        self.frames = deque()
+
+    def bind(self):
+        if self.sock.family == socket.AF_INET:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif os.path.exists(self.address):
+            # stale socket file left behind by a previous worker
+            os.unlink(self.address)
+        self.sock.bind(self.address)
+        self.sock.listen()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def close(self):
+        for conn in list(self.buffers):
+            self.drop(conn)
+        self.sock.close()
+        super().close()
+
+    def drop(self, conn):
+        self.selector.unregister(conn)
+        self.buffers.pop(conn)
+        conn.close()
+
+    def recv(self):
+        """
+        Block until a complete frame has arrived on any connection, running the callbacks handed over meanwhile
+        :return: frame bytes and the (connection, request id) to reply to
+        """
+        while not self.frames:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.waker:
+                    self.run_callbacks()
+                    continue
+
+                if key.fileobj is self.sock:
+                    conn, _ = self.sock.accept()
+                    if conn.family == socket.AF_INET:
+                        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.selector.register(conn, selectors.EVENT_READ)
+                    self.buffers[conn] = bytearray()
+                    continue
+
+                conn = key.fileobj
+                try:
+                    data = conn.recv(Config.STREAM_CHUNK_SIZE)
+                except ConnectionError:
+                    data = b""
+                if not data:
+                    self.drop(conn)
+                    continue
+
+                buffer = self.buffers[conn]
+                buffer.extend(data)
+                start = 0
+                while len(buffer) - start >= _header.size:
+                    size, request_id = _header.unpack_from(buffer, start)
+                    if len(buffer) - start - _header.size < size:
+                        break
+                    start = start + _header.size
+                    self.frames.append((bytes(buffer[start: start + size]), (conn, request_id)))
+                    start = start + size
+                del buffer[:start]
+
+        return self.frames.popleft()
+
+    def pending(self):
+        return bool(self.frames)
+
+    def send(self, payload, address):
+        conn, request_id = address
+        try:
+            send_frame(conn, payload, request_id)
+        except (ConnectionError, BrokenPipeError, OSError):
+            if conn in self.buffers:
+                self.drop(conn)
+
+
+class DatagramServer(Server):
+    def __init__(self, address):
+        super().__init__(address)
+        self.sock = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+
+    def bind(self):
+        self.sock.bind(self.address)
+        self.selector.register(self.sock, selectors.EVENT_READ)
+
+    def close(self):
+        self.sock.close()
+        super().close()
+
+    def recv(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.fileobj is self.waker:
+                    self.run_callbacks()
+                    continue
+
+                data, address = self.sock.recvfrom(Config.BUFFER_SIZE)
+                return data[_request_id.size:], (address, _request_id.unpack_from(data)[0])
+
+    def pending(self):
+        return False
+
+    def send(self, payload, address):
+        address, request_id = address
+        self.sock.sendto(_request_id.pack(request_id) + payload, address)
+
+
+def make_client(address, transport=None):
+    transport = transport or Config.TRANSPORT
+    return DatagramClient(address) if transport == "udp" else StreamClient(address)
+
+
+def make_async_client(address, transport=None, timeout=None):
+    transport = transport or Config.TRANSPORT
+    return AsyncDatagramClient(address, timeout) if transport == "udp" else AsyncStreamClient(address, timeout)
+
+
+def make_server(address, transport=None):
+    transport = transport or Config.TRANSPORT
+    return DatagramServer(address) if transport == "udp" else StreamServer(address)
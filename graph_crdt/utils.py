@@ -1,6 +1,7 @@
 import time
 import logging
 import sys
+from functools import wraps
 
 
 def get_logger(logger_name='default'):
@@ -24,15 +25,15 @@ def get_logger(logger_name='default'):
 
 def timer(func, *args, **kwargs):
     """
-    Timer decorator
+    Timer decorator, logs how long each call takes. See graph_crdt.metrics for the latencies kept in production
     """
     log = get_logger(logger_name='Timer')
 
+    @wraps(func)
     def wrapper(*args, **kwargs):
-        before = time.time()
-        print(args)
+        before = time.perf_counter()
         rv = func(*args, **kwargs)
-        after = time.time()
+        after = time.perf_counter()
         log.info(f'{func.__name__} took {round(after - before, 5)}s for execution.')
         return rv
 
@@ -0,0 +1,212 @@
+"""
+Crash recovery of a replica: a write-ahead log of the LWW entries that changed, plus compact snapshots of the whole
+state, both in the binary format of graph_crdt.codec.
+
+    wal.log       := block*
+    block         := payload length (uint32) | crc32 of the payload (uint32) | payload in the codec format
+    snapshot.gcrd := codec payload of the four LWW tables
+
+Changes are buffered and written as one block per group commit. Since LWW merges are idempotent and only ever keep
+the largest timestamp, recovery simply merges the snapshot and then every intact block of the log, and a snapshot
+taken right before a crash may overlap with the log without harm. Entries freed because another one dominates them
+are not logged: they do not change the resolved state.
+"""
+import os
+import mmap
+import time
+import zlib
+import struct
+from graph_crdt import codec
+from graph_crdt.config import Config
+from graph_crdt.utils import get_logger
+
+logger = get_logger("WAL")
+
+_block = struct.Struct("<II")
+
+
+class WriteAheadLog:
+    def __init__(self, path, fsync=Config.WAL_FSYNC):
+        self.path = path
+        self.fsync = fsync
+        self.buffer = [dict() for _ in codec.TABLES]
+        self.file = None
+
+    def open(self):
+        self.file = open(self.path, "ab")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def size(self):
+        return self.file.tell() if self.file is not None else 0
+
+    def record(self, table, changes):
+        """
+        LWWSet observer: buffer the new timestamps until the next commit
+        :return:
+        """
+        buffer = self.buffer[codec.TABLES.index(table)]
+        for item, _, new_timestamp in changes:
+            if new_timestamp is not None:
+                buffer[item] = new_timestamp
+
+    def pending(self):
+        return any(self.buffer)
+
+    def commit(self):
+        """
+        Write all buffered changes as one block and flush it to disk
+        :return: number of bytes written
+        """
+        if not self.pending():
+            return 0
+
+        buffer, self.buffer = self.buffer, [dict() for _ in codec.TABLES]
+        try:
+            payload = codec.encode(*buffer)
+        except struct.error as e:
+            logger.error(f"Could not log changes, ids outside of the int64 range are not persisted: {e}")
+            return 0
+
+        self.file.write(_block.pack(len(payload), zlib.crc32(payload)) + payload)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+        return _block.size + len(payload)
+
+    def reset(self):
+        """
+        Start an empty log once its content is covered by a snapshot
+        :return:
+        """
+        self.close()
+        self.file = open(self.path, "wb")
+        if self.fsync:
+            os.fsync(self.file.fileno())
+
+    @staticmethod
+    def replay(path):
+        """
+        Read back all intact blocks, cutting off a block torn by a crash in the middle of a commit
+        :param path:
+        :return: merged tables (vertices_added, vertices_removed, edges_added, edges_removed), number of blocks
+        """
+        tables = [dict() for _ in codec.TABLES]
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return tuple(tables), 0
+
+        blocks, offset = 0, 0
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            while offset + _block.size <= len(data):
+                size, crc = _block.unpack_from(data, offset)
+                payload = data[offset + _block.size: offset + _block.size + size]
+                if len(payload) < size or zlib.crc32(payload) != crc:
+                    break
+
+                for table, block in zip(tables, codec.decode(payload)):
+                    merge_max(table, block)
+                offset = offset + _block.size + size
+                blocks = blocks + 1
+
+            torn = offset < len(data)
+
+        if torn:
+            logger.warning(f"Dropping {os.path.getsize(path) - offset} bytes of a torn block at the end of {path}")
+            with open(path, "r+b") as f:
+                f.truncate(offset)
+
+        return tuple(tables), blocks
+
+
+def merge_max(table, block):
+    for item, timestamp in block.items():
+        if table.get(item, timestamp) <= timestamp:
+            table[item] = timestamp
+
+
+class Checkpointer:
+    """
+    Keep a replica recoverable from its data directory: log every change, and take a snapshot then truncate the log
+    once it has grown past Config.SNAPSHOT_WAL_BYTES, or when it is not empty and the last snapshot is older than
+    Config.SNAPSHOT_INTERVAL seconds
+    """
+    def __init__(self, directory, database, fsync=Config.WAL_FSYNC):
+        self.directory = directory
+        self.database = database
+        self.fsync = fsync
+        self.snapshot_path = os.path.join(directory, "snapshot.gcrd")
+        self.wal = WriteAheadLog(os.path.join(directory, "wal.log"), fsync)
+        self.last_snapshot = time.monotonic()
+
+    def recover(self):
+        """
+        Load the latest snapshot and replay the log on top of it, then start logging new changes
+        :return: number of entries restored
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        start = time.perf_counter()
+
+        tables = tuple(dict() for _ in codec.TABLES)
+        if os.path.exists(self.snapshot_path) and os.path.getsize(self.snapshot_path) > 0:
+            with open(self.snapshot_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                tables = codec.decode(data)
+
+        # fold the log into the snapshot first, so that every entry is merged (and hashed) only once
+        log, blocks = WriteAheadLog.replay(self.wal.path)
+        for table, changes in zip(tables, log):
+            merge_max(table, changes)
+        restored = self.database.restore(tables)
+
+        self.wal.open()
+        self.database.vertices.observers.append(self.wal.record)
+        self.database.edges.observers.append(self.wal.record)
+        logger.info(f"Recovered {restored} entries from {self.directory} ({blocks} log blocks) "
+                    f"in {time.perf_counter() - start:.3f}s")
+        return restored
+
+    def commit(self):
+        written = self.wal.commit()
+        if self.wal.size() > Config.SNAPSHOT_WAL_BYTES or \
+                (self.wal.size() > 0 and time.monotonic() - self.last_snapshot > Config.SNAPSHOT_INTERVAL):
+            self.snapshot()
+
+        return written
+
+    def snapshot(self):
+        """
+        Atomically replace the snapshot with the current state, then truncate the log it covers
+        :return:
+        """
+        self.wal.commit()
+        start = time.perf_counter()
+        try:
+            payload = codec.encode(*self.database.state())
+        except struct.error as e:
+            logger.error(f"Could not take a snapshot, ids outside of the int64 range are not persisted: {e}")
+            return
+
+        path = f"{self.snapshot_path}.tmp"
+        with open(path, "wb") as f:
+            f.write(payload)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(path, self.snapshot_path)
+        if self.fsync:
+            directory = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+
+        self.wal.reset()
+        self.last_snapshot = time.monotonic()
+        logger.info(f"Took a {len(payload)} bytes snapshot in {time.perf_counter() - start:.3f}s")
+
+    def close(self):
+        self.wal.commit()
+        self.wal.close()
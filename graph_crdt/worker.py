@@ -1,215 +1,708 @@
 import json
-import socket
-import requests
+import time
+import base64
+import struct
+import threading
+from functools import partial
+from graph_crdt import codec
 from graph_crdt.config import Config
 from graph_crdt.utils import get_logger
 from graph_crdt.graph import database_instance
+from graph_crdt.merkle import check_buckets, descend
+from graph_crdt.fanout import Fanout
+from graph_crdt.network import message_size
+from graph_crdt.cache import ReadCache
+from graph_crdt.wal import Checkpointer
+from graph_crdt.bootstrap import BootstrapSessions, read_frames
+from graph_crdt.gossip import GossipMetrics, check_message, decode_tables, encode_tables, payload_size
+from graph_crdt.transport import make_server, unpack_message
+from graph_crdt.metrics import COUNT_BUCKETS, SIZE_BUCKETS, MetricsRegistry
 
 logger = get_logger("Worker")
 
 
 class DatabaseWorker:
-    def __init__(self, socket_internal):
+    def __init__(self, socket_internal, database=None, transport=None, data_dir=None, network=None, server=None,
+                 address=None):
+        """
+        :param socket_internal: address to serve the gateway on
+        :param database: CRDTGraph, defaults to the module instance
+        :param transport: "tcp" or "udp", defaults to Config.TRANSPORT
+        :param data_dir: directory of the write-ahead log and snapshots, None to keep the database in memory only
+        :param network: graph_crdt.network.Network carrying the requests to friends, HTTP through the fan-out pool
+                        if None
+        :param server: transport serving the gateway, made from socket_internal and transport if None
+        :param address: address of the replica on the network, the source of its requests
+        """
         self.socket_internal = socket_internal
-        self.bufferSize = Config.BUFFER_SIZE
-        self.UDPServerSocket = socket.socket(family=socket.AF_INET, type=socket.SOCK_DGRAM)
+        self.database = database if database is not None else database_instance
+        self.server = server if server is not None else make_server(socket_internal, transport)
+        self.metrics = MetricsRegistry()
+        self.fanout = Fanout(self.server.call_soon, metrics=self.metrics)
+        self.network = network if network is not None else self.fanout
+        self.address = address
+        self.checkpointer = Checkpointer(data_dir, self.database) if data_dir is not None else None
+        self.replies = list()
+        self.peer_encodings = dict()
+        self.bootstrap_sessions = BootstrapSessions()
+        self.gossip_acks = dict()
+        self.gossip_metrics = GossipMetrics()
+        self.gossip_metrics.track(self.database)
+        self.read_cache = ReadCache()
+        self.query_seconds = self.metrics.histogram("worker_query_seconds", "Time the worker spends handling a query",
+                                                    ("query", ))
+        self.merge_bytes = self.metrics.histogram("worker_merge_payload_bytes", "Size of the merged payloads",
+                                                  ("source", ), buckets=SIZE_BUCKETS)
+        self.merge_changed = self.metrics.histogram("worker_merge_entries_changed",
+                                                    "Entries of a merge that changed the local state", ("source", ),
+                                                    buckets=COUNT_BUCKETS)
+        self.lww_entries = self.metrics.gauge("worker_lww_entries",
+                                              "Entries of the LWW sets, the removed side holds the tombstones",
+                                              ("set", "side"))
+        self.graph_version = self.metrics.gauge("worker_graph_version", "Version of the graph, see CRDTGraph.changed")
+        self.metrics.collector(self.collect_graph)
+
+    def collect_graph(self):
+        for lww in (self.database.vertices, self.database.edges):
+            self.lww_entries.labels(lww.name, "added").set(len(lww.added))
+            self.lww_entries.labels(lww.name, "removed").set(len(lww.removed))
+        self.graph_version.set(self.database.version)
+
+    def merged(self, source, size, changed):
+        self.merge_bytes.labels(source).observe(size)
+        self.merge_changed.labels(source).observe(changed)
 
     def response(self, res, address):
         msg = json.dumps(res)
         msg = str.encode(msg)
-        self.UDPServerSocket.sendto(msg, address)
+        self.replies.append((msg, address))
+
+    def flush(self):
+        """
+        Group commit: log the changes of all the queries handled since the last flush at once, then send their replies
+        :return:
+        """
+        if self.checkpointer is not None:
+            self.checkpointer.commit()
+
+        for msg, address in self.replies:
+            self.server.send(msg, address)
+        self.replies.clear()
+
+    def post(self, friend, path, message, callback=None):
+        """
+        Send a request to a friend through the network, see graph_crdt.network.Network.post
+        :param callback: function of the reply and the error, called on the worker loop
+        :return:
+        """
+        self.network.post(self.address, friend, path, message, callback or (lambda reply, error: None),
+                          timeout=Config.REQUEST_TIMEOUT)
+
+    def post_merge(self, friend, tables, uuid, from_addr, payloads, callback):
+        """
+        Send LWW tables to a friend's merge endpoint in the best encoding it supports: binary if its status endpoint
+        advertises our format version, JSON otherwise. The encoding is asked for on the first merge to the friend.
+        :param friend: friend address
+        :param tables: vertices_added, vertices_removed, edges_added, edges_removed
+        :param uuid: merge uuid
+        :param from_addr: sender address
+        :param payloads: already encoded payloads by encoding, shared between the friends of one merge
+        :param callback: function of the reply of the friend and the error
+        :return:
+        """
+        if friend in self.peer_encodings:
+            self.send_merge(friend, tables, uuid, from_addr, payloads, callback)
+            return
+
+        def negotiated(reply, error):
+            if error is None:
+                encodings = reply.get("encodings", [])
+                self.peer_encodings[friend] = codec.ENCODING if codec.ENCODING in encodings else codec.JSON_ENCODING
+            else:
+                # JSON for now, asked again with the next merge
+                logger.info(f"Could not get the encodings of {friend}: {error}")
+            self.send_merge(friend, tables, uuid, from_addr, payloads, callback)
+
+        self.post(friend, "/", dict(), negotiated)
+
+    def send_merge(self, friend, tables, uuid, from_addr, payloads, callback):
+        encoding = self.peer_encodings.get(friend, codec.JSON_ENCODING)
+        if encoding == codec.ENCODING and encoding not in payloads:
+            try:
+                payloads[encoding] = self.database.encode(tables, encoding)
+            except struct.error:
+                # ids outside of the int64 range can only travel as JSON
+                payloads[encoding] = None
+
+        if encoding == codec.ENCODING and payloads[encoding] is not None:
+            self.post(friend, "/merge/binary", {"uuid": uuid, "from_addr": from_addr, "payload": payloads[encoding]},
+                      callback)
+            return
+
+        if codec.JSON_ENCODING not in payloads:
+            payloads[codec.JSON_ENCODING] = self.database.encode(tables, codec.JSON_ENCODING)
+
+        self.post(friend, "/merge", dict(payloads[codec.JSON_ENCODING], uuid=uuid, from_addr=from_addr), callback)
+
+    def forwarded(self, reply, error, friend, uuid):
+        if error is not None:
+            logger.info(f"Request timeout {friend}/merge with uuid {uuid}: {error}")
+        else:
+            logger.info(f"Broadcasted merge request to {friend}: {reply}")
+
+    def broadcasted(self, reply, error, friend, sequence, full_state, uuid, address):
+        """
+        Acknowledge a delta once the friend has merged it and answer the gateway, runs on the worker loop
+        :param reply: reply of the friend, None if the request failed
+        :param error: error of a failed request
+        :return:
+        """
+        if error is None and "status" in reply:
+            res = {
+                "status": reply["status"]
+            }
+            # a duplicated uuid means the friend got another peer's delta rather than this one
+            if reply["status"] == "Success" and reply["data"] == "True":
+                self.database.acknowledge(friend, sequence)
+            else:
+                self.database.reached(friend)
+            logger.info(f"Sent {'full state' if full_state else 'delta'} up to change {sequence} to {friend}")
+        else:
+            logger.info(f"Request timeout {friend}/merge with uuid {uuid}: {error}")
+            self.unreachable(friend)
+            res = {
+                "status": "Error"
+            }
+
+        self.response(res, address)
+        self.flush()
+        logger.info("Broadcasted")
+
+    def unreachable(self, friend):
+        if self.database.unreachable(friend):
+            logger.info(f"{friend} expired after {self.database.delta_tracker.expiry} failed syncs in a row")
+
+    def bootstrap(self, friend):
+        """
+        Stream the state of a friend and merge it chunk by chunk, runs on the fan-out pool while the worker loop
+        keeps serving queries and live merges. At most Config.BOOTSTRAP_WINDOW chunks wait to be merged at a time.
+        :param friend: friend address
+        :return:
+        """
+        window = threading.Semaphore(Config.BOOTSTRAP_WINDOW)
+        chunks, entries = 0, 0
+        try:
+            response = self.fanout.session(friend).get(f"{friend}/bootstrap", stream=True,
+                                                       timeout=Config.RPC_TIMEOUT)
+            response.raise_for_status()
+            for payload in read_frames(response.raw):
+                tables = codec.decode(payload)
+                window.acquire()
+                self.server.call_soon(partial(self.apply_bootstrap_chunk, tables, window))
+                chunks, entries = chunks + 1, entries + sum(len(table) for table in tables)
+            logger.info(f"Bootstrapped {entries} entries in {chunks} chunks from {friend}")
+        except Exception as e:
+            logger.exception(e)
+            logger.info(f"Bootstrap from {friend} failed after {entries} entries")
+
+    def apply_bootstrap_chunk(self, tables, window):
+        try:
+            self.database.merge_tables(*tables)
+        finally:
+            window.release()
+        self.flush()
+
+    def gossiped(self, reply, error, peer, data, sequence, exchanges):
+        """
+        Merge the delta pulled from a gossip peer and record the acknowledgements of both sides, runs on the worker
+        loop. The gateway gets its answer once every exchange of the round is over.
+        :param reply: reply of the peer, see graph_crdt.gossip
+        :param error: error of a failed request
+        :param data: message pushed to the peer
+        :param exchanges: dictionary with the gateway address and the number of exchanges of the round still running
+        :return:
+        """
+        metrics = self.gossip_metrics
+        exchanges["pending"] = exchanges["pending"] - 1
+        if exchanges["pending"] == 0:
+            self.response({"status": "Success", "data": exchanges["peers"]}, exchanges["address"])
+
+        if error is None and reply.get("status") != "Success":
+            error = ConnectionError(f"Gossip with {peer} failed: {reply}")
+        if error is not None:
+            logger.info(f"Gossip with {peer} failed: {error}")
+            self.unreachable(peer)
+            metrics.failures = metrics.failures + 1
+            self.flush()
+            return
+
+        try:
+            reply = reply["data"]
+            if not isinstance(reply, dict) or not isinstance(reply.get("sequence"), int) or \
+                    not isinstance(reply.get("ack"), (int, type(None))):
+                raise ValueError(f"Invalid reply {reply}")
+            with metrics.merging():
+                changed = self.database.merge_tables(*decode_tables(reply))
+        except (KeyError, ValueError) as e:
+            logger.info(f"Could not merge the gossip reply of {peer}: {e}")
+            metrics.failures = metrics.failures + 1
+            self.flush()
+            return
+        self.merged("gossip", payload_size(reply), changed)
+        self.database.acknowledge(peer, reply["ack"])
+        self.gossip_acks[peer] = reply["sequence"]
+        metrics.exchanges = metrics.exchanges + 1
+        metrics.sent(payload_size(data))
+        metrics.received(payload_size(reply))
+
+        self.flush()
+        logger.info(f"Gossiped with {peer} up to change {sequence}, {changed} entries changed")
+
+    def forward_register(self, message):
+        """
+        Let a friend know about a newcomer
+        :return:
+        """
+        def registered(reply, error):
+            f, t, d = message["from"], message["to"], message["data"]
+            logger.info(f"Broadcasted from {f} to {t} with {d}: {reply['status'] if error is None else error}")
+
+        self.post(message["to"], "/register", {"their_address": message["data"], "my_address": message["from"]},
+                  registered)
+
+    def anti_entropy(self, friend, address, level=0, nodes=(0, ), exchanged=0):
+        """
+        Compare Merkle digests with a friend one tree level at a time and exchange only the entries of the buckets
+        that differ, address gets the number of differing buckets and of bytes exchanged once the walk is over
+        :param friend: friend address
+        :param address: address of the anti-entropy query
+        :param level: tree level to compare
+        :param nodes: node indices within the level
+        :param exchanged: bytes exchanged so far
+        :return:
+        """
+        message = {"level": level, "nodes": json.dumps(list(nodes))}
+        self.post(friend, "/digest", message,
+                  partial(self.digested, friend=friend, address=address, level=level, nodes=list(nodes),
+                          exchanged=exchanged + message_size(message)))
+
+    def digested(self, reply, error, friend, address, level, nodes, exchanged):
+        """
+        Compare the digests of a friend with ours and go down a level, or exchange the differing buckets, runs on
+        the worker loop
+        :return:
+        """
+        try:
+            if error is not None:
+                raise error
+            buckets, children = descend(self.database.merkle, level, nodes, reply["data"])
+        except Exception as e:
+            self.anti_entropy_failed(e, friend, address)
+            return
+
+        exchanged = exchanged + message_size(reply)
+        if buckets is None:
+            self.anti_entropy(friend, address, level + 1, children, exchanged)
+        elif not buckets:
+            self.anti_entropy_done(friend, address, buckets, exchanged)
+        else:
+            data = self.database.bucket_entries(buckets)
+            data["buckets"] = json.dumps(buckets)
+            self.post(friend, "/digest/entries", data,
+                      partial(self.buckets_exchanged, friend=friend, address=address, buckets=buckets,
+                              exchanged=exchanged + message_size(data)))
+
+    def buckets_exchanged(self, reply, error, friend, address, buckets, exchanged):
+        """
+        Merge the entries a friend sent back for the differing buckets, runs on the worker loop
+        :return:
+        """
+        try:
+            if error is not None:
+                raise error
+            data = reply["data"]
+            self.database.merge(data["vertices_added"], data["vertices_removed"], data["edges_added"],
+                                data["edges_removed"])
+        except Exception as e:
+            self.anti_entropy_failed(e, friend, address)
+            return
+
+        self.anti_entropy_done(friend, address, buckets, exchanged + message_size(reply))
+
+    def anti_entropy_done(self, friend, address, buckets, exchanged):
+        res = {
+            "status": "Success",
+            "data": {
+                "buckets": len(buckets),
+                "bytes": exchanged
+            }
+        }
+        self.response(res, address)
+        self.flush()
+        logger.info(f"Anti-entropy with {friend}: {res['data']}")
+
+    def anti_entropy_failed(self, error, friend, address):
+        logger.info(f"Anti-entropy with {friend} failed: {error}")
+        self.response({"status": "Error", "data": {}}, address)
+        self.flush()
 
     def execute(self):
-        self.UDPServerSocket.bind(self.socket_internal)
+        if self.checkpointer is not None:
+            self.checkpointer.recover()
+        self.server.bind()
 
         logger.info(f"Broadcaster listening at {self.socket_internal}")
         msg = "Copy! I am on the way"
         while True:
-            bytes_address_pair = self.UDPServerSocket.recvfrom(self.bufferSize)
-            message, address = bytes_address_pair
-
-            message = message.decode("utf-8")
-            message = json.loads(message)
-
-            if message["query"] == "merge":
-                database_instance.merge(message["vertices_added"], message["vertices_removed"], message["edges_added"],
-                                        message["edges_removed"])
-                self.response({"data": f"Successfully merged!"}, address)
-
-                friends = message["friend_list"]
-                logger.info(friends)
-                logger.debug(message)
-                for friend in friends:
-                    if friend == message["your_address"] or friend == message["from_addr"]:
-                        continue
-
-                    data = {
-                        "uuid": message["uuid"],
-                        "from_addr": message["your_address"],
-                        "vertices_added": message["vertices_added"],
-                        "vertices_removed": message["vertices_removed"],
-                        "edges_added": message["edges_added"],
-                        "edges_removed": message["edges_removed"]
-                    }
-
-                    uuid = message["uuid"]
-                    try:
-                        logger.debug(f"Broadcasting merge request to {friend} with uuid: {uuid}")
-                        response = requests.post(f"{friend}/merge", data=data, timeout=Config.REQUEST_TIMEOUT)
-                        logger.info(f"Broadcasted merge request to {friend}: {response.json()}")
-                    except Exception as e:
-                        logger.exception(e)
-                        logger.info(f"Request timeout {friend}/merge with uuid: {uuid}")
-                logger.info("Successfully merged!")
-            elif message["query"] == "set_dir":
-                database_instance.set_dir(bool(message["dir"]))
-                res = {
-                    "data": "Success"
-                }
-                self.response(res, address)
-                logger.info("Successfully set direction")
-            elif message["query"] == "broadcast":
-                data = database_instance.broadcast()
-                data["uuid"] = message["uuid"]
-                data["from_addr"] = message["from_addr"]
-
-                friend = message["to"]
-                try:
-                    response = requests.post(f"{friend}/merge", data=data, timeout=Config.REQUEST_TIMEOUT)
-
-                    res = {
-                        "status": response.json()["status"]
-                    }
-                except Exception as e:
-                    logger.exception(e)
-                    uuid = message["uuid"]
-                    logger.info(f"Request timeout {friend}/merge with uuid {uuid}")
-                    res = {
-                        "status": "Error"
-                    }
-
-                self.response(res, address)
-                logger.info("Broadcasted")
-            elif message["query"] == "add_vertex":
-                u = int(message["u"])
-                status, _ = database_instance.add_vertex(u)
-                res = {
-                    "status": status,
-                    "_": _
-                }
-
-                self.response(res, address)
-                logger.info(f"Successfully added vertex {u}")
-            elif message["query"] == "add_edge":
-                u = int(message["u"])
-                v = int(message["v"])
-
-                status, _ = database_instance.add_edge(u, v)
-                res = {
-                    "status": status,
-                    "_": _
-                }
-
-                self.response(res, address)
-                logger.info(f"Successfully added edge {u} - {v}")
-            elif message["query"] == "remove_vertex":
-                u = int(message["u"])
-                status = database_instance.remove_vertex(u)
-
-                res = {
-                    "status": status
-                }
-
-                self.response(res, address)
-                logger.info(f"Successfully removed vertex {u}")
-            elif message["query"] == "remove_edge":
-                u = int(message["u"])
-                v = int(message["v"])
-
-                status = database_instance.remove_edge(u, v)
-                res = {
-                    "status": status
-                }
-
-                self.response(res, address)
-                logger.info(f"Successfully removed edge {u} - {v}")
-            elif message["query"] == "exists_vertex":
-                u = int(message["u"])
-                _, status = database_instance.contains_vertex(u)
-
+            # reply once all the queries that have already arrived are handled
+            if not self.server.pending():
+                self.flush()
+            message, address = self.server.recv()
+
+            try:
+                message, attachment = unpack_message(message)
+                self.handle(message, address, attachment)
+            except Exception as e:
+                # a malformed query fails on its own instead of taking the loop and every later query down
+                logger.exception(e)
+                self.response({"status": "Error", "data": str(e)}, address)
+
+    def handle(self, message, address, attachment=None):
+        """
+        Answer a query of the gateway, the reply goes out with the next flush
+        :param message: decoded query
+        :param address: where the reply goes, only passed back to the server
+        :param attachment: raw bytes sent along with the query, the payload of a binary merge
+        :return:
+        """
+        started = time.perf_counter()
+
+        if message["query"] == "merge":
+            try:
+                if attachment is not None:
+                    tables = codec.decode(attachment)
+                    payloads = {codec.ENCODING: attachment}
+                else:
+                    tables = self.database.deserialize(message["vertices_added"], message["vertices_removed"],
+                                                       message["edges_added"], message["edges_removed"])
+                    payloads = {codec.JSON_ENCODING: {k: message[k] for k in codec.TABLES}}
+                changed = self.database.merge_tables(*tables)
+            except (KeyError, ValueError) as e:
+                logger.info(f"Rejected merge {message.get('uuid')}: {e}")
+                self.response({"status": "Error", "data": str(e), "changed": 0}, address)
+                return
+
+            self.merged("merge", len(attachment) if attachment is not None else payload_size(message), changed)
+            self.response({"data": f"Successfully merged!", "changed": changed}, address)
+
+            # a merge that changed nothing has already been seen here, so it does not need to travel further
+            friends = message["friend_list"] if changed > 0 else []
+            logger.info(friends)
+            logger.debug(message)
+            for friend in friends:
+                if friend == message["your_address"] or friend == message["from_addr"]:
+                    continue
+
+                self.post_merge(friend, tables, message["uuid"], message["your_address"], payloads,
+                                partial(self.forwarded, friend=friend, uuid=message["uuid"]))
+            logger.info("Successfully merged!")
+        elif message["query"] == "set_dir":
+            self.database.set_dir(bool(message["dir"]))
+            res = {
+                "data": "Success"
+            }
+            self.response(res, address)
+            logger.info("Successfully set direction")
+        elif message["query"] == "broadcast":
+            friend = message["to"]
+            tables, sequence, full_state = self.database.delta_tables(friend)
+            if full_state:
+                # the live tables keep changing while the encodings of the friend are asked for
+                tables = tuple(dict(table.items()) for table in tables)
+
+            self.post_merge(friend, tables, message["uuid"], message["from_addr"], dict(),
+                            partial(self.broadcasted, friend=friend, sequence=sequence, full_state=full_state,
+                                    uuid=message["uuid"], address=address))
+        elif message["query"] == "gossip_round":
+            self.gossip_metrics.rounds = self.gossip_metrics.rounds + 1
+            exchanges = {
+                "address": address,
+                "peers": message["peers"],
+                "pending": len(message["peers"])
+            }
+            if not message["peers"]:
+                self.response({"status": "Success", "data": []}, address)
+
+            for peer in message["peers"]:
+                # push our delta, the reply pulls the peer's, see graph_crdt.gossip
+                tables, sequence, _ = self.database.delta_tables(peer)
+                data = dict(encode_tables(tables), from_addr=message["from_addr"], sequence=sequence,
+                            ack=self.gossip_acks.get(peer))
+                self.post(peer, "/gossip", data,
+                          partial(self.gossiped, peer=peer, data=data, sequence=sequence, exchanges=exchanges))
+            logger.info(f"Started gossip round with {message['peers']}")
+        elif message["query"] == "gossip":
+            try:
+                check_message(message, payload=False)
+                incoming = decode_tables(message)
+            except ValueError as e:
+                logger.info(f"Rejected gossip from {message.get('from_addr')}: {e}")
+                self.response({"status": "Error", "data": str(e)}, address)
+                return
+
+            peer = message["from_addr"]
+            # the reply only goes up to the changes made before merging, the peer is not sent its own entries back
+            tables, sequence, _ = self.database.delta_tables(peer)
+            try:
+                with self.gossip_metrics.merging():
+                    changed = self.database.merge_tables(*incoming)
+            except ValueError as e:
+                logger.info(f"Could not merge the gossip of {peer}: {e}")
+                self.response({"status": "Error", "data": str(e)}, address)
+                return
+            self.merged("gossip", payload_size(message), changed)
+            if message["ack"] is not None:
+                self.database.acknowledge(peer, message["ack"])
+            self.gossip_acks[peer] = message["sequence"]
+
+            res = {
+                "status": "Success",
+                "data": dict(encode_tables(tables), sequence=sequence, ack=message["sequence"])
+            }
+            self.gossip_metrics.received(payload_size(message))
+            self.gossip_metrics.sent(payload_size(res["data"]))
+
+            self.response(res, address)
+            logger.info(f"Gossiped with {peer}, {changed} entries changed")
+        elif message["query"] == "read_cache_stats":
+            self.response({"status": "Success", "data": self.read_cache.stats()}, address)
+        elif message["query"] == "gossip_stats":
+            self.response({"status": "Success", "data": self.gossip_metrics.stats()}, address)
+        elif message["query"] == "bootstrap":
+            self.response({"data": "Success"}, address)
+            self.fanout.submit(self.bootstrap, message["from"])
+        elif message["query"] == "bootstrap_open":
+            session, total = self.bootstrap_sessions.open(self.database)
+            res = {
+                "status": "Success",
+                "session": session,
+                "total": total
+            }
+
+            self.response(res, address)
+            logger.info(f"Opened bootstrap session {session} over {total} entries")
+        elif message["query"] == "bootstrap_chunk":
+            try:
+                payload, done = self.bootstrap_sessions.chunk(message["session"])
                 res = {
-                    "_": _,
-                    "status": status
+                    "status": "Success",
+                    "payload": base64.b64encode(payload).decode(),
+                    "done": done
                 }
-
-                self.response(res, address)
-                logger.info(f"Successfully check exists {u}")
-            elif message["query"] == "exists_edge":
-                u = int(message["u"])
-                v = int(message["v"])
-
-                _, status = database_instance.contains_edge(u, v)
+            except (KeyError, struct.error) as e:
+                logger.exception(e)
                 res = {
-                    "_": _,
-                    "status": status
+                    "status": "Error",
+                    "done": True
                 }
 
-                self.response(res, address)
-                logger.info(f"Successfully check exists {u} - {v}")
-            elif message["query"] == "get_neighbors":
-                u = int(message["u"])
-
-                _, status = database_instance.get_neighbors(u)
+            self.response(res, address)
+        elif message["query"] == "digest":
+            res = {
+                "data": self.database.merkle.digest(int(message["level"]), message["nodes"])
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully returned digest at level {message['level']}")
+        elif message["query"] == "digest_entries":
+            try:
+                check_buckets(message["buckets"])
+                tables = self.database.deserialize(message["vertices_added"], message["vertices_removed"],
+                                                   message["edges_added"], message["edges_removed"])
+            except (KeyError, ValueError) as e:
+                logger.info(f"Rejected bucket entries: {e}")
+                self.response({"status": "Error", "data": {}}, address)
+                return
+
+            data = self.database.bucket_entries(message["buckets"])
+            try:
+                self.database.merge_tables(*tables)
+            except ValueError as e:
+                logger.info(f"Could not merge bucket entries: {e}")
+                self.response({"status": "Error", "data": {}}, address)
+                return
+            res = {
+                "status": "Success",
+                "data": data
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully exchanged {len(message['buckets'])} buckets")
+        elif message["query"] == "anti_entropy":
+            self.anti_entropy(message["to"], address)
+        elif message["query"] == "gc":
+            stats = self.database.collect_garbage(message["peers"])
+            res = {
+                "status": "Success",
+                "data": stats
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully collected garbage: {stats}")
+        elif message["query"] == "add_vertex":
+            u = int(message["u"])
+            status, _ = self.database.add_vertex(u)
+            res = {
+                "status": status,
+                "_": _
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully added vertex {u}")
+        elif message["query"] == "add_edge":
+            u = int(message["u"])
+            v = int(message["v"])
+
+            status, _ = self.database.add_edge(u, v, message.get("timestamp"))
+            res = {
+                "status": status,
+                "_": _
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully added edge {u} - {v}")
+        elif message["query"] == "batch":
+            results = self.database.batch(message["operations"])
+            res = {
+                "data": results
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully applied batch of {len(results)} operations")
+        elif message["query"] == "remove_vertex":
+            u = int(message["u"])
+            status = self.database.remove_vertex(u, message.get("timestamp"))
+
+            res = {
+                "status": status
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully removed vertex {u}")
+        elif message["query"] == "remove_edge":
+            u = int(message["u"])
+            v = int(message["v"])
+
+            status = self.database.remove_edge(u, v, message.get("timestamp"))
+            res = {
+                "status": status
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully removed edge {u} - {v}")
+        elif message["query"] == "remove_edges":
+            for u, v in message["edges"]:
+                self.database.remove_edge(int(u), int(v), message.get("timestamp"))
+
+            self.response({"status": True}, address)
+            logger.info(f"Successfully removed {len(message['edges'])} edges")
+        elif message["query"] == "exists_batch":
+            res = {
+                "data": [self.database.contains_vertex(int(u))[1] for u in message["nodes"]]
+            }
+
+            self.response(res, address)
+        elif message["query"] == "neighbors_batch":
+            res = {
+                "data": [self.database.get_neighbors(int(u)) for u in message["nodes"]]
+            }
+
+            self.response(res, address)
+        elif message["query"] == "list_nodes":
+            res = {
+                "data": sorted(self.database.list_nodes())
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully listed {len(res['data'])} nodes")
+        elif message["query"] == "exists_vertex":
+            u = int(message["u"])
+            _, status = self.database.contains_vertex(u)
+
+            res = {
+                "_": _,
+                "status": status
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully check exists {u}")
+        elif message["query"] == "exists_edge":
+            u = int(message["u"])
+            v = int(message["v"])
+
+            _, status = self.database.contains_edge(u, v)
+            res = {
+                "_": _,
+                "status": status
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully check exists {u} - {v}")
+        elif message["query"] == "get_neighbors":
+            u = int(message["u"])
+
+            key = ("get_neighbors", u)
+            res = self.read_cache.get(key, self.database.version)
+            if res is None:
+                _, status = self.database.get_neighbors(u)
                 res = {
                     "_": _,
                     "status": status
                 }
-
-                self.response(res, address)
-                logger.info(f"Successfully get neighbors {u}")
-            elif message["query"] == "find_path":
-                u = int(message["u"])
-                v = int(message["v"])
-
-                status, path = database_instance.find_path(u, v)
+                self.read_cache.put(key, self.database.version, res)
+
+            self.response(res, address)
+            logger.info(f"Successfully get neighbors {u}")
+        elif message["query"] == "find_path":
+            u = int(message["u"])
+            v = int(message["v"])
+            max_hops = message.get("max_hops")
+
+            key = ("find_path", u, v, max_hops)
+            res = self.read_cache.get(key, self.database.version)
+            if res is None:
+                status, path = self.database.find_path(u, v, max_hops=max_hops)
                 res = {
                     "status": status,
                     "path": path
                 }
-
-                self.response(res, address)
-                logger.info(f"Successfully find path from {u} to {v}")
-            elif message["query"] == "get_friend":
-                data = database_instance.get_cluster_table()
-
-                res = {
-                    "data": data
-                }
-
-                self.response(res, address)
-                logger.info(f"Successfully get friend")
-            elif message["query"] == "clear":
-                data = database_instance.clear()
-
-                res = {
-                    "data": data
-                }
-                self.response(res, address)
-                logger.info(f"Successfully clear database")
-            elif message["query"] == "register":
-                addr = message["to"]
-                self.response({"data": "Success"}, address)
-                try:
-                    response = requests.post(f"{addr}/register",
-                                             data={"their_address": message["data"],
-                                                   "my_address": message["from"]},
-                                             timeout=Config.REQUEST_TIMEOUT)
-                    response = response.json()["status"]
-                except Exception as e:
-                    logger.exception(e)
-                    logger.info(f"Request timeout {addr}/register")
-
-                f, t, d = message["from"], message["to"], message["data"]
-                logger.info(f"Broadcasted from {f} to {t} with {d}: {response}")
-            else:
-                continue
+                self.read_cache.put(key, self.database.version, res)
+
+            self.response(res, address)
+            logger.info(f"Successfully find path from {u} to {v}")
+        elif message["query"] == "get_friend":
+            data = self.database.get_cluster_table()
+
+            res = {
+                "data": data
+            }
+
+            self.response(res, address)
+            logger.info(f"Successfully get friend")
+        elif message["query"] == "clear":
+            data = self.database.clear()
+
+            res = {
+                "data": data
+            }
+            self.response(res, address)
+            logger.info(f"Successfully clear database")
+        elif message["query"] == "register":
+            self.response({"data": "Success"}, address)
+            self.forward_register(message)
+        elif message["query"] == "metrics":
+            self.response({"data": self.metrics.collect()}, address)
+        else:
+            return
+
+        self.query_seconds.labels(message["query"]).observe(time.perf_counter() - started)
@@ -25,4 +25,5 @@ setup(
     packages=find_packages(exclude=("example", "test", "graph_crdt")),
     include_package_data=True,
     install_requires=['requests'],
+    extras_require={'async': ['httpx']},
 )
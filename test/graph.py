@@ -0,0 +1,1098 @@
+import io
+import os
+import json
+import time
+import logging
+import asyncio
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from graph_crdt import codec
+from graph_crdt.graph import CRDTGraph
+from graph_crdt.merkle import check_buckets, check_nodes, diff_buckets
+from graph_crdt.wal import Checkpointer
+from graph_crdt.bootstrap import END, BootstrapSessions, frame, read_frames
+from graph_crdt.dedupe import DedupeCache
+from graph_crdt.gossip import check_message
+from graph_crdt.storage import EMPTY, ColumnStore
+from graph_crdt.scheduler import SyncScheduler
+from graph_crdt.lock import ReadWriteLock
+from graph_crdt.metrics import MetricsRegistry, render, with_labels
+from graph_crdt.worker import DatabaseWorker
+from graph_crdt.transport import make_async_client, make_client, pack_message, unpack_message
+from graph_crdt.router import ShardRouter
+from graph_crdt.shard import Partition, partition_tables, shard_addresses, shard_of
+from benchmark.simulation import SimulatedNetwork, Simulation
+
+
+class CRDTGraphTestCase(unittest.TestCase):
+    storage = "dict"
+
+    def new_graph(self, bidirection=True):
+        return CRDTGraph(bidirection=bidirection, storage=self.storage)
+
+    def test_get_neighbors(self):
+        graph = self.new_graph()
+        for u in range(1, 5):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(3, 1)
+
+        self.assertEqual(graph.get_neighbors(1), (True, [2, 3]))
+        self.assertEqual(graph.get_neighbors(3), (True, [1]))
+        self.assertEqual(graph.get_neighbors(4), (True, []))
+        self.assertEqual(graph.get_neighbors(5), (False, []))
+
+        graph.remove_edge(1, 3)
+        self.assertEqual(graph.get_neighbors(1), (True, [2]))
+
+    def test_remove_vertex_drops_incident_edges(self):
+        graph = self.new_graph()
+        for u in range(1, 4):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(2, 3)
+
+        self.assertTrue(graph.remove_vertex(2))
+        self.assertFalse(graph.contains_edge(1, 2)[1])
+        self.assertFalse(graph.contains_edge(2, 3)[1])
+        self.assertEqual(graph.get_neighbors(1), (True, []))
+
+    def test_get_neighbors_monodirection(self):
+        graph = self.new_graph(bidirection=False)
+        for u in range(1, 4):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(3, 1)
+
+        self.assertEqual(graph.get_neighbors(1), (True, [2]))
+        self.assertEqual(graph.get_neighbors(3), (True, [1]))
+
+    def test_merge_updates_neighbors(self):
+        graph = self.new_graph()
+        for u in range(1, 4):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+
+        timestamp = graph.edges.added[(1, 2)]
+        graph.merge(json.dumps({}), json.dumps({}),
+                    json.dumps({"3_1": timestamp}),
+                    json.dumps({"1_2": timestamp + 1}))
+
+        self.assertEqual(graph.get_neighbors(1), (True, [3]))
+        self.assertEqual(graph.get_neighbors(2), (True, []))
+
+        # a stale add must not resurrect the removed edge
+        graph.merge(json.dumps({}), json.dumps({}), json.dumps({"2_1": timestamp}), json.dumps({}))
+        self.assertEqual(graph.get_neighbors(1), (True, [3]))
+
+    def test_batch(self):
+        graph = self.new_graph()
+        results = graph.batch([["add_vertex", 1], ["add_vertex", 2], ["add_vertex", 1], ["add_edge", 1, 2],
+                               ["add_edge", 1, 3], ["remove_edge", 2, 1], ["remove_vertex", 2], ["drop", 1],
+                               ["add_vertex", "x"], ["add_edge", 1]])
+
+        self.assertEqual([status for status, _ in results],
+                         [True, True, False, True, False, True, True, False, False, False])
+        self.assertEqual(results[2][1], "Duplicated")
+        self.assertEqual(graph.list_nodes(), [1])
+        self.assertEqual(graph.get_neighbors(1), (True, []))
+
+        # a client cannot choose the timestamp of a write
+        results = graph.batch([["add_vertex", 4, 4102444800], ["remove_vertex", 1, 4102444800],
+                               ["add_edge", 1, 4, 4102444800], ["remove_edge", 1, 4, 4102444800]])
+        self.assertEqual([status for status, _ in results], [False, False, False, False])
+        self.assertEqual(graph.list_nodes(), [1])
+
+        results = graph.batch([[["add_vertex"], 1], [], 5, [None, 1], ["add_vertex", [1]]])
+        self.assertEqual([status for status, _ in results], [False, False, False, False, False])
+
+    def test_find_path(self):
+        graph = self.new_graph()
+        for u in range(1, 7):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(1, 3)
+        graph.add_edge(3, 4)
+        graph.add_edge(4, 5)
+
+        self.assertEqual(graph.find_path(1, 2), (True, [1, 2]))
+        self.assertEqual(graph.find_path(2, 3), (True, [2, 1, 3]))
+        self.assertEqual(graph.find_path(2, 5), (True, [2, 1, 3, 4, 5]))
+        self.assertEqual(graph.find_path(5, 5), (True, [5]))
+        self.assertEqual(graph.find_path(1, 6), (False, []))
+        self.assertEqual(graph.find_path(1, 7), (False, []))
+
+        graph.add_edge(2, 5)
+        self.assertEqual(graph.find_path(1, 5), (True, [1, 2, 5]))
+
+        graph.remove_vertex(2)
+        self.assertEqual(graph.find_path(1, 5), (True, [1, 3, 4, 5]))
+
+    def test_find_path_max_hops(self):
+        graph = self.new_graph()
+        for u in range(1, 5):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(2, 3)
+        graph.add_edge(3, 4)
+
+        self.assertEqual(graph.find_path(1, 4, max_hops=3), (True, [1, 2, 3, 4]))
+        self.assertEqual(graph.find_path(1, 4, max_hops=2), (False, []))
+        self.assertEqual(graph.find_path(1, 3, max_hops=2), (True, [1, 2, 3]))
+
+    def test_find_path_monodirection(self):
+        graph = self.new_graph(bidirection=False)
+        for u in range(1, 4):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(2, 3)
+
+        self.assertEqual(graph.find_path(1, 3), (True, [1, 2, 3]))
+        self.assertEqual(graph.find_path(3, 1), (False, []))
+
+    def test_delta_since_acknowledged_sync(self):
+        graph, replica = self.new_graph(), self.new_graph()
+        for u in range(1, 11):
+            graph.add_vertex(u)
+
+        # an unknown peer gets the full state
+        data, sequence, full_state = graph.delta("replica")
+        self.assertTrue(full_state)
+        replica.merge(data["vertices_added"], data["vertices_removed"], data["edges_added"], data["edges_removed"])
+        graph.acknowledge("replica", sequence)
+
+        graph.add_edge(1, 2)
+        graph.remove_vertex(3)
+        data, sequence, full_state = graph.delta("replica")
+        self.assertFalse(full_state)
+        self.assertEqual(json.loads(data["vertices_added"]), {})
+        self.assertEqual(list(json.loads(data["vertices_removed"])), ["3"])
+        self.assertEqual(list(json.loads(data["edges_added"])), ["1_2"])
+
+        replica.merge(data["vertices_added"], data["vertices_removed"], data["edges_added"], data["edges_removed"])
+        graph.acknowledge("replica", sequence)
+        self.assertEqual(sorted(replica.list_nodes()), sorted(graph.list_nodes()))
+        self.assertEqual(replica.get_neighbors(1), (True, [2]))
+        self.assertEqual(json.loads(graph.delta("replica")[0]["vertices_removed"]), {})
+
+    def test_delta_falls_back_to_full_state(self):
+        graph = self.new_graph()
+        graph.add_vertex(1)
+        graph.acknowledge("replica", graph.delta("replica")[1])
+
+        for u in range(2, 10):
+            graph.add_vertex(u)
+        data, _, full_state = graph.delta("replica")
+        self.assertTrue(full_state)
+        self.assertEqual(len(json.loads(data["vertices_added"])), 9)
+
+    def test_delta_changes_are_pruned(self):
+        graph = self.new_graph()
+        graph.add_vertex(1)
+        self.assertEqual(len(graph.delta_tracker.changes), 0)
+
+        graph.acknowledge("a", graph.delta("a")[1])
+        graph.acknowledge("b", graph.delta("b")[1])
+        graph.add_vertex(2)
+        graph.acknowledge("a", graph.delta("a")[1])
+        graph.add_vertex(3)
+        self.assertEqual(len(graph.delta_tracker.changes), 2)
+
+        graph.acknowledge("b", graph.delta("b")[1])
+        self.assertEqual(len(graph.delta_tracker.changes), 1)
+        self.assertEqual(list(json.loads(graph.delta("a")[0]["vertices_added"])), ["3"])
+
+    def test_merkle_anti_entropy(self):
+        graph, replica = self.new_graph(), self.new_graph()
+        for u in range(100):
+            graph.add_vertex(u)
+        for u in range(99):
+            graph.add_edge(u, u + 1)
+        data = graph.broadcast()
+        replica.merge(data["vertices_added"], data["vertices_removed"], data["edges_added"], data["edges_removed"])
+        self.assertEqual(diff_buckets(graph.merkle, replica.merkle.digest), [])
+
+        # freeing a dominated entry must not make equivalent replicas look different
+        graph.remove_vertex(7)
+        replica.merge(*graph.bucket_entries([graph.merkle.bucket(6), graph.merkle.bucket(7)]).values())
+        graph.compact()
+        self.assertEqual(diff_buckets(graph.merkle, replica.merkle.digest), [])
+
+        graph.add_vertex(1000)
+        replica.remove_edge(50, 51)
+        buckets = diff_buckets(graph.merkle, replica.merkle.digest)
+        self.assertEqual(sorted(buckets), sorted({graph.merkle.bucket(1000), graph.merkle.bucket(50)}))
+
+        mine, theirs = graph.bucket_entries(buckets), replica.bucket_entries(buckets)
+        replica.merge(*mine.values())
+        graph.merge(*theirs.values())
+        self.assertEqual(diff_buckets(graph.merkle, replica.merkle.digest), [])
+        self.assertTrue(replica.contains_vertex(1000)[1])
+        self.assertFalse(graph.contains_edge(50, 51)[1])
+
+        depth, fanout = graph.merkle.depth, graph.merkle.fanout
+        check_nodes(depth, [fanout ** depth - 1], graph.merkle.buckets, fanout)
+        for level, nodes in ((depth + 1, [0]), (-1, [0]), (1, [fanout]), (0, [-1]), (0, 0), (0, ["0"])):
+            self.assertRaises(ValueError, check_nodes, level, nodes, graph.merkle.buckets, fanout)
+
+        check_buckets([0, graph.merkle.buckets - 1], graph.merkle.buckets)
+        for buckets in ([graph.merkle.buckets], [-1], [[1]], [True], "[1]"):
+            self.assertRaises(ValueError, check_buckets, buckets, graph.merkle.buckets)
+
+    def test_merge_reports_changed_entries(self):
+        graph, replica = self.new_graph(), self.new_graph()
+        for u in range(1, 4):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.add_edge(3, 2)
+
+        self.assertEqual(replica.merge_tables(*graph.state()), 5)
+        self.assertEqual(replica.merge_tables(*graph.state()), 0)
+
+        # (3, 2) and (2, 3) collapse into one edge, the latest timestamp wins
+        timestamp = graph.edges.added[(2, 3)]
+        self.assertEqual(replica.merge_tables({}, {}, {(3, 2): timestamp + 2, (2, 3): timestamp + 1}, {}), 1)
+        self.assertEqual(replica.edges.added[(2, 3)], timestamp + 2)
+        self.assertEqual(replica.get_neighbors(2), (True, [1, 3]))
+
+    def test_version_moves_on_effective_writes(self):
+        graph, replica = self.new_graph(), self.new_graph()
+        graph.add_vertex(1)
+        graph.add_vertex(2)
+        version = graph.version
+        graph.add_vertex(1)
+        graph.get_neighbors(1)
+        self.assertEqual(graph.version, version)
+
+        graph.add_edge(1, 2)
+        self.assertGreater(graph.version, version)
+
+        replica.merge_tables(*graph.state())
+        version = replica.version
+        replica.merge_tables(*graph.state())
+        self.assertEqual(replica.version, version)
+
+    def test_collect_garbage(self):
+        graph, replica = self.new_graph(), self.new_graph()
+        for u in range(1, 5):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        graph.acknowledge("replica", graph.delta_tracker.sequence)
+        graph.remove_vertex(1)
+        graph.remove_vertex(3)
+
+        # the replica has not acknowledged the removals yet, so only the add entries they dominate can go
+        stats = graph.collect_garbage(["replica"])
+        self.assertEqual((stats["entries"], stats["tombstones"]), (3, 0))
+        self.assertEqual(graph.size(), 5)
+        self.assertEqual(len(graph.vertices.removed), 2)
+        self.assertEqual(len(graph.edges.removed), 1)
+
+        tables, sequence, _ = graph.delta_tables("replica")
+        replica.merge_tables(*tables)
+        graph.acknowledge("replica", sequence)
+        stats = graph.collect_garbage(["replica"])
+        self.assertEqual(stats["tombstones"], 3)
+        self.assertEqual(stats["payload_bytes"], 2 * 16 + 24)
+        self.assertGreater(stats["memory_bytes"], 0)
+        self.assertEqual(graph.size(), 2)
+        self.assertEqual(sorted(graph.list_nodes()), [2, 4])
+        self.assertEqual(graph.get_neighbors(2), (True, []))
+
+        # a replica still holding the tombstones agrees on the digest and cannot resurrect the vertices
+        self.assertEqual(diff_buckets(graph.merkle, replica.merkle.digest), [])
+        graph.merge_tables(*replica.state())
+        self.assertFalse(graph.contains_vertex(1)[1])
+
+        # a known replica that never acknowledged anything blocks the collection
+        graph.remove_vertex(4)
+        self.assertEqual(graph.collect_garbage(["replica", "newcomer"])["tombstones"], 0)
+        self.assertEqual(graph.collect_garbage([])["tombstones"], 4)
+
+    def test_unreachable_peer_expires(self):
+        graph = self.new_graph()
+        graph.delta_tracker.expiry = 3
+        graph.add_vertex(1)
+        graph.acknowledge("replica", graph.delta_tracker.sequence)
+        graph.acknowledge("dead", graph.delta_tracker.sequence)
+        graph.remove_vertex(1)
+        graph.acknowledge("replica", graph.delta_tracker.sequence)
+
+        # the dead peer pins the changes and stops the collection until it expires
+        self.assertEqual([graph.unreachable("dead") for _ in range(3)], [False, False, True])
+        self.assertFalse(graph.unreachable("dead"))
+        self.assertEqual(len(graph.delta_tracker.changes), 0)
+        self.assertEqual(graph.collect_garbage(["replica", "dead"])["tombstones"], 1)
+
+        # once back, it gets a full state and counts again
+        graph.reached("dead")
+        self.assertTrue(graph.delta_tables("dead")[2])
+        graph.add_vertex(2)
+        graph.remove_vertex(2)
+        graph.acknowledge("replica", graph.delta_tracker.sequence)
+        self.assertEqual(graph.collect_garbage(["replica", "dead"])["tombstones"], 0)
+
+    def test_adjacency_follows_lww_state(self):
+        graph = self.new_graph()
+        for u in range(3):
+            graph.add_vertex(u)
+
+        graph.add_edge(0, 1, timestamp=50)
+        graph.remove_edge(0, 1, timestamp=10)
+        self.assertEqual(graph.contains_edge(0, 1), (True, True))
+        self.assertEqual(graph.get_neighbors(0), (True, [1]))
+
+        graph.add_edge(0, 2, timestamp=50)
+        graph.remove_edge(0, 2, timestamp=100)
+        graph.add_edge(0, 2, timestamp=80)
+        self.assertEqual(graph.contains_edge(0, 2), (True, False))
+        self.assertEqual(graph.get_neighbors(0), (True, [1]))
+
+    def test_compacted_add_does_not_come_back(self):
+        a, b, d = self.new_graph(), self.new_graph(), self.new_graph()
+        a.add_vertex(7)
+        a.remove_vertex(7)
+        for peer, name in ((b, "B"), (d, "D")):
+            tables, sequence, _ = a.delta_tables(name)
+            peer.merge_tables(*tables)
+            a.acknowledge(name, sequence)
+        tables, sequence, _ = b.delta_tables("A")
+        a.merge_tables(*tables)
+        b.acknowledge("A", sequence)
+
+        # B frees the add entry its tombstone dominates, A collects the stable tombstone
+        b.compact()
+        self.assertEqual(a.collect_garbage(["B", "D"])["tombstones"], 1)
+
+        # D still ships add(7), which must not turn into a new change of B sent on without its tombstone
+        tables, _, _ = d.delta_tables("B")
+        self.assertEqual(b.merge_tables(*tables), 0)
+        tables, _, _ = b.delta_tables("A")
+        a.merge_tables(*tables)
+        self.assertFalse(a.contains_vertex(7)[1])
+        self.assertFalse(b.contains_vertex(7)[1])
+
+    def test_reads_leave_state_untouched(self):
+        graph = self.new_graph()
+        for u in range(4):
+            graph.add_vertex(u)
+        graph.add_edge(0, 1)
+        graph.remove_vertex(1)
+        graph.add_vertex(1)
+        size, version = graph.size(), graph.version
+
+        self.assertTrue(graph.contains_vertex(1)[1])
+        self.assertFalse(graph.contains_edge(0, 1)[1])
+        self.assertEqual(sorted(graph.list_nodes()), [0, 1, 2, 3])
+        self.assertEqual(graph.get_neighbors(0), (True, []))
+        self.assertEqual((graph.size(), graph.version), (size, version))
+
+        # the vertex tombstone and the edge add entry it hid are dominated
+        self.assertEqual(graph.compact()["entries"], 2)
+        self.assertEqual(graph.size(), size - 2)
+        self.assertTrue(graph.contains_vertex(1)[1])
+        self.assertFalse(graph.contains_edge(0, 1)[1])
+
+    def test_recovery_from_wal_and_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            graph = self.new_graph(bidirection=False)
+            checkpointer = Checkpointer(directory, graph, fsync=False)
+            checkpointer.recover()
+            for u in range(1, 6):
+                graph.add_vertex(u)
+            graph.add_edge(2, 1)
+            graph.add_edge(2, 3)
+            checkpointer.commit()
+            checkpointer.snapshot()
+
+            graph.remove_vertex(3)
+            graph.add_edge(4, 5)
+            checkpointer.commit()
+            graph.add_vertex(6)
+            checkpointer.close()
+
+            with open(os.path.join(directory, "wal.log"), "ab") as f:
+                # a commit torn by a crash
+                f.write(b"\x40\x00\x00\x00garbage")
+
+            recovered = self.new_graph(bidirection=False)
+            checkpointer = Checkpointer(directory, recovered, fsync=False)
+            restored = checkpointer.recover()
+            checkpointer.close()
+
+        self.assertGreater(restored, 0)
+        self.assertEqual(sorted(recovered.list_nodes()), [1, 2, 4, 5, 6])
+        self.assertEqual(recovered.get_neighbors(2), (True, [1]))
+        self.assertEqual(recovered.get_neighbors(1), (True, []))
+        self.assertEqual(recovered.get_neighbors(4), (True, [5]))
+        self.assertEqual(recovered.merkle.digest(0, [0]), graph.merkle.digest(0, [0]))
+
+    def test_bootstrap_stream(self):
+        graph = self.new_graph()
+        graph.batch([["add_vertex", u] for u in range(100)] + [["add_edge", u, u + 1] for u in range(99)] +
+                    [["remove_vertex", u] for u in range(0, 100, 10)])
+
+        sessions = BootstrapSessions()
+        session, total = sessions.open(graph)
+        self.assertEqual(total, graph.size())
+
+        stream, done = io.BytesIO(), False
+        while not done:
+            payload, done = sessions.chunk(session, size=37)
+            stream.write(frame(payload))
+            # changes during the transfer travel with the regular merges
+            graph.add_vertex(1000)
+        stream.write(END)
+        self.assertEqual(sessions.cursors, {})
+
+        newcomer = self.new_graph()
+        stream.seek(0)
+        for payload in read_frames(stream):
+            newcomer.merge_binary(payload)
+        self.assertEqual(sorted(newcomer.list_nodes()), [u for u in range(100) if u % 10])
+        self.assertEqual(newcomer.get_neighbors(5), (True, [4, 6]))
+
+        newcomer.merge_tables(*graph.state())
+        self.assertEqual(newcomer.merkle.digest(0, [0]), graph.merkle.digest(0, [0]))
+
+        with self.assertRaises(ConnectionError):
+            list(read_frames(io.BytesIO(stream.getvalue()[:-len(END)])))
+
+    def test_binary_merge(self):
+        graph, replica = self.new_graph(), self.new_graph()
+        for u in range(-3, 20):
+            graph.add_vertex(u)
+        for u in range(-3, 19):
+            graph.add_edge(u + 1, u)
+        graph.remove_vertex(5)
+
+        payload = graph.encode(graph.state(), codec.ENCODING)
+        self.assertEqual(codec.decode(payload), tuple(dict(table.items()) for table in graph.state()))
+
+        replica.merge_binary(payload)
+        self.assertEqual(replica.merkle.digest(0, [0]), graph.merkle.digest(0, [0]))
+        self.assertEqual(replica.find_path(-3, 4), graph.find_path(-3, 4))
+
+        self.assertRaises(ValueError, codec.check, b"GCRD\x02\x04")
+        self.assertRaises(ValueError, codec.decode, payload + b"\x00")
+        for size in (7, 20, len(payload) - 1):
+            self.assertRaises(ValueError, codec.check, payload[:size])
+            self.assertRaises(ValueError, codec.decode, payload[:size])
+
+
+class ArrayCRDTGraphTestCase(CRDTGraphTestCase):
+    storage = "array"
+
+    def test_storage_limits(self):
+        graph = self.new_graph()
+        graph.add_vertex(2 ** 40)
+        self.assertTrue(graph.contains_vertex(2 ** 40)[1])
+        self.assertFalse(graph.add_vertex(2 ** 63)[0])
+        self.assertFalse(graph.contains_vertex(2 ** 63)[1])
+
+        graph.add_vertex(-1)
+        self.assertFalse(graph.add_edge(2 ** 40, -1)[0])
+        graph.add_vertex(-2 ** 31)
+        self.assertEqual(graph.add_edge(-2 ** 31, -1), (True, ""))
+        self.assertEqual(graph.get_neighbors(-1), (True, [-2 ** 31]))
+
+    def test_merge_out_of_range_is_atomic(self):
+        graph = self.new_graph()
+        changes = list()
+        graph.vertices.observers.append(lambda table, changed: changes.append(changed))
+        with self.assertRaises(ValueError):
+            graph.merge_tables({1: 1.0, 2 ** 63: 2.0, 3: 3.0}, {}, {}, {})
+
+        self.assertEqual(len(graph.vertices.added), 0)
+        self.assertEqual(changes, [])
+
+    def test_compact_adjacency(self):
+        for bidirection in (True, False):
+            graph = CRDTGraph(bidirection=bidirection, storage=self.storage)
+            for u in range(6):
+                graph.add_vertex(u)
+            for v in (5, 2, 4, 1, 3):
+                graph.add_edge(0, v)
+            graph.add_edge(0, 2)
+            graph.remove_edge(0, 4)
+
+            self.assertEqual(list(graph.adjacency.neighbors(0)), [1, 2, 3, 5])
+            self.assertEqual(list(graph.adjacency.reverse_neighbors(5)), [0])
+            self.assertEqual(graph.adjacency.neighbors(4), ())
+            self.assertEqual(graph.get_neighbors(0), (True, [1, 2, 3, 5]))
+
+    def test_column_merge_growth(self):
+        store = ColumnStore()
+        store.merge(0, list(range(100)), [1.0] * 100)
+        capacity = store.capacity
+
+        # a merge that changes nothing does not grow the table
+        self.assertEqual(store.merge(0, list(range(100)), [1.0] * 100), [])
+        self.assertEqual(store.capacity, capacity)
+
+        # more new keys than the table was sized for
+        changed = store.merge(0, list(range(50, 400)), [2.0] * 350)
+        self.assertGreater(store.capacity, capacity)
+        self.assertEqual(len(changed), 350)
+        self.assertEqual(len([old for _, old, _ in changed if old is None]), 300)
+        self.assertEqual(store.sizes[0], 400)
+        self.assertEqual(sorted(item for item, _ in store.items(0)), list(range(400)))
+        self.assertEqual((store.get(0, 10), store.get(0, 60), store.get(1, 60)), (1.0, 2.0, None))
+
+        # a deleted slot is reused
+        store.delete(0, 5)
+        used = store.used
+        self.assertEqual(store.merge(0, [5], [3.0]), [(5, None, 3.0)])
+        self.assertEqual((store.used, store.sizes[0], store.get(0, 5)), (used, 400, 3.0))
+
+    def test_merge_in_peer_order(self):
+        # a peer's table comes in its slot order, which must not pile up into one probe run here
+        graph, replica = self.new_graph(), self.new_graph()
+        for u in range(23000):
+            graph.add_vertex(u)
+        entries = dict(list(graph.vertices.added.items())[:5000])
+        replica.merge_tables(entries, {}, {}, {})
+
+        run, longest = 0, 0
+        for key in replica.vertices.store.keys:
+            run = run + 1 if key != EMPTY else 0
+            longest = max(longest, run)
+        self.assertEqual(sorted(replica.list_nodes()), sorted(entries))
+        self.assertLess(longest, 200)
+
+    def test_growth_and_deletion(self):
+        graph = self.new_graph()
+        for u in range(5000):
+            graph.add_vertex(u)
+        for u in range(0, 5000, 2):
+            graph.remove_vertex(u)
+
+        self.assertEqual(sorted(graph.list_nodes()), list(range(1, 5000, 2)))
+        self.assertEqual(len(graph.vertices.added), 5000)
+
+        graph.compact()
+        self.assertEqual(sorted(graph.list_nodes()), list(range(1, 5000, 2)))
+        self.assertEqual(len(graph.vertices.added), 2500)
+        self.assertEqual(len(graph.vertices.removed), 2500)
+
+
+class DedupeCacheTestCase(unittest.TestCase):
+    def test_bounded_by_capacity(self):
+        cache = DedupeCache(capacity=100, ttl=None, error_rate=None)
+        for i in range(1000):
+            cache.add(str(i))
+
+        self.assertEqual(len(cache), 100)
+        self.assertIn("999", cache)
+        self.assertNotIn("0", cache)
+        self.assertEqual(cache.stats()["evictions"], 900)
+        self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 1))
+
+    def test_expires_after_ttl(self):
+        cache = DedupeCache(capacity=100, ttl=0.05, error_rate=None)
+        cache.add("a")
+        self.assertIn("a", cache)
+        time.sleep(0.1)
+        self.assertNotIn("a", cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_bloom_filter_remembers_evicted(self):
+        cache = DedupeCache(capacity=1000, ttl=None, error_rate=0.01)
+        for i in range(2000):
+            cache.add(f"seen-{i}")
+
+        self.assertEqual(len(cache), 1000)
+        self.assertTrue(all(f"seen-{i}" in cache for i in range(1000)))
+        self.assertEqual(cache.stats()["bloom_hits"], 1000)
+
+        false_positives = sum(f"new-{i}" in cache for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class ReadWriteLockTestCase(unittest.TestCase):
+    def test_readers_share_and_writers_exclude(self):
+        lock = ReadWriteLock()
+        inside, events = threading.Barrier(3, timeout=5), list()
+
+        def read():
+            lock.acquire_read()
+            inside.wait()
+            time.sleep(0.05)
+            events.append("read")
+            lock.release_read()
+
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+
+        # both readers are in at once, the writer waits for them to leave
+        inside.wait()
+        writer = threading.Thread(target=lambda: (lock.acquire_write(), events.append("write"), lock.release_write()))
+        writer.start()
+        for thread in readers + [writer]:
+            thread.join(5)
+        self.assertEqual(events, ["read", "read", "write"])
+
+    def test_reentrancy(self):
+        lock = ReadWriteLock()
+        lock.acquire_write()
+        lock.acquire_write()
+        lock.acquire_read()
+        lock.release_read()
+        lock.release_write()
+        lock.release_write()
+
+        lock.acquire_read()
+        lock.acquire_read()
+        with self.assertRaises(RuntimeError):
+            lock.acquire_write()
+        lock.release_read()
+        lock.release_read()
+        self.assertEqual((lock.readers, lock.writer), (0, None))
+
+    def test_concurrent_reads_and_merges(self):
+        graph, source = CRDTGraph(), CRDTGraph()
+        for u in range(200):
+            source.add_vertex(u)
+        for u in range(199):
+            source.add_edge(u, u + 1)
+        errors = list()
+
+        def read():
+            try:
+                for _ in range(50):
+                    nodes = graph.list_nodes()
+                    if nodes:
+                        graph.find_path(0, max(nodes))
+                        graph.get_neighbors(max(nodes))
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        graph.merge_tables(dict(source.vertices.added.items()), dict(), dict(), dict())
+        edges = list(source.edges.added.items())
+        for start in range(0, len(edges), 20):
+            graph.merge_tables(dict(), dict(), dict(edges[start: start + 20]), dict())
+        for reader in readers:
+            reader.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(graph.find_path(0, 199), source.find_path(0, 199))
+
+
+class MetricsTestCase(unittest.TestCase):
+    def test_render(self):
+        metrics = MetricsRegistry()
+        latency = metrics.histogram("query_seconds", "Query latency", ("query", ), buckets=(0.1, 1.0))
+        failures = metrics.counter("failures_total", "Failed requests")
+        for value in (0.05, 0.5, 5):
+            latency.labels("find_path").observe(value)
+        failures.inc()
+        failures.inc(2)
+
+        text = render(metrics.collect() + with_labels(metrics.collect(), shard="1"))
+        lines = text.splitlines()
+        self.assertEqual(lines.count("# TYPE gcrdt_query_seconds histogram"), 1)
+        self.assertIn('gcrdt_query_seconds_bucket{query="find_path",le="0.1"} 1', lines)
+        self.assertIn('gcrdt_query_seconds_bucket{query="find_path",le="+Inf"} 3', lines)
+        self.assertIn('gcrdt_query_seconds_sum{query="find_path"} 5.55', lines)
+        self.assertIn('gcrdt_query_seconds_count{query="find_path",shard="1"} 3', lines)
+        self.assertIn("gcrdt_failures_total 3", lines)
+
+
+class SyncSchedulerTestCase(unittest.TestCase):
+    def test_coalesces_writes_and_never_overlaps(self):
+        syncs, running = list(), set()
+
+        async def sync(peers):
+            self.assertFalse(running & set(peers))
+            running.update(peers)
+            syncs.append(list(peers))
+            await asyncio.sleep(0.1)
+            running.difference_update(peers)
+
+        async def run():
+            scheduler = SyncScheduler(lambda: ["a", "b"], sync, interval=60, delay=0.05, burst=100)
+            task = asyncio.ensure_future(scheduler.run())
+            await asyncio.sleep(0)
+
+            # a few writes are shipped together shortly after the first one
+            for _ in range(10):
+                scheduler.written()
+            await asyncio.sleep(0.2)
+            self.assertEqual(syncs, [["a", "b"]])
+
+            # a burst starts a round right away, a manual round meanwhile skips the busy peers
+            scheduler.written(100)
+            await asyncio.sleep(0.01)
+            self.assertEqual(await scheduler.round(), [])
+            await asyncio.sleep(0.3)
+            task.cancel()
+            return scheduler.stats()
+
+        stats = asyncio.run(run())
+        self.assertEqual(syncs, [["a", "b"]] * 3)
+        self.assertEqual((stats["coalesced_writes"], stats["skipped"]), (110, 2))
+
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.address = os.path.join(self.directory.name, "worker.sock")
+        self.worker = DatabaseWorker(socket_internal=self.address, database=CRDTGraph())
+        threading.Thread(target=self.worker.execute, daemon=True).start()
+        while not os.path.exists(self.address):
+            time.sleep(0.01)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_large_reply(self):
+        for u in range(2000):
+            self.worker.database.add_vertex(u)
+        for v in range(1, 2000):
+            self.worker.database.add_edge(0, v)
+
+        client = make_client(self.address)
+        reply = client.request(json.dumps({"query": "get_neighbors", "u": 0}).encode())
+        client.close()
+
+        self.assertGreater(len(reply), 2048)
+        self.assertEqual(json.loads(reply)["status"], list(range(1, 2000)))
+
+    def test_concurrent_requests(self):
+        for u in range(0, 200, 2):
+            self.worker.database.add_vertex(u)
+
+        async def run():
+            client = make_async_client(self.address)
+            replies = await asyncio.gather(*[
+                client.request(json.dumps({"query": "exists_vertex", "u": u}).encode()) for u in range(200)
+            ])
+            client.close()
+            return [json.loads(reply)["status"] for reply in replies]
+
+        self.assertEqual(asyncio.run(run()), [u % 2 == 0 for u in range(200)])
+
+    def test_request_timeout(self):
+        # a datagram worker nobody listens on never answers
+        async def run():
+            client = make_async_client(("127.0.0.1", 9), "udp", timeout=0.1)
+            try:
+                await client.request(b"{}")
+            finally:
+                client.close()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(run())
+
+    def test_slow_friend_does_not_block_queries(self):
+        class SlowFriend(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.reply({"encodings": []})
+
+            def do_POST(self):
+                time.sleep(1)
+                self.reply({"status": "Success", "data": "True"})
+
+            def reply(self, content):
+                body = json.dumps(content).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        friend = ThreadingHTTPServer(("127.0.0.1", 0), SlowFriend)
+        threading.Thread(target=friend.serve_forever, daemon=True).start()
+        friend_address = f"http://127.0.0.1:{friend.server_address[1]}"
+
+        client = make_client(self.address)
+        self.worker.database.add_vertex(1)
+        start = time.perf_counter()
+        broadcast = threading.Thread(target=client.request, args=(json.dumps({
+            "query": "broadcast", "uuid": "1", "from_addr": "http://127.0.0.1:1", "to": friend_address
+        }).encode(), ))
+        broadcast.start()
+
+        local = make_client(self.address)
+        reply = local.request(json.dumps({"query": "exists_vertex", "u": 1}).encode())
+        self.assertTrue(json.loads(reply)["status"])
+        self.assertLess(time.perf_counter() - start, 0.5)
+
+        broadcast.join()
+        self.assertEqual(self.worker.database.delta_tracker.acked, {friend_address: 1})
+        friend.shutdown()
+        friend.server_close()
+        client.close()
+        local.close()
+
+    def test_malformed_queries(self):
+        client = make_client(self.address)
+
+        def request(message):
+            return json.loads(client.request(json.dumps(message).encode()))
+
+        reply = request({"query": "batch", "operations": [[["add_vertex"], 1], ["add_vertex", 1]]})
+        self.assertEqual([status for status, _ in reply["data"]], [False, True])
+        self.assertEqual(request({"query": "add_vertex"})["status"], "Error")
+
+        for message in ({"sequence": 1, "ack": None, **CRDTGraph().broadcast()},
+                        {"from_addr": "a", "sequence": 1, "ack": None, "encoding": codec.ENCODING, "payload": "AAAA"},
+                        {"from_addr": "a", "sequence": 1, "ack": None, "vertices_added": "{"}):
+            with self.assertRaises(ValueError):
+                check_message(message)
+            self.assertEqual(request(dict(message, query="gossip"))["status"], "Error")
+        message = dict(CRDTGraph().broadcast(), query="gossip", from_addr="a", sequence=1, ack=None, edges_added="{")
+        self.assertEqual(request(message)["status"], "Error")
+
+        tables = CRDTGraph().broadcast()
+        for message in (dict(tables, buckets=[[1]]), dict(tables, buckets=[1], vertices_added="[1]"),
+                        dict(tables, buckets=[1], vertices_added='{"1": "x"}'), {"buckets": [1]}):
+            self.assertEqual(request(dict(message, query="digest_entries"))["status"], "Error")
+        self.assertEqual(request(dict(tables, query="digest_entries", buckets=[1]))["status"], "Success")
+
+        # the loop is still serving
+        self.assertTrue(request({"query": "exists_vertex", "u": 1})["status"])
+        client.close()
+
+    def test_binary_merge(self):
+        graph = CRDTGraph()
+        for u in range(1, 4):
+            graph.add_vertex(u)
+        graph.add_edge(1, 2)
+        payload = codec.encode(*graph.state())
+        data = {"query": "merge", "uuid": "1", "your_address": "", "from_addr": "", "friend_list": []}
+        self.assertEqual(unpack_message(pack_message(data, payload)), (data, payload))
+        self.assertEqual(unpack_message(pack_message(data)), (data, None))
+
+        client = make_client(self.address)
+        reply = json.loads(client.request(pack_message(data, payload[:-3])))
+        self.assertEqual(reply["status"], "Error")
+        reply = json.loads(client.request(pack_message(dict(data, **CRDTGraph.serialize({"x": 1.0}, {}, {}, {})))))
+        self.assertEqual(reply["status"], "Error")
+        self.assertEqual(self.worker.database.list_nodes(), [])
+
+        reply = json.loads(client.request(pack_message(data, payload)))
+        self.assertEqual(reply["changed"], 4)
+        self.assertEqual(self.worker.database.get_neighbors(1), (True, [2]))
+        client.close()
+
+    def test_read_cache(self):
+        for u in range(1, 4):
+            self.worker.database.add_vertex(u)
+        self.worker.database.add_edge(1, 2)
+
+        client = make_client(self.address)
+
+        def neighbors(u):
+            return json.loads(client.request(json.dumps({"query": "get_neighbors", "u": u}).encode()))["status"]
+
+        self.assertEqual(neighbors(1), [2])
+        self.assertEqual(neighbors(1), [2])
+        stats = json.loads(client.request(b'{"query": "read_cache_stats"}'))["data"]
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+
+        # a write never lets a stale answer through
+        client.request(json.dumps({"query": "add_edge", "u": 1, "v": 3}).encode())
+        self.assertEqual(neighbors(1), [2, 3])
+        client.close()
+
+    def test_metrics(self):
+        client = make_client(self.address)
+        graph = CRDTGraph()
+        for u in range(3):
+            graph.add_vertex(u)
+        client.request(json.dumps(dict(graph.broadcast(), query="merge", uuid="1", your_address="",
+                                       from_addr="", friend_list=[])).encode())
+        client.request(json.dumps({"query": "get_neighbors", "u": 1}).encode())
+        client.request(json.dumps({"query": "remove_vertex", "u": 1}).encode())
+
+        families = {family["name"]: family for family in json.loads(client.request(b'{"query": "metrics"}'))["data"]}
+        client.close()
+        samples = {(name, tuple(sorted(labels.items()))): value
+                   for family in families.values() for name, labels, value in family["samples"]}
+
+        self.assertEqual(samples[("gcrdt_worker_query_seconds_count", (("query", "get_neighbors"), ))], 1)
+        self.assertEqual(samples[("gcrdt_worker_merge_entries_changed_sum", (("source", "merge"), ))], 3)
+        self.assertEqual(samples[("gcrdt_worker_lww_entries", (("set", "vertices"), ("side", "added")))], 3)
+        self.assertEqual(samples[("gcrdt_worker_lww_entries", (("set", "vertices"), ("side", "removed")))], 1)
+        self.assertEqual(families["gcrdt_peer_request_seconds"]["type"], "histogram")
+
+    def test_gossip_push_pull(self):
+        peer_address = os.path.join(self.directory.name, "peer.sock")
+        peer = DatabaseWorker(socket_internal=peer_address, database=CRDTGraph())
+        threading.Thread(target=peer.execute, daemon=True).start()
+        while not os.path.exists(peer_address):
+            time.sleep(0.01)
+
+        class PeerGateway(BaseHTTPRequestHandler):
+            def do_POST(self):
+                message = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                peer_client = make_client(peer_address)
+                reply = json.loads(peer_client.request(json.dumps(dict(message, query="gossip")).encode()))
+                peer_client.close()
+
+                body = json.dumps(reply).encode()
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        gateway = ThreadingHTTPServer(("127.0.0.1", 0), PeerGateway)
+        threading.Thread(target=gateway.serve_forever, daemon=True).start()
+        gateway_address = f"http://127.0.0.1:{gateway.server_address[1]}"
+
+        self.worker.database.add_vertex(1)
+        peer.database.add_vertex(2)
+        client = make_client(self.address)
+
+        def gossip_round():
+            client.request(json.dumps({"query": "gossip_round", "peers": [gateway_address],
+                                       "from_addr": "http://127.0.0.1:1"}).encode())
+            while json.loads(client.request(b'{"query": "gossip_stats"}'))["data"]["exchanges"] < rounds:
+                time.sleep(0.01)
+
+        # one round trip pushes our delta and pulls the peer's
+        rounds = 1
+        gossip_round()
+        self.assertEqual(sorted(self.worker.database.list_nodes()), [1, 2])
+        self.assertEqual(sorted(peer.database.list_nodes()), [1, 2])
+        self.assertEqual(self.worker.database.delta_tracker.acked, {gateway_address: 1})
+
+        # the acknowledgement of the peer's delta travels with the next exchange, which only carries new entries
+        self.worker.database.add_vertex(3)
+        rounds = 2
+        gossip_round()
+        self.assertEqual(peer.database.delta_tracker.acked, {"http://127.0.0.1:1": 1})
+        self.assertEqual(sorted(peer.database.list_nodes()), [1, 2, 3])
+
+        stats = json.loads(client.request(b'{"query": "gossip_stats"}'))["data"]
+        self.assertEqual((stats["rounds"], stats["messages_sent"], stats["messages_received"]), (2, 2, 2))
+        self.assertEqual(stats["entries_received"], 1)
+        self.assertEqual(peer.gossip_metrics.stats()["entries_received"], 2)
+        gateway.shutdown()
+        gateway.server_close()
+        client.close()
+
+    def test_sharded_router(self):
+        shards = 3
+        workers = [DatabaseWorker(socket_internal=address, database=CRDTGraph(partition=Partition(index, shards)))
+                   for index, address in enumerate(shard_addresses(self.address + "-shard", shards))]
+        for worker in workers:
+            threading.Thread(target=worker.execute, daemon=True).start()
+        for worker in workers:
+            while not os.path.exists(worker.socket_internal):
+                time.sleep(0.01)
+
+        reference = CRDTGraph()
+        operations = [["add_vertex", u] for u in range(12)] + [["add_edge", u, (u * 5 + 1) % 12] for u in range(12)]
+        operations = operations + [["add_edge", 0, 42], ["remove_vertex", 6], ["remove_edge", 1, 6]]
+
+        async def run():
+            router = ShardRouter([make_async_client(worker.socket_internal) for worker in workers])
+            applied = (await router.batch(operations))["data"]
+            neighbors = [sorted((await router.get_neighbors(u))["status"]) for u in range(12)]
+            paths = [(await router.find_path(u, v))["path"] for u in range(12) for v in range(12)]
+            nodes = (await router.list_nodes())["data"]
+            for client in router.clients:
+                client.close()
+            return applied, neighbors, paths, nodes
+
+        applied, neighbors, paths, nodes = asyncio.run(run())
+        self.assertEqual([status for status, _ in applied], [status for status, _ in reference.batch(operations)])
+
+        # every vertex lives on a single shard, an edge on the owners of both of its endpoints
+        self.assertEqual(nodes, sorted(reference.list_nodes()))
+        self.assertEqual(neighbors, [sorted(reference.get_neighbors(u)[1]) for u in range(12)])
+        self.assertEqual([len(path) for path in paths],
+                         [len(reference.find_path(u, v)[1]) for u in range(12) for v in range(12)])
+        for index, worker in enumerate(workers):
+            self.assertTrue(all(shard_of(u, shards) == index for u in worker.database.list_nodes()))
+
+    def test_partition_tables(self):
+        graph = CRDTGraph()
+        for u in range(20):
+            graph.add_vertex(u)
+        for u in range(19):
+            graph.add_edge(u, u + 1)
+        graph.remove_vertex(7)
+
+        parts = partition_tables(graph.state(), 4)
+        for table_id in range(2):
+            self.assertEqual(sum(len(part[table_id]) for part in parts), len(graph.state()[table_id]))
+        for index, part in enumerate(parts):
+            self.assertTrue(all(shard_of(u, 4) == index for u in part[0]))
+            self.assertTrue(all(Partition(index, 4).owns_edge(edge) for edge in part[2]))
+
+
+class SimulationTestCase(unittest.TestCase):
+    def setUp(self):
+        # every simulated replica runs a worker, logging each of their queries
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_simulated_network(self):
+        network = SimulatedNetwork(latency=0.01, jitter=0.0)
+        network.attach("a", lambda path, message: {"echo": message["x"]})
+        network.attach("b", lambda path, message: {})
+        results = list()
+
+        def post(destination):
+            network.post("b", destination, "/echo", {"x": 1},
+                         lambda reply, error: results.append((network.now(), reply, type(error))), timeout=1)
+
+        start = network.now()
+        post("a")
+        network.slow("a", 0.5)
+        post("a")
+        network.slow("a", 0)
+        network.partition(["a"], ["b"])
+        post("a")
+        network.heal()
+        post("c")
+        network.run(start + 2)
+
+        self.assertEqual([(round(now - start, 6), reply, error) for now, reply, error in results], [
+            (0.02, {"echo": 1}, type(None)),
+            (0.02, None, ConnectionRefusedError),
+            (0.52, {"echo": 1}, type(None)),
+            (1.0, None, TimeoutError)
+        ])
+        self.assertEqual(network.stats()["messages"], 6)
+        self.assertEqual(network.stats()["dropped"], 1)
+
+    def test_simulation_converges_reproducibly(self):
+        def simulate(gossip):
+            network = SimulatedNetwork(7, latency=0.02, jitter=0.01, loss=0.05)
+            simulation = Simulation(12, network, gossip=gossip, seed=7, interval=1)
+            simulation.run(3)
+            addresses = [replica.address for replica in simulation.live()]
+            network.call_later(2, lambda: network.partition(addresses[:4], addresses[4:]))
+            network.call_later(4, network.heal)
+            simulation.run(6, write_rate=20, churn_rate=0.3)
+            return simulation.converge(60), simulation
+
+        for gossip in (False, True):
+            seconds, simulation = simulate(gossip)
+            self.assertIsNotNone(seconds)
+            self.assertTrue(simulation.converged())
+            self.assertGreater(simulation.writes, 50)
+            self.assertGreater(simulation.crashed, 0)
+            self.assertEqual(len({tuple(replica.root()) for replica in simulation.live()}), 1)
+            self.assertEqual(simulate(gossip)[1].stats(), simulation.stats())
+
+
+if __name__ == "__main__":
+    unittest.main()